@@ -0,0 +1,246 @@
+"""
+Límite de consultas por cliente y control de admisión.
+
+`ClientRateLimiter` es un token bucket por cliente (API key o IP) guardado en
+SQLite, así que todos los workers descuentan de la misma cuota. Cada
+decisión es una sola sentencia UPSERT ... RETURNING: rellenar, comprobar y
+descontar ocurren de forma atómica sin transacción explícita.
+
+`AdmissionController` rechaza de inmediato (503) las peticiones que no se
+van a poder atender a tiempo: las que ya esperaron demasiado en la cola del
+servidor (encabezado X-Request-Start de nginx), las que exceden el máximo de
+peticiones en curso del proceso y aquellas cuyo tiempo estimado (cola más
+rondas de consultas a Finkok por la latencia reciente) supera el deadline.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRateLimiter:
+    """Token bucket por cliente compartido entre workers.
+
+    `tasa` tokens por segundo hasta `capacidad`; una consulta de N RFCs
+    cuesta N tokens. Una tasa <= 0 desactiva el límite.
+    """
+
+    def __init__(self, ruta, tasa, capacidad=None):
+        self.ruta = ruta
+        self.tasa = tasa
+        self.capacidad = capacidad if capacidad is not None else max(1.0, tasa)
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        # Conexión temporal: las de trabajo se abren por hilo y no cruzan fork()
+        conexion = sqlite3.connect(ruta, timeout=10, isolation_level=None)
+        try:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS cubetas ("
+                " clave TEXT PRIMARY KEY,"
+                " tokens REAL NOT NULL,"
+                " actualizado REAL NOT NULL)"
+            )
+        finally:
+            conexion.close()
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        self._local = threading.local()
+        self._proxima_limpieza = time.time() + 60.0
+        self.permitidas = 0
+        self.rechazadas = 0
+        self.errores = 0
+
+    def _conexion(self):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            # Timeout corto: si la base está ocupada se deja pasar la petición
+            conexion = sqlite3.connect(self.ruta, timeout=0.5, isolation_level=None)
+            # La cuota no necesita sobrevivir a un corte de energía
+            conexion.execute("PRAGMA synchronous=OFF")
+            self._local.conexion = conexion
+        return conexion
+
+    def consumir(self, clave, costo=1):
+        """(permitido, tokens restantes, segundos a esperar para reintentar)"""
+        if self.tasa <= 0:
+            return True, None, 0.0
+        if costo > self.capacidad:
+            # Nunca cabría: no tiene sentido pedir que reintente
+            self.rechazadas += 1
+            return False, 0.0, None
+        ahora = time.time()
+        parametros = {'clave': clave, 'costo': costo, 'ahora': ahora,
+                      'tasa': self.tasa, 'capacidad': self.capacidad}
+        try:
+            conexion = self._conexion()
+            fila = conexion.execute(
+                "INSERT INTO cubetas (clave, tokens, actualizado) VALUES (:clave, :capacidad - :costo, :ahora)"
+                " ON CONFLICT(clave) DO UPDATE SET"
+                " tokens = min(:capacidad, tokens + max(0, :ahora - actualizado) * :tasa) - :costo,"
+                " actualizado = :ahora"
+                " WHERE min(:capacidad, tokens + max(0, :ahora - actualizado) * :tasa) >= :costo"
+                " RETURNING tokens", parametros
+            ).fetchone()
+            if fila is not None:
+                self.permitidas += 1
+                if ahora >= self._proxima_limpieza:
+                    self._limpiar(conexion, ahora)
+                return True, fila[0], 0.0
+            fila = conexion.execute(
+                "SELECT min(:capacidad, tokens + max(0, :ahora - actualizado) * :tasa)"
+                " FROM cubetas WHERE clave = :clave", parametros
+            ).fetchone()
+        except sqlite3.Error as e:
+            # Ante un problema con la base se prefiere atender de más que rechazar a todos
+            self.errores += 1
+            logger.error(f"Error en el limitador de consultas: {str(e)}")
+            return True, None, 0.0
+        disponibles = fila[0] if fila is not None else self.capacidad
+        self.rechazadas += 1
+        return False, disponibles, (costo - disponibles) / self.tasa
+
+    def esperar(self, clave, costo=1):
+        """Bloquea hasta poder descontar `costo` tokens (para trabajos en segundo plano)"""
+        while True:
+            permitido, _, espera = self.consumir(clave, costo)
+            if permitido or espera is None:
+                return
+            time.sleep(espera)
+
+    def _limpiar(self, conexion, ahora):
+        # Una cubeta llena equivale a no tener fila: se borran para que la tabla no crezca
+        self._proxima_limpieza = ahora + 60.0
+        conexion.execute(
+            "DELETE FROM cubetas WHERE actualizado < ?", (ahora - self.capacidad / self.tasa,)
+        )
+
+    def estadisticas(self):
+        return {
+            "tasa_por_segundo": self.tasa,
+            "rafaga": self.capacidad,
+            "permitidas": self.permitidas,
+            "rechazadas": self.rechazadas,
+            "errores": self.errores,
+        }
+
+
+def clave_cliente(api_key, ip):
+    """Identidad del cliente para el limitador; la API key no se guarda en claro"""
+    if api_key:
+        return 'k:' + hashlib.sha256(api_key.encode()).hexdigest()[:16]
+    return f'ip:{ip}'
+
+
+def tiempo_en_cola(encabezado, ahora=None):
+    """Segundos desde que el proxy recibió la petición (X-Request-Start: t=<epoch>).
+
+    Acepta epoch en segundos con milisegundos (nginx `${msec}`), en
+    milisegundos o en microsegundos. None si no hay encabezado válido.
+    """
+    if not encabezado:
+        return None
+    valor = encabezado.strip()
+    if valor.startswith('t='):
+        valor = valor[2:]
+    try:
+        inicio = float(valor)
+    except ValueError:
+        return None
+    if inicio > 1e14:
+        inicio /= 1e6
+    elif inicio > 1e11:
+        inicio /= 1e3
+    return max(0.0, (ahora if ahora is not None else time.time()) - inicio)
+
+
+class AdmissionController:
+    """Decide si una petición se atiende o se rechaza con 503 y Retry-After.
+
+    La latencia de Finkok se sigue con un promedio móvil exponencial
+    (`observar_upstream`); `rondas` es cuántas tandas de consultas necesita
+    la petición (RFCs / hilos de la consulta múltiple). Una estimación sin
+    observaciones recientes no se usa: si todo se rechazara por una latencia
+    vieja, nunca llegaría una medición nueva.
+    """
+
+    def __init__(self, max_cola=10.0, max_en_vuelo=200, deadline=55.0, suavizado=0.2):
+        self.max_cola = max_cola
+        self.max_en_vuelo = max_en_vuelo
+        self.deadline = deadline
+        self.suavizado = suavizado
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        self._lock = threading.Lock()
+        self.en_vuelo = 0
+        self.latencia_upstream = None
+        self._observada = 0.0
+        self.rechazos = {'cola': 0, 'en_vuelo': 0, 'deadline': 0}
+
+    def observar_upstream(self, segundos):
+        anterior = self.latencia_upstream
+        self.latencia_upstream = segundos if anterior is None else anterior + self.suavizado * (segundos - anterior)
+        self._observada = time.monotonic()
+
+    def evaluar(self, cola=None, rondas=1):
+        """None si se admite; si no, (motivo, segundos sugeridos para reintentar)"""
+        if cola is not None and self.max_cola > 0 and cola > self.max_cola:
+            self.rechazos['cola'] += 1
+            return 'cola', max(1, math.ceil(cola - self.max_cola))
+        if self.max_en_vuelo > 0 and self.en_vuelo >= self.max_en_vuelo:
+            self.rechazos['en_vuelo'] += 1
+            return 'en_vuelo', 1
+        reciente = time.monotonic() - self._observada < self.deadline
+        if rondas and reciente and self.latencia_upstream is not None and self.deadline > 0:
+            estimado = (cola or 0.0) + rondas * self.latencia_upstream
+            if estimado > self.deadline:
+                self.rechazos['deadline'] += 1
+                return 'deadline', max(1, math.ceil(estimado - self.deadline))
+        return None
+
+    def entrar(self):
+        with self._lock:
+            self.en_vuelo += 1
+
+    def salir(self):
+        with self._lock:
+            self.en_vuelo -= 1
+
+    def estadisticas(self):
+        return {
+            "en_vuelo": self.en_vuelo,
+            "max_en_vuelo": self.max_en_vuelo,
+            "max_cola_s": self.max_cola,
+            "deadline_s": self.deadline,
+            "latencia_upstream_ms": round(self.latencia_upstream * 1000, 1) if self.latencia_upstream is not None else None,
+            "rechazos": dict(self.rechazos),
+        }
+
+
+def crear_limitador(config):
+    """Construye el limitador por cliente a partir de la configuración (None si está deshabilitado)"""
+    if config.RATE_LIMIT <= 0:
+        return None
+    return ClientRateLimiter(config.RATE_LIMIT_DB_PATH, config.RATE_LIMIT / 60.0, config.RATE_LIMIT_RAFAGA)
+
+
+def crear_admision(config):
+    """Construye el control de admisión a partir de la configuración"""
+    return AdmissionController(
+        max_cola=config.ADMISSION_MAX_COLA_MS / 1000.0,
+        max_en_vuelo=config.ADMISSION_MAX_EN_VUELO,
+        deadline=config.ADMISSION_DEADLINE
+    )
@@ -0,0 +1,496 @@
+"""
+Entrega de alertas por webhook.
+
+Cada respuesta nueva de Finkok (consulta directa o refresco programado) pasa
+por `observar()`: se encola sin tocar el disco y un hilo compara las alertas
+del RFC contra las últimas vistas, guardadas en SQLite. Solo un cambio (alerta
+nueva, resuelta o con otro mensaje) produce un evento; la comparación y la
+actualización ocurren en la misma transacción, así que con varios workers el
+mismo cambio se notifica una sola vez.
+
+Los eventos se reparten a los webhooks registrados cuyo filtro coincide y se
+envían desde un event loop propio: por webhook se juntan en lotes (hasta
+`tamano_lote` eventos o `ventana_lote` segundos), se reintentan con backoff
+exponencial y, si se agotan los intentos, se escriben en un archivo de
+dead-letter (NDJSON). Un semáforo limita los envíos simultáneos.
+
+Los destinos se validan al registrarse y otra vez antes de cada envío (el DNS
+pudo cambiar): una URL que resuelve a una dirección privada, de loopback,
+link-local o reservada se rechaza, para que un webhook no sirva para alcanzar
+la red interna del servidor. El envío se conecta a la dirección ya validada
+(el host original va en la cabecera Host y en el SNI de TLS), así que un DNS
+que cambia entre la validación y la conexión no la evade; las redirecciones
+no se siguen.
+"""
+
+import atexit
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+TIPOS = ('critico', 'advertencia', 'atencion')
+
+
+def resolver_destino(url, permitir_privados=False):
+    """Resuelve el host de `url`: (dirección validada, None), o (None, motivo) si no se puede enviar"""
+    try:
+        partes = urlsplit(url)
+        puerto = partes.port
+    except ValueError:
+        return None, 'URL inválida'
+    if partes.scheme not in ('http', 'https') or not partes.hostname:
+        return None, 'Se requiere una URL http(s) con host'
+    if partes.username or partes.password:
+        return None, 'La URL no puede llevar credenciales'
+    try:
+        # En el orden de getaddrinfo, sin repetir
+        direcciones = list(dict.fromkeys(info[4][0] for info in socket.getaddrinfo(
+            partes.hostname, puerto or (443 if partes.scheme == 'https' else 80),
+            proto=socket.IPPROTO_TCP)))
+    except (socket.gaierror, UnicodeError):
+        return None, f"No se pudo resolver {partes.hostname}"
+    if not direcciones:
+        return None, f"No se pudo resolver {partes.hostname}"
+    if not permitir_privados:
+        for direccion in direcciones:
+            ip = ipaddress.ip_address(direccion.split('%', 1)[0])
+            if getattr(ip, 'ipv4_mapped', None):
+                ip = ip.ipv4_mapped
+            if not ip.is_global or ip.is_multicast:
+                return None, f"{partes.hostname} resuelve a una dirección no pública ({ip})"
+    return direcciones[0], None
+
+
+def destino_no_permitido(url, permitir_privados=False):
+    """Motivo por el que no se puede enviar a `url`, o None si es un destino público http(s)"""
+    return resolver_destino(url, permitir_privados)[1]
+
+
+def huella(alertas):
+    """Identifica un conjunto de alertas sin importar el orden"""
+    return hashlib.sha1(json.dumps(sorted((a.get('tipo'), a.get('mensaje')) for a in alertas)).encode()).hexdigest()
+
+
+class _Destino:
+    """Eventos pendientes de un webhook; lo toca solo el hilo del event loop"""
+
+    __slots__ = ('webhook', 'pendientes', 'tarea')
+
+    def __init__(self, webhook):
+        self.webhook = webhook
+        self.pendientes = deque()
+        self.tarea = None
+
+
+class AlertDispatcher:
+    """Detecta cambios de alertas por RFC y los entrega a webhooks.
+
+    Los webhooks se guardan en SQLite para que todos los workers los vean;
+    cada worker relee la lista cada `intervalo_sync` segundos.
+    """
+
+    def __init__(self, ruta, ruta_dead_letter, tamano_lote=50, ventana_lote=2.0, reintentos=5,
+                 backoff_base=1.0, backoff_max=60.0, concurrencia=10, timeout=10.0,
+                 max_pendientes=10000, intervalo_sync=5.0, permitir_privados=False):
+        self.ruta = ruta
+        self.ruta_dead_letter = ruta_dead_letter
+        self.tamano_lote = tamano_lote
+        self.ventana_lote = ventana_lote
+        self.reintentos = reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.concurrencia = concurrencia
+        self.timeout = timeout
+        self.max_pendientes = max_pendientes
+        self.intervalo_sync = intervalo_sync
+        self.permitir_privados = permitir_privados
+        for archivo in (ruta, ruta_dead_letter):
+            directorio = os.path.dirname(archivo)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+        # Conexión temporal: las de trabajo se abren por hilo y no cruzan fork()
+        conexion = sqlite3.connect(ruta, timeout=10, isolation_level=None)
+        try:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS webhooks ("
+                " id TEXT PRIMARY KEY,"
+                " url TEXT NOT NULL,"
+                " rfcs TEXT,"
+                " tipos TEXT,"
+                " secreto TEXT,"
+                " activo INTEGER NOT NULL,"
+                " creado REAL NOT NULL,"
+                " propietario TEXT)"
+            )
+            # Bases creadas antes de que los webhooks tuvieran dueño: esos quedan solo para el administrador
+            columnas = {fila[1] for fila in conexion.execute("PRAGMA table_info(webhooks)")}
+            if 'propietario' not in columnas:
+                conexion.execute("ALTER TABLE webhooks ADD COLUMN propietario TEXT")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS alertas_vigentes ("
+                " rfc TEXT PRIMARY KEY,"
+                " huella TEXT NOT NULL,"
+                " alertas TEXT NOT NULL,"
+                " actualizada REAL NOT NULL)"
+            )
+        finally:
+            conexion.close()
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+        atexit.register(self._al_salir)
+
+    def _reiniciar(self):
+        # También se usa tras un fork(): cola, hilos y event loop propios del proceso
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._lock_dead_letter = threading.Lock()
+        self._observaciones = deque()
+        self._despertar = threading.Event()
+        self._hilo = None
+        self._loop = None
+        self._clientes = {}
+        self._destinos = {}
+        self._webhooks = []
+        self._webhooks_leidos = 0.0
+        self.observadas = 0
+        self.eventos = 0
+        self.entregados = 0
+        self.lotes = 0
+        self.reintentos_realizados = 0
+        self.fallidos = 0
+        self.descartadas = 0
+
+    def _conexion(self):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    # Webhooks (cualquier worker)
+
+    def registrar_webhook(self, url, rfcs=None, tipos=None, secreto=None, propietario=None):
+        """Registra un webhook; `rfcs` y `tipos` en None significan todos"""
+        webhook_id = uuid.uuid4().hex
+        self._conexion().execute(
+            "INSERT INTO webhooks (id, url, rfcs, tipos, secreto, activo, creado, propietario)"
+            " VALUES (?, ?, ?, ?, ?, 1, ?, ?)",
+            (webhook_id, url, json.dumps(rfcs) if rfcs else None, json.dumps(tipos) if tipos else None,
+             secreto, time.time(), propietario)
+        )
+        self._webhooks_leidos = 0.0
+        return webhook_id
+
+    def eliminar_webhook(self, webhook_id, propietario=None):
+        """Da de baja un webhook; devuelve False si no existía (o, con `propietario`, si no es suyo)"""
+        if propietario is None:
+            cursor = self._conexion().execute(
+                "UPDATE webhooks SET activo = 0 WHERE id = ? AND activo = 1", (webhook_id,)
+            )
+        else:
+            cursor = self._conexion().execute(
+                "UPDATE webhooks SET activo = 0 WHERE id = ? AND activo = 1 AND propietario = ?",
+                (webhook_id, propietario)
+            )
+        self._webhooks_leidos = 0.0
+        return cursor.rowcount > 0
+
+    def listar_webhooks(self, propietario=None):
+        """Webhooks activos (sin el secreto); con `propietario`, solo los suyos"""
+        consulta = "SELECT id, url, rfcs, tipos, secreto IS NOT NULL, creado FROM webhooks WHERE activo = 1"
+        if propietario is None:
+            filas = self._conexion().execute(consulta + " ORDER BY creado").fetchall()
+        else:
+            filas = self._conexion().execute(
+                consulta + " AND propietario = ? ORDER BY creado", (propietario,)
+            ).fetchall()
+        return [{
+            'id': fila[0],
+            'url': fila[1],
+            'rfcs': json.loads(fila[2]) if fila[2] else None,
+            'tipos': json.loads(fila[3]) if fila[3] else None,
+            'firmado': bool(fila[4]),
+            'creado': datetime.fromtimestamp(fila[5]).isoformat(),
+        } for fila in filas]
+
+    def _leer_webhooks(self):
+        filas = self._conexion().execute(
+            "SELECT id, url, rfcs, tipos, secreto FROM webhooks WHERE activo = 1"
+        ).fetchall()
+        self._webhooks = [{
+            'id': fila[0],
+            'url': fila[1],
+            'rfcs': frozenset(json.loads(fila[2])) if fila[2] else None,
+            'tipos': frozenset(json.loads(fila[3])) if fila[3] else None,
+            'secreto': fila[4],
+        } for fila in filas]
+        self._webhooks_leidos = time.monotonic()
+
+    # Detección (camino de la petición: solo encola)
+
+    def observar(self, rfc, alertas, datos=None, momento=None):
+        """Encola las alertas de una respuesta nueva de Finkok para compararlas"""
+        with self._lock:
+            if len(self._observaciones) >= self.max_pendientes:
+                self.descartadas += 1
+                return
+            self._observaciones.append((rfc, alertas, datos, momento if momento is not None else time.time()))
+        self._iniciar()
+
+    def _iniciar(self):
+        if self._hilo is not None:
+            return
+        with self._lock:
+            if self._hilo is not None:
+                return
+            # asyncio y httpx se importan aquí: sin alertas observadas el proceso no los necesita
+            import asyncio
+            import httpx
+
+            self._asyncio = asyncio
+            self._httpx = httpx
+            self._cupos = asyncio.Semaphore(self.concurrencia)
+            self._loop = asyncio.new_event_loop()
+            threading.Thread(target=self._loop.run_forever, name='alertas-envio', daemon=True).start()
+            self._hilo = threading.Thread(target=self._ciclo, name='alertas-deteccion', daemon=True)
+            self._hilo.start()
+
+    def _ciclo(self):
+        while True:
+            self._despertar.wait(self.ventana_lote)
+            self._despertar.clear()
+            try:
+                self.procesar_pendientes()
+            except Exception as e:
+                logger.error(f"Error detectando cambios de alertas: {str(e)}")
+
+    def procesar_pendientes(self):
+        """Compara las observaciones encoladas y reparte los eventos resultantes"""
+        with self._lock:
+            lote, self._observaciones = self._observaciones, deque()
+        if not lote:
+            return 0
+        self.observadas += len(lote)
+        eventos = self._detectar(lote)
+        if not eventos:
+            return 0
+        self.eventos += len(eventos)
+        if time.monotonic() - self._webhooks_leidos > self.intervalo_sync:
+            self._leer_webhooks()
+        for webhook in self._webhooks:
+            seleccion = [e for e in eventos if self._coincide(webhook, e)]
+            if seleccion:
+                self._loop.call_soon_threadsafe(self._encolar, webhook, seleccion)
+        return len(eventos)
+
+    def _detectar(self, lote):
+        conexion = self._conexion()
+        eventos = []
+        # IMMEDIATE: dos workers no pueden reclamar el mismo cambio
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            for rfc, alertas, datos, momento in lote:
+                nueva = huella(alertas)
+                fila = conexion.execute(
+                    "SELECT huella, alertas, actualizada FROM alertas_vigentes WHERE rfc = ?", (rfc,)
+                ).fetchone()
+                if fila is not None and (fila[0] == nueva or fila[2] > momento):
+                    continue  # sin cambios, o ya hay una observación más reciente
+                anteriores = json.loads(fila[1]) if fila is not None else []
+                conexion.execute(
+                    "INSERT OR REPLACE INTO alertas_vigentes (rfc, huella, alertas, actualizada)"
+                    " VALUES (?, ?, ?, ?)", (rfc, nueva, json.dumps(alertas, ensure_ascii=False), momento)
+                )
+                if fila is None and not alertas:
+                    continue  # primer registro sin alertas: nada que notificar
+                vistas = {(a.get('tipo'), a.get('mensaje')) for a in anteriores}
+                actuales = {(a.get('tipo'), a.get('mensaje')) for a in alertas}
+                eventos.append({
+                    'id': uuid.uuid4().hex,
+                    'rfc': rfc,
+                    'momento': datetime.fromtimestamp(momento).isoformat(),
+                    'alertas': alertas,
+                    'nuevas': [a for a in alertas if (a.get('tipo'), a.get('mensaje')) not in vistas],
+                    'resueltas': [a for a in anteriores if (a.get('tipo'), a.get('mensaje')) not in actuales],
+                    'datos': datos,
+                })
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        return eventos
+
+    @staticmethod
+    def _coincide(webhook, evento):
+        if webhook['rfcs'] is not None and evento['rfc'] not in webhook['rfcs']:
+            return False
+        if webhook['tipos'] is None:
+            return True
+        return any(a.get('tipo') in webhook['tipos'] for a in evento['nuevas'] + evento['resueltas'])
+
+    # Entrega (hilo del event loop)
+
+    def _encolar(self, webhook, eventos):
+        destino = self._destinos.get(webhook['id'])
+        if destino is None:
+            destino = self._destinos[webhook['id']] = _Destino(webhook)
+        destino.webhook = webhook
+        espacio = self.max_pendientes - len(destino.pendientes)
+        if espacio < len(eventos):
+            # Webhook caído con la cola llena: lo que no cabe va directo al dead-letter
+            self._dead_letter(webhook, eventos[max(0, espacio):], 'cola llena', 0)
+            eventos = eventos[:max(0, espacio)]
+        destino.pendientes.extend(eventos)
+        if destino.tarea is None and destino.pendientes:
+            destino.tarea = self._loop.create_task(self._entregar(destino))
+
+    async def _entregar(self, destino):
+        try:
+            # Ventana para juntar los eventos que lleguen casi a la vez
+            await self._asyncio.sleep(self.ventana_lote)
+            while destino.pendientes:
+                lote = [destino.pendientes.popleft()
+                        for _ in range(min(self.tamano_lote, len(destino.pendientes)))]
+                await self._enviar_lote(destino.webhook, lote)
+        finally:
+            destino.tarea = None
+
+    async def _enviar_lote(self, webhook, eventos):
+        cuerpo = json.dumps({
+            'webhook': webhook['id'],
+            'enviado': datetime.now().isoformat(),
+            'eventos': eventos,
+        }, ensure_ascii=False).encode()
+        cabeceras = {'Content-Type': 'application/json'}
+        if webhook['secreto']:
+            firma = hmac.new(webhook['secreto'].encode(), cuerpo, hashlib.sha256).hexdigest()
+            cabeceras['X-Monitor-SAT-Firma'] = f"sha256={firma}"
+
+        # Se vuelve a validar el destino: el nombre pudo pasar a resolver a una dirección interna
+        direccion, motivo = await self._loop.run_in_executor(None, resolver_destino, webhook['url'],
+                                                             self.permitir_privados)
+        if motivo is not None:
+            self._dead_letter(webhook, eventos, f"Destino no permitido: {motivo}", 0)
+            return
+        # Se conecta a la dirección validada; httpx no vuelve a resolver el nombre
+        partes = urlsplit(webhook['url'])
+        url = self._httpx.URL(webhook['url']).copy_with(host=direccion.split('%', 1)[0])
+        cabeceras['Host'] = partes.netloc
+        extensiones = {'sni_hostname': partes.hostname} if partes.scheme == 'https' else {}
+        cliente = self._cliente_para(partes.hostname)
+
+        intento = 0
+        while True:
+            espera = None
+            try:
+                async with self._cupos:
+                    response = await cliente.post(url, content=cuerpo, headers=cabeceras, extensions=extensiones)
+                if response.status_code < 300:
+                    self.lotes += 1
+                    self.entregados += len(eventos)
+                    return
+                error = f"HTTP {response.status_code}"
+                # Los 4xx (salvo 408 y 429) no se arreglan reintentando
+                reintentable = response.status_code >= 500 or response.status_code in (408, 429)
+                if response.status_code == 429:
+                    try:
+                        espera = float(response.headers.get('Retry-After', ''))
+                    except ValueError:
+                        pass
+            except self._httpx.HTTPError as e:
+                error = f"{type(e).__name__}: {str(e)}"
+                reintentable = True
+
+            if not reintentable or intento >= self.reintentos:
+                self._dead_letter(webhook, eventos, error, intento + 1)
+                return
+            intento += 1
+            self.reintentos_realizados += 1
+            if espera is None:
+                espera = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** intento)))
+            logger.warning(f"Reintentando webhook {webhook['id']} ({intento}/{self.reintentos}) en {espera:.1f}s: {error}")
+            await self._asyncio.sleep(min(espera, self.backoff_max))
+
+    def _cliente_para(self, host):
+        # Un cliente por host: su pool se indexa por la dirección, y una conexión TLS
+        # abierta con el SNI de un host no debe reutilizarse para otro en la misma IP
+        cliente = self._clientes.get(host)
+        if cliente is None:
+            cliente = self._clientes[host] = self._httpx.AsyncClient(
+                timeout=self.timeout, headers={'User-Agent': 'Monitor-SAT/1.0'}
+            )
+        return cliente
+
+    def _dead_letter(self, webhook, eventos, error, intentos):
+        self.fallidos += len(eventos)
+        registro = json.dumps({
+            'webhook': webhook['id'],
+            'url': webhook['url'],
+            'error': error,
+            'intentos': intentos,
+            'momento': datetime.now().isoformat(),
+            'eventos': eventos,
+        }, ensure_ascii=False)
+        logger.error(f"Webhook {webhook['id']}: {len(eventos)} eventos al dead-letter ({error})")
+        try:
+            with self._lock_dead_letter, open(self.ruta_dead_letter, 'a') as f:
+                f.write(registro + '\n')
+        except OSError as e:
+            logger.error(f"Error escribiendo dead-letter: {str(e)}")
+
+    def _al_salir(self):
+        # Lo que sigue en memoria al terminar el proceso se conserva en el dead-letter
+        for destino in list(self._destinos.values()):
+            if destino.pendientes:
+                self._dead_letter(destino.webhook, list(destino.pendientes), 'proceso terminado', 0)
+                destino.pendientes.clear()
+
+    def estadisticas(self):
+        return {
+            "webhooks": len(self._webhooks),
+            "observadas": self.observadas,
+            "eventos": self.eventos,
+            "entregados": self.entregados,
+            "lotes": self.lotes,
+            "reintentos": self.reintentos_realizados,
+            "dead_letter": self.fallidos,
+            "descartadas": self.descartadas,
+            "pendientes": len(self._observaciones) + sum(len(d.pendientes) for d in list(self._destinos.values())),
+        }
+
+
+def crear_despachador(config):
+    """Construye el despachador de alertas a partir de la configuración (None si está deshabilitado)"""
+    if not config.ALERTS_ENABLED:
+        return None
+    return AlertDispatcher(
+        config.ALERTS_DB_PATH,
+        config.ALERTS_DEAD_LETTER_PATH,
+        tamano_lote=config.ALERTS_BATCH,
+        ventana_lote=config.ALERTS_BATCH_WINDOW,
+        reintentos=config.ALERTS_RETRIES,
+        backoff_base=config.ALERTS_BACKOFF_BASE,
+        backoff_max=config.ALERTS_BACKOFF_MAX,
+        concurrencia=config.ALERTS_CONCURRENCIA,
+        timeout=config.ALERTS_TIMEOUT,
+        max_pendientes=config.ALERTS_QUEUE_MAX,
+        intervalo_sync=config.ALERTS_SYNC,
+        permitir_privados=config.ALERTS_PERMITIR_PRIVADOS
+    )
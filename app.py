@@ -1,115 +1,284 @@
-from flask import Flask, request, jsonify
+from flask import Blueprint, Flask, request, jsonify, Response
 from flask_cors import CORS
 import requests
+import hmac
+import io
 import json
 import os
 import logging
 from datetime import datetime
-import base64
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-import xml.etree.ElementTree as ET
-import re
+import threading
+import time
+import contextvars
+import math
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import rfc_validator
+from cert_store import CertificateStore
+from result_cache import crear_cache
+from upstream import crear_cliente, CircuitBreaker
+from micro_batch import crear_lotes
+from metrics import MetricsRegistry
+from tracing import crear_tracer, fase, anotar
+from snapshots import codigos_alerta, renderizar_alertas
+from response_codec import FastJSONProvider, dumps_texto, elegir_codificacion, comprimir
+from secrets_provider import crear_proveedor_secretos
+from admission import ClientRateLimiter, crear_limitador, crear_admision, clave_cliente, tiempo_en_cola
+from settings import Config
 
 # Configuración de logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-CORS(app)  # Permite CORS para desarrollo
-
-# Configuración (en producción usar variables de entorno)
-class Config:
-    FINKOK_API_URL = "https://api.finkok.com/v3/cfdi33/status"
-    FINKOK_USERNAME = os.getenv('FINKOK_USERNAME', 'tu_usuario_finkok')
-    FINKOK_PASSWORD = os.getenv('FINKOK_PASSWORD', 'tu_password_finkok')
-    CERT_PATH = os.getenv('CERT_PATH', 'certificados/cert.cer')
-    KEY_PATH = os.getenv('KEY_PATH', 'certificados/key.key')
-    DEBUG = os.getenv('DEBUG', 'True').lower() == 'true'
+# Rutas y hooks; la aplicación se arma en crear_app()
+bp = Blueprint('monitor_sat', __name__)
 
 config = Config()
 
+metricas = MetricsRegistry(config.METRICS_DIR, config.METRICS_FLUSH_INTERVAL)
+tracer = crear_tracer(config, metricas)
+limitador = crear_limitador(config)
+admision = crear_admision(config)
+
 class SATMonitor:
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'Content-Type': 'application/json',
-            'User-Agent': 'Monitor-SAT/1.0'
-        })
+        # Un solo pool de conexiones compartido por todos los hilos del worker
+        self.cliente = crear_cliente(config)
+        self.lotes = crear_lotes(config, self.cliente.post_json)
+        self._executor = None
+        self._revalidador = None
+        self._executor_lock = threading.Lock()
+        self.cache = crear_cache(config)
+        self.secretos = crear_proveedor_secretos(config)
+        self.certificados = CertificateStore(
+            config.CERT_PATH,
+            config.KEY_PATH,
+            certs_dir=config.CERTS_DIR,
+            intervalo_stat=config.CERT_STAT_INTERVAL
+        )
+        # Los módulos de las funciones opcionales solo se importan si están habilitadas
+        self.historial = self.alertas = self.carteras = self.programador = None
+        if config.HISTORY_ENABLED:
+            from history_store import crear_historial
+            self.historial = crear_historial(config)
+        if config.ALERTS_ENABLED:
+            from alert_dispatch import crear_despachador
+            self.alertas = crear_despachador(config)
+        if config.PORTFOLIO_ENABLED:
+            from portfolio_store import crear_carteras
+            self.carteras = crear_carteras(config)
+        if config.SCHEDULER_ENABLED:
+            from scheduler import crear_programador
+            self.programador = crear_programador(
+                config,
+                self.consultar_finkok,
+                lambda rfc, data_sat: self.completar_respuesta(data_sat, rfc, {"hit": False, "programada": True})
+            )
     
     def validar_rfc(self, rfc):
-        """Valida formato básico del RFC"""
-        if not rfc:
-            return False
-        
-        rfc = rfc.strip()
-        
-        # RFC debe tener 12 o 13 caracteres
-        if len(rfc) < 12 or len(rfc) > 13:
-            return False
-        
-        # Validación básica de formato
-        # Personas morales: 12 caracteres (3 letras + 6 dígitos + 3 caracteres)
-        # Personas físicas: 13 caracteres (4 letras + 6 dígitos + 3 caracteres)
-        
-        if len(rfc) == 12:
-            # Persona moral: ABC123456789
-            pattern = r'^[A-Z&Ñ]{3}[0-9]{6}[A-Z0-9]{3}$'
-        else:
-            # Persona física: ABCD123456789
-            pattern = r'^[A-Z&Ñ]{4}[0-9]{6}[A-Z0-9]{3}$'
-        
-        return bool(re.match(pattern, rfc))
+        """Valida formato, fecha y dígito verificador del RFC"""
+        return self.motivo_rechazo(rfc) is None
     
-    def cargar_certificado(self):
-        """Carga el certificado y llave privada"""
-        try:
-            # En un entorno real, estos archivos deben estar seguros
-            with open(config.CERT_PATH, 'rb') as cert_file:
-                cert_data = cert_file.read()
-            
-            with open(config.KEY_PATH, 'rb') as key_file:
-                key_data = key_file.read()
-            
-            return base64.b64encode(cert_data).decode(), base64.b64encode(key_data).decode()
-        except FileNotFoundError:
-            logger.error("Archivos de certificado no encontrados")
-            return None, None
-        except Exception as e:
-            logger.error(f"Error cargando certificados: {str(e)}")
-            return None, None
+    def motivo_rechazo(self, rfc):
+        """Devuelve por qué se rechaza el RFC (None si es válido)"""
+        return rfc_validator.validar(rfc, verificar_digito=config.RFC_VALIDAR_DIGITO)
+    
+    def cargar_certificado(self, rfc=None):
+        """Obtiene el certificado y llave privada (en base64) desde el almacén en memoria"""
+        return self.certificados.obtener(rfc)
+    
+    def construir_payload(self, rfc):
+        """Arma el payload de Finkok para un RFC (None si no hay certificados)"""
+        cert_b64, key_b64 = self.cargar_certificado(rfc)
+        if not cert_b64 or not key_b64:
+            return None
+        
+        return {
+            "username": self.secretos.obtener('finkok_username', config.FINKOK_USERNAME),
+            "password": self.secretos.obtener('finkok_password', config.FINKOK_PASSWORD),
+            "rfc": rfc,
+            "certificate": cert_b64,
+            "private_key": key_b64
+        }
     
     def consultar_finkok(self, rfc):
         """Consulta la API de Finkok para obtener el estatus SAT"""
         try:
-            cert_b64, key_b64 = self.cargar_certificado()
-            if not cert_b64 or not key_b64:
+            with fase('certificados'):
+                payload = self.construir_payload(rfc)
+            if payload is None:
                 return {"error": "Error cargando certificados"}
             
-            payload = {
-                "username": config.FINKOK_USERNAME,
-                "password": config.FINKOK_PASSWORD,
-                "rfc": rfc,
-                "certificate": cert_b64,
-                "private_key": key_b64
-            }
-            
-            response = self.session.post(
-                config.FINKOK_API_URL,
-                json=payload,
-                timeout=30
-            )
-            
-            response.raise_for_status()
-            return response.json()
+            inicio = time.perf_counter()
+            try:
+                with fase('finkok'):
+                    if self.lotes is not None:
+                        return self.lotes.consultar(payload)
+                    return self.cliente.post_json(payload)
+            finally:
+                duracion = time.perf_counter() - inicio
+                metricas.observar('latencia_upstream', duracion)
+                admision.observar_upstream(duracion)
             
         except requests.exceptions.RequestException as e:
+            metricas.incrementar('errores_upstream')
             logger.error(f"Error en petición a Finkok: {str(e)}")
             return {"error": f"Error de conexión: {str(e)}"}
         except Exception as e:
             logger.error(f"Error inesperado: {str(e)}")
             return {"error": f"Error interno: {str(e)}"}
     
+    def respuesta_programada(self, rfc):
+        """Respuesta desde la última instantánea del refresco programado (None si no hay)"""
+        if self.programador is None:
+            return None
+        encontrada = self.programador.instantanea(rfc)
+        if encontrada is None:
+            return None
+        instantanea, edad = encontrada
+        # Un acierto no es observación nueva: la respuesta se arma desde la instantánea compacta
+        with fase('procesamiento'):
+            respuesta = instantanea.respuesta()
+        respuesta["cache"] = {"hit": True, "edad_segundos": round(edad, 3), "programada": True}
+        return respuesta
+    
+    def consultar_rfc(self, rfc, max_edad=0):
+        """Consulta Finkok (o la caché) y procesa la respuesta para un RFC ya validado.
+        
+        Con `max_edad` > 0 se admite servir el último resultado bueno de hasta
+        `max_edad` segundos si Finkok falla o tarda (ver ResultCache).
+        """
+        respuesta = self.respuesta_programada(rfc)
+        if respuesta is not None:
+            return respuesta
+        
+        ejecutor = espera = None
+        if max_edad > 0:
+            ejecutor = self._obtener_revalidador()
+            # Con el breaker abierto no tiene caso esperar: se sirve el respaldo de inmediato
+            espera = 0.0 if self.cliente.breaker.estado == CircuitBreaker.ABIERTO else config.STALE_ESPERA
+        data_sat, info_cache = self.cache.obtener_o_calcular(
+            rfc, lambda: self.consultar_finkok(rfc),
+            max_edad=max_edad, espera=espera, ejecutor=ejecutor
+        )
+        return self.completar_respuesta(data_sat, rfc, info_cache)
+    
+    def completar_respuesta(self, data_sat, rfc, info_cache):
+        """Procesa la respuesta de Finkok y le agrega la información de caché"""
+        with fase('procesamiento'):
+            respuesta = dict(self.procesar_respuesta_sat(data_sat, rfc))
+        respuesta["cache"] = info_cache
+        
+        # Solo las respuestas nuevas de Finkok son observaciones para el historial
+        nueva = not info_cache.get("hit") and not info_cache.get("coalescida")
+        if nueva and "datos" in respuesta:
+            if self.historial is not None:
+                self.historial.registrar(rfc, respuesta["datos"])
+            if self.alertas is not None:
+                self.alertas.observar(rfc, respuesta["alertas"], respuesta["datos"])
+            if self.carteras is not None:
+                self.carteras.observar(rfc, respuesta["alertas"], respuesta["datos"])
+        return respuesta
+    
+    def _obtener_executor(self):
+        # Se crea bajo demanda para no heredar hilos a través de fork()
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=config.MULTIPLE_MAX_WORKERS,
+                        thread_name_prefix='consulta-sat'
+                    )
+        return self._executor
+    
+    def _obtener_revalidador(self):
+        # Pool aparte: las consultas que siguen tras servir un respaldo no deben
+        # ocupar los hilos de la consulta múltiple (que a su vez las esperan)
+        if self._revalidador is None:
+            with self._executor_lock:
+                if self._revalidador is None:
+                    self._revalidador = ThreadPoolExecutor(
+                        max_workers=config.STALE_HILOS,
+                        thread_name_prefix='revalidacion-sat'
+                    )
+        return self._revalidador
+    
+    def consultar_varios(self, rfcs, deadline=None, max_edad=0):
+        """Consulta varios RFCs en paralelo y devuelve los resultados en el orden de entrada"""
+        resultados = [None] * len(rfcs)
+        for i, resultado in self.consultar_en_flujo(rfcs, deadline, ventana=len(rfcs), max_edad=max_edad):
+            resultados[i] = resultado
+        return resultados
+    
+    def consultar_en_flujo(self, rfcs, deadline=None, ventana=None, max_edad=0):
+        """Genera (índice, resultado) de cada RFC conforme termina su consulta.
+        
+        Solo hay `ventana` consultas en vuelo: el siguiente RFC se envía cuando
+        quien consume el generador toma un resultado, así que un cliente lento
+        frena las consultas en lugar de acumular resultados en memoria. Al
+        vencer el deadline, los RFCs restantes se reportan como tiempo agotado.
+        """
+        if deadline is None:
+            deadline = config.MULTIPLE_DEADLINE
+        if ventana is None:
+            ventana = config.MULTIPLE_MAX_WORKERS
+        
+        executor = self._obtener_executor()
+        limite = time.monotonic() + deadline
+        entrada = enumerate(rfcs)
+        en_vuelo = {}
+        agotada = False
+        
+        try:
+            while True:
+                while not agotada and len(en_vuelo) < ventana:
+                    siguiente = next(entrada, None)
+                    if siguiente is None:
+                        agotada = True
+                        break
+                    i, rfc = siguiente
+                    motivo = self.motivo_rechazo(rfc)
+                    if motivo is None:
+                        # Cada hilo corre en una copia del contexto para sumar sus fases a la traza
+                        en_vuelo[executor.submit(contextvars.copy_context().run, self.consultar_rfc, rfc, max_edad)] = i
+                    else:
+                        yield i, {
+                            'rfc': rfc,
+                            'error': 'RFC inválido',
+                            'motivo': motivo
+                        }
+                
+                if not en_vuelo:
+                    return
+                
+                terminados, _ = wait(en_vuelo, timeout=max(0.0, limite - time.monotonic()),
+                                     return_when=FIRST_COMPLETED)
+                if not terminados:
+                    break
+                
+                for futuro in terminados:
+                    i = en_vuelo.pop(futuro)
+                    try:
+                        yield i, futuro.result()
+                    except Exception as e:
+                        logger.error(f"Error consultando {rfcs[i]}: {str(e)}")
+                        yield i, {'rfc': rfcs[i], 'error': f"Error interno: {str(e)}"}
+            
+            # Deadline vencido: lo que sigue en vuelo o sin enviar se reporta como agotado
+            for futuro, i in list(en_vuelo.items()):
+                futuro.cancel()
+                del en_vuelo[futuro]
+                yield i, {'rfc': rfcs[i], 'error': 'Tiempo de espera agotado'}
+            for i, rfc in entrada:
+                motivo = self.motivo_rechazo(rfc)
+                if motivo is not None:
+                    yield i, {'rfc': rfc, 'error': 'RFC inválido', 'motivo': motivo}
+                else:
+                    yield i, {'rfc': rfc, 'error': 'Tiempo de espera agotado'}
+        finally:
+            # Cliente desconectado o generador cerrado: no seguir consultando
+            for futuro in en_vuelo:
+                futuro.cancel()
+    
     def procesar_respuesta_sat(self, data_sat, rfc):
         """Procesa la respuesta del SAT y estructura los datos"""
         try:
@@ -139,37 +308,65 @@ class SATMonitor:
             return {"error": f"Error procesando datos: {str(e)}"}
     
     def generar_alertas(self, data):
-        """Genera alertas basadas en los datos del SAT"""
-        alertas = []
-        
+        """Genera alertas basadas en los datos del SAT (reglas en snapshots.py)"""
         pendientes = data.get("pendientes", 0)
         vencidas = data.get("vencidas", 0)
         discrepancias = data.get("discrepancias", 0)
-        
-        if vencidas > 0:
-            alertas.append({
-                "tipo": "critico",
-                "mensaje": f"Tienes {vencidas} facturas vencidas que requieren atención inmediata"
-            })
-        
-        if pendientes > 10:
-            alertas.append({
-                "tipo": "advertencia",
-                "mensaje": f"Tienes {pendientes} facturas pendientes de procesamiento"
-            })
-        
-        if discrepancias > 0:
-            alertas.append({
-                "tipo": "atencion",
-                "mensaje": f"Se encontraron {discrepancias} discrepancias en tus facturas"
-            })
-        
-        return alertas
+        return renderizar_alertas(codigos_alerta(pendientes, vencidas, discrepancias),
+                                  pendientes, vencidas, discrepancias)
+
+def registrar_metricas(endpoint, resultados, inicio):
+    """Alimenta el agregador de métricas con los resultados de una petición"""
+    metricas.observar(f'latencia_{endpoint}', time.perf_counter() - inicio)
+    for resultado in resultados:
+        registrar_resultado(resultado)
+
+def registrar_resultado(resultado):
+    """Contadores de un resultado individual (también para respuestas en flujo)"""
+    metricas.incrementar('consultas')
+    metricas.incrementar_dia('consultas')
+    if 'error' in resultado:
+        metricas.incrementar('consultas_error')
+    elif resultado.get('rfc'):
+        metricas.registrar_rfc(resultado['rfc'])
+    info_cache = resultado.get('cache', {})
+    if info_cache.get('hit'):
+        metricas.incrementar('cache_hits')
+    if info_cache.get('obsoleta'):
+        metricas.incrementar('respuestas_obsoletas')
+    criticas = sum(1 for alerta in resultado.get('alertas', ()) if alerta.get('tipo') == 'critico')
+    if criticas:
+        metricas.incrementar_dia('alertas_criticas', criticas)
 
 # Instancia del monitor
 monitor = SATMonitor()
+monitor.certificados.instalar_manejador_sighup()
+
+# Tasa de consultas a Finkok común a todos los trabajos masivos de todos los workers
+tasa_jobs = (ClientRateLimiter(os.path.join(config.JOBS_DIR, 'tasa.sqlite3'), config.JOBS_TASA)
+             if config.JOBS_ENABLED and config.JOBS_TASA > 0 else None)
+
+def cobrar_cuota(cliente):
+    """Espera la tasa común de los trabajos y descuenta de la cuota del cliente un RFC de su trabajo"""
+    if tasa_jobs is not None:
+        tasa_jobs.esperar('trabajos')
+    if limitador is not None and cliente:
+        limitador.esperar(cliente)
 
-@app.route('/', methods=['GET'])
+# Trabajos masivos en segundo plano (la tasa la aplica cobrar_cuota, no cada worker)
+jobs = None
+if config.JOBS_ENABLED:
+    from bulk_jobs import JobManager, crear_procesador
+    jobs = JobManager(
+        config.JOBS_DIR,
+        crear_procesador(monitor, config.STALE_MAX_EDAD_JOBS),
+        concurrencia=config.JOBS_CONCURRENCIA,
+        cobrar=cobrar_cuota,
+        max_concurrentes=config.JOBS_MAX_CONCURRENTES,
+        max_bytes=config.JOBS_MAX_BYTES
+    )
+
+@bp.route('/', methods=['GET'])
 def health_check():
     """Endpoint de verificación de salud"""
     return jsonify({
@@ -179,7 +376,7 @@ def health_check():
         "timestamp": datetime.now().isoformat()
     })
 
-@app.route('/consultar_sat', methods=['POST'])
+@bp.route('/consultar_sat', methods=['POST'])
 def consultar_sat():
     """Endpoint principal para consultar el estatus SAT"""
     try:
@@ -196,29 +393,134 @@ def consultar_sat():
             return jsonify({'error': 'Se requiere el campo "rfc"'}), 400
             
         rfc = rfc.strip().upper()
+        anotar('rfc', rfc)
         
-        if not monitor.validar_rfc(rfc):
-            return jsonify({'error': 'RFC inválido. Formato: ABCD123456789 (13 caracteres) o ABC123456789 (12 caracteres)'}), 400
+        with fase('validacion'):
+            motivo = monitor.motivo_rechazo(rfc)
+        if motivo is not None:
+            return jsonify({
+                'error': f'RFC inválido. {rfc_validator.describir(motivo)}',
+                'motivo': motivo
+            }), 400
         
         logger.info(f"Consultando SAT para RFC: {rfc}")
+        inicio = time.perf_counter()
         
-        # Consultar API de Finkok
-        data_sat = monitor.consultar_finkok(rfc)
-        
-        # Procesar respuesta
-        respuesta = monitor.procesar_respuesta_sat(data_sat, rfc)
+        # Consultar API de Finkok y procesar respuesta
+        respuesta = monitor.consultar_rfc(rfc, config.STALE_MAX_EDAD_SAT)
+        registrar_metricas('consultar_sat', [respuesta], inicio)
         
         # Determinar código de estado HTTP
+        with fase('serializacion'):
+            cuerpo = jsonify(respuesta)
         if "error" in respuesta:
-            return jsonify(respuesta), 500
+            return cuerpo, 500
         
-        return jsonify(respuesta), 200
+        return cuerpo, 200
         
     except Exception as e:
         logger.error(f"Error en consultar_sat: {str(e)}")
         return jsonify({'error': 'Error interno del servidor'}), 500
 
-@app.route('/consultar_multiple', methods=['POST'])
+def costo_admision(ruta, cuerpo):
+    """Tokens que un POST descuenta de la cuota del cliente; None si la ruta no genera consultas a Finkok.
+    
+    Las consultas cuestan un token por RFC, igual que registrar RFCs para
+    refresco (/programadas, /carteras con "programar"). Crear un trabajo
+    masivo cuesta un token y cada RFC se cobra al procesarlo (cobrar_cuota).
+    """
+    datos = cuerpo if isinstance(cuerpo, dict) else {}
+    rfcs = datos.get('rfcs')
+    por_rfc = len(rfcs) if isinstance(rfcs, list) and rfcs else 1
+    if ruta in ('/consultar_sat', '/jobs'):
+        return 1
+    if ruta in ('/consultar_multiple', '/programadas'):
+        return por_rfc
+    if ruta.startswith('/carteras/') and datos.get('programar') is True:
+        return por_rfc
+    return None
+
+def admitir(ruta, cuerpo, api_key, ip, request_start, flujo=False):
+    """Control de admisión y cuota del cliente para las rutas que consultan Finkok.
+    
+    Devuelve (status, cuerpo, cabeceras); status None si la petición se
+    admite (las cabeceras informan la cuota restante).
+    """
+    costo = costo_admision(ruta, cuerpo) or 1
+    
+    cola = tiempo_en_cola(request_start)
+    if cola is not None:
+        metricas.observar('cola', cola)
+    # Las respuestas en flujo tienen su propio deadline y las demás rutas consultan en segundo
+    # plano: solo cuentan la cola y las peticiones en curso
+    sincrona = ruta in ('/consultar_sat', '/consultar_multiple') and not flujo
+    rondas = math.ceil(costo / config.MULTIPLE_MAX_WORKERS) if sincrona else 0
+    rechazo = admision.evaluar(cola, rondas)
+    if rechazo is not None:
+        motivo, espera = rechazo
+        metricas.incrementar(f'admision_rechazadas_{motivo}')
+        return 503, {'error': 'Servicio saturado, reintentar más tarde', 'motivo': motivo}, {'Retry-After': str(espera)}
+    
+    if limitador is None:
+        return None, None, {}
+    permitido, restantes, espera = limitador.consumir(clave_cliente(api_key, ip), costo)
+    cabeceras = {'X-RateLimit-Limit': f"{config.RATE_LIMIT:g}"}
+    if restantes is not None:
+        cabeceras['X-RateLimit-Remaining'] = str(int(restantes))
+    if permitido:
+        metricas.incrementar('limitador_permitidas')
+        return None, None, cabeceras
+    metricas.incrementar('limitador_rechazadas')
+    if espera is None:
+        return 429, {'error': f'La consulta excede la ráfaga máxima de {config.RATE_LIMIT_RAFAGA:g} RFCs'}, cabeceras
+    cabeceras['Retry-After'] = str(max(1, math.ceil(espera)))
+    return 429, {
+        'error': 'Límite de consultas excedido',
+        'reintentar_en_segundos': round(espera, 1)
+    }, cabeceras
+
+FORMATOS_FLUJO = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+def formato_flujo():
+    """Formato de flujo pedido con ?stream= o con el encabezado Accept (None = JSON normal)"""
+    formato = request.args.get('stream')
+    if formato in FORMATOS_FLUJO:
+        return formato
+    aceptado = request.headers.get('Accept', '')
+    for formato, tipo in FORMATOS_FLUJO.items():
+        if tipo in aceptado:
+            return formato
+    return None
+
+def serializar_evento(formato, evento, datos):
+    """Una línea NDJSON o un evento SSE"""
+    texto = dumps_texto(datos)
+    if formato == 'sse':
+        return f"event: {evento}\ndata: {texto}\n\n"
+    return texto + "\n"
+
+def flujo_multiple(rfcs, formato):
+    """Genera cada resultado conforme termina y al final un registro de resumen"""
+    inicio = time.perf_counter()
+    errores = 0
+    for i, resultado in monitor.consultar_en_flujo(rfcs, config.MULTIPLE_STREAM_DEADLINE,
+                                                   max_edad=config.STALE_MAX_EDAD_MULTIPLE):
+        registrar_resultado(resultado)
+        if 'error' in resultado:
+            errores += 1
+        yield serializar_evento(formato, 'resultado', {'indice': i, **resultado})
+    metricas.observar('latencia_consultar_multiple_flujo', time.perf_counter() - inicio)
+    yield serializar_evento(formato, 'resumen', {'resumen': {
+        'total_consultados': len(rfcs),
+        'errores': errores,
+        'duracion_ms': round((time.perf_counter() - inicio) * 1000, 1),
+        'timestamp': datetime.now().isoformat()
+    }})
+
+@bp.route('/consultar_multiple', methods=['POST'])
 def consultar_multiple():
     """Endpoint para consultar múltiples RFCs"""
     try:
@@ -229,75 +531,695 @@ def consultar_multiple():
         if not isinstance(rfcs, list) or len(rfcs) == 0:
             return jsonify({'error': 'La lista de RFCs no puede estar vacía'}), 400
         
-        if len(rfcs) > 10:  # Límite de seguridad
-            return jsonify({'error': 'Máximo 10 RFCs por consulta'}), 400
+        formato = formato_flujo()
+        if formato is not None:
+            if len(rfcs) > config.MULTIPLE_STREAM_MAX_RFCS:
+                return jsonify({'error': f'Máximo {config.MULTIPLE_STREAM_MAX_RFCS} RFCs por consulta en flujo'}), 400
+            anotar('rfcs', len(rfcs))
+            return Response(
+                flujo_multiple(rfcs, formato),
+                mimetype=FORMATOS_FLUJO[formato],
+                # Sin buffer en nginx: cada resultado sale en cuanto está listo
+                headers={'X-Accel-Buffering': 'no', 'Cache-Control': 'no-cache'}
+            )
         
-        resultados = []
+        if len(rfcs) > config.MULTIPLE_MAX_RFCS:  # Límite de seguridad
+            return jsonify({'error': f'Máximo {config.MULTIPLE_MAX_RFCS} RFCs por consulta'}), 400
         
-        for rfc in rfcs:
-            if monitor.validar_rfc(rfc):
-                data_sat = monitor.consultar_finkok(rfc)
-                resultado = monitor.procesar_respuesta_sat(data_sat, rfc)
-                resultados.append(resultado)
-            else:
-                resultados.append({
-                    'rfc': rfc,
-                    'error': 'RFC inválido'
-                })
+        inicio = time.perf_counter()
+        anotar('rfcs', len(rfcs))
+        resultados = monitor.consultar_varios(rfcs, max_edad=config.STALE_MAX_EDAD_MULTIPLE)
+        registrar_metricas('consultar_multiple', resultados, inicio)
         
-        return jsonify({
-            'resultados': resultados,
-            'total_consultados': len(resultados),
-            'timestamp': datetime.now().isoformat()
-        }), 200
+        with fase('serializacion'):
+            cuerpo = jsonify({
+                'resultados': resultados,
+                'total_consultados': len(resultados),
+                'timestamp': datetime.now().isoformat()
+            })
+        return cuerpo, 200
         
     except Exception as e:
         logger.error(f"Error en consultar_multiple: {str(e)}")
         return jsonify({'error': 'Error interno del servidor'}), 500
 
-@app.route('/estadisticas', methods=['GET'])
+def construir_estadisticas():
+    """Estadísticas generales agregadas de todos los workers"""
+    agregado = metricas.agregado()
+    contadores = agregado['contadores']
+    respuestas = contadores.get('respuestas', 0)
+    disponibilidad = 100.0
+    if respuestas:
+        disponibilidad = 100.0 * (respuestas - contadores.get('respuestas_5xx', 0)) / respuestas
+    
+    return {
+        "consultas_hoy": agregado['contadores_dia'].get('consultas', 0),
+        "rfcs_activos": agregado['rfcs_distintos_hoy'],
+        "alertas_criticas": agregado['contadores_dia'].get('alertas_criticas', 0),
+        "uptime": f"{disponibilidad:.1f}%",
+        "uptime_segundos": int(time.time() - agregado['inicio']),
+        "workers": agregado['workers'],
+        "latencias": {
+            nombre: MetricsRegistry.resumen_histograma(valores)
+            for nombre, valores in agregado['histogramas'].items()
+        },
+        # Contadores locales del worker que atiende la petición
+        "certificados": monitor.certificados.estadisticas(),
+        "cache": monitor.cache.estadisticas(),
+        "upstream": monitor.cliente.estadisticas(),
+        "trazas": tracer.estadisticas(),
+        "historial": monitor.historial.estadisticas() if monitor.historial is not None else None,
+        "programador": monitor.programador.estadisticas() if monitor.programador is not None else None,
+        "alertas": monitor.alertas.estadisticas() if monitor.alertas is not None else None,
+        "carteras": monitor.carteras.estadisticas() if monitor.carteras is not None else None,
+        "admision": admision.estadisticas(),
+        "lotes": monitor.lotes.estadisticas() if monitor.lotes is not None else None,
+        "secretos": monitor.secretos.estadisticas(),
+        "limitador": limitador.estadisticas() if limitador is not None else None,
+        "ultima_actualizacion": datetime.now().isoformat()
+    }
+
+def construir_metricas_prometheus():
+    """Métricas en formato de texto de Prometheus"""
+    upstream = monitor.cliente.estadisticas()
+    estados_breaker = {'cerrado': 0, 'semiabierto': 1, 'abierto': 2}
+    extra = {
+        'breaker_estado': estados_breaker.get(upstream['breaker']['estado'], 0),
+        'upstream_reintentos': upstream['reintentos'],
+        'upstream_conexiones_reutilizadas': upstream['pool']['reutilizadas'],
+        'certificados_recargas': monitor.certificados.recargas,
+        'admision_en_vuelo': admision.en_vuelo,
+    }
+    return metricas.prometheus(extra=extra)
+
+def construir_disponibilidad():
+    """Si este worker puede atender consultas (readiness); `/` solo indica que el proceso responde"""
+    rutas_certificado = monitor.certificados.rutas_para()
+    verificaciones = {
+        "certificados": all(os.access(ruta, os.R_OK) for ruta in rutas_certificado)
+                        or bool(config.CERTS_DIR and os.path.isdir(config.CERTS_DIR)),
+        "secretos": monitor.secretos.estadisticas()['edad_segundos'] is not None,
+        "admision": admision.max_en_vuelo <= 0 or admision.en_vuelo < admision.max_en_vuelo,
+    }
+    listo = all(verificaciones.values())
+    return listo, {
+        "listo": listo,
+        "pid": os.getpid(),
+        "verificaciones": verificaciones,
+        # Con el breaker abierto se sirven respaldos: informativo, no saca al worker de servicio
+        "finkok": monitor.cliente.breaker.estado,
+        "timestamp": datetime.now().isoformat()
+    }
+
+@bp.route('/estadisticas', methods=['GET'])
 def estadisticas_generales():
     """Endpoint para obtener estadísticas generales del sistema"""
-    # En producción, estos datos vendrían de una base de datos
-    stats = {
-        "consultas_hoy": 150,
-        "rfcs_activos": 25,
-        "alertas_criticas": 3,
-        "uptime": "99.9%",
-        "ultima_actualizacion": datetime.now().isoformat()
+    return jsonify(construir_estadisticas()), 200
+
+@bp.route('/metrics', methods=['GET'])
+def metricas_prometheus():
+    """Métricas en formato de texto de Prometheus"""
+    return Response(construir_metricas_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/listo', methods=['GET'])
+def disponibilidad():
+    """Endpoint de disponibilidad: 200 si el worker puede atender consultas, 503 si no"""
+    listo, cuerpo = construir_disponibilidad()
+    return jsonify(cuerpo), 200 if listo else 503
+
+@bp.route('/jobs', methods=['POST'])
+def crear_job():
+    """Crea un trabajo masivo a partir de un CSV/JSONL o de una lista JSON de RFCs"""
+    if jobs is None:
+        return jsonify({'error': 'Trabajos masivos deshabilitados'}), 404
+    from bulk_jobs import EntradaDemasiadoGrande, detectar_formato
+    propietario, error = identificar_cliente('Trabajos')
+    if error is not None:
+        return error
+    if config.JOBS_MAX_BYTES > 0 and (request.content_length or 0) > config.JOBS_MAX_BYTES:
+        return jsonify({'error': f'La entrada excede el máximo de {config.JOBS_MAX_BYTES} bytes'}), 413
+    try:
+        content_type = request.content_type or ''
+        
+        if 'application/json' in content_type:
+            rfcs = (request.json or {}).get('rfcs')
+            if not isinstance(rfcs, list) or len(rfcs) == 0:
+                return jsonify({'error': 'Se requiere una lista de RFCs'}), 400
+            contenido = '\n'.join(json.dumps(rfc) for rfc in rfcs).encode()
+            job_id = jobs.crear(io.BytesIO(contenido), 'jsonl', g.get('cliente_cuota'), propietario)
+        elif 'archivo' in request.files:
+            archivo = request.files['archivo']
+            formato = request.args.get('formato') or detectar_formato(archivo.filename or '')
+            job_id = jobs.crear(archivo.stream, formato, g.get('cliente_cuota'), propietario)
+        else:
+            formato = request.args.get('formato')
+            if not formato:
+                formato = 'jsonl' if ('ndjson' in content_type or 'jsonl' in content_type) else 'csv'
+            job_id = jobs.crear(request.stream, formato, g.get('cliente_cuota'), propietario)
+        
+        return jsonify({
+            'id': job_id,
+            'estado': 'en_cola',
+            'url': f'/jobs/{job_id}',
+            'resultados': f'/jobs/{job_id}/resultados'
+        }), 202
+        
+    except EntradaDemasiadoGrande as e:
+        return jsonify({'error': str(e)}), 413
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error en crear_job: {str(e)}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+def buscar_job(job_id):
+    """Estado de un trabajo del cliente que llama: (estado, error). Un cliente solo ve sus
+    trabajos y el administrador todos; uno ajeno se responde como inexistente"""
+    if jobs is None:
+        return None, (jsonify({'error': 'Trabajos masivos deshabilitados'}), 404)
+    propietario, error = identificar_cliente('Trabajos')
+    if error is not None:
+        return None, error
+    estado = jobs.estado(job_id)
+    if estado is None or (propietario is not None and estado.get('propietario') != propietario):
+        return None, (jsonify({'error': 'Trabajo no encontrado'}), 404)
+    return estado, None
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def estado_job(job_id):
+    """Devuelve el progreso de un trabajo masivo"""
+    estado, error = buscar_job(job_id)
+    if error is not None:
+        return error
+    estado.pop('offset_salida', None)
+    estado.pop('pid', None)
+    estado.pop('cliente', None)
+    estado.pop('propietario', None)
+    estado['resultados'] = f'/jobs/{job_id}/resultados'
+    return jsonify(estado), 200
+
+@bp.route('/jobs/<job_id>/reanudar', methods=['POST'])
+def reanudar_job(job_id):
+    """Reanuda un trabajo interrumpido desde su último checkpoint"""
+    estado, error = buscar_job(job_id)
+    if error is not None:
+        return error
+    if estado.get('estado') == 'completado':
+        return jsonify({'error': 'El trabajo ya está completado'}), 409
+    if not jobs.iniciar(job_id):
+        return jsonify({'error': 'El trabajo ya está en proceso'}), 409
+    return jsonify({'id': job_id, 'estado': 'en_cola' if config.JOBS_MAX_CONCURRENTES > 0 else 'en_proceso'}), 202
+
+@bp.route('/jobs/<job_id>/resultados', methods=['GET'])
+def resultados_job(job_id):
+    """Transmite los resultados disponibles de un trabajo como NDJSON"""
+    _, error = buscar_job(job_id)
+    if error is not None:
+        return error
+    ruta = jobs.ruta_resultados(job_id)
+    if ruta is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    
+    def generar():
+        with open(ruta, 'rb') as f:
+            while True:
+                bloque = f.read(64 * 1024)
+                if not bloque:
+                    break
+                yield bloque
+    
+    return Response(generar(), mimetype='application/x-ndjson')
+
+def parsear_momento(valor):
+    """Convierte un parámetro de fecha (ISO 8601 o epoch en segundos) a epoch.
+    
+    Lanza ValueError si no es una fecha o queda fuera del rango de datetime.
+    """
+    if valor is None or valor == '':
+        return None
+    try:
+        momento = float(valor)
+    except ValueError:
+        return datetime.fromisoformat(valor).timestamp()
+    try:
+        # Las respuestas vuelven a formatear el momento: se valida aquí y no al responder
+        datetime.fromtimestamp(momento)
+    except (ValueError, OverflowError, OSError) as e:
+        raise ValueError(f"Fecha fuera de rango: {valor}") from e
+    return momento
+
+def parsear_limite(valor, defecto=1000, maximo=10000):
+    """Parámetro ?limite= entre 1 y `maximo` (SQLite toma un LIMIT negativo como sin límite)"""
+    if valor is None or valor == '':
+        return defecto
+    limite = int(valor)
+    if limite < 1:
+        raise ValueError(f"limite debe ser al menos 1: {valor}")
+    return min(limite, maximo)
+
+def formatear_tramo(tramo):
+    """Tramo del historial con fechas ISO 8601"""
+    if tramo is None:
+        return None
+    return {
+        'desde': datetime.fromtimestamp(tramo['desde']).isoformat(),
+        'hasta': datetime.fromtimestamp(tramo['hasta']).isoformat(),
+        'observaciones': tramo['observaciones'],
+        'datos': tramo['datos']
     }
+
+@bp.route('/historial/<rfc>', methods=['GET'])
+def historial_rfc(rfc):
+    """Historial de instantáneas de un RFC, opcionalmente acotado con ?desde=&hasta="""
+    if monitor.historial is None:
+        return jsonify({'error': 'Historial deshabilitado'}), 404
+    rfc = rfc.strip().upper()
+    try:
+        desde = parsear_momento(request.args.get('desde'))
+        hasta = parsear_momento(request.args.get('hasta'))
+        limite = parsear_limite(request.args.get('limite'))
+    except ValueError:
+        return jsonify({'error': 'Parámetros desde/hasta/limite inválidos'}), 400
     
-    return jsonify(stats), 200
+    tramos = monitor.historial.historial(rfc, desde, hasta, limite)
+    return jsonify({
+        'rfc': rfc,
+        'tramos': [formatear_tramo(tramo) for tramo in tramos],
+        'total': len(tramos)
+    }), 200
 
-@app.errorhandler(400)
+@bp.route('/historial/<rfc>/cambios', methods=['GET'])
+def cambios_rfc(rfc):
+    """Qué cambió en un RFC desde ?desde= (fecha de la última revisión)"""
+    if monitor.historial is None:
+        return jsonify({'error': 'Historial deshabilitado'}), 404
+    rfc = rfc.strip().upper()
+    try:
+        desde = parsear_momento(request.args.get('desde'))
+    except ValueError:
+        return jsonify({'error': 'Parámetro desde inválido'}), 400
+    if desde is None:
+        return jsonify({'error': 'Se requiere el parámetro desde'}), 400
+    
+    consultado = datetime.now().isoformat()
+    delta = monitor.historial.cambios(rfc, desde)
+    if delta is None:
+        return jsonify({'error': 'Sin historial para el RFC'}), 404
+    delta['desde'] = datetime.fromtimestamp(desde).isoformat()
+    delta['anterior'] = formatear_tramo(delta['anterior'])
+    delta['actual'] = formatear_tramo(delta['actual'])
+    # Usar como ?desde= en la siguiente revisión
+    delta['consultado'] = consultado
+    return jsonify(delta), 200
+
+@bp.route('/cambios', methods=['GET'])
+def rfcs_con_cambios():
+    """RFCs cuyo estatus cambió desde ?desde="""
+    if monitor.historial is None:
+        return jsonify({'error': 'Historial deshabilitado'}), 404
+    try:
+        desde = parsear_momento(request.args.get('desde'))
+        limite = parsear_limite(request.args.get('limite'))
+    except ValueError:
+        return jsonify({'error': 'Parámetros desde/limite inválidos'}), 400
+    if desde is None:
+        return jsonify({'error': 'Se requiere el parámetro desde'}), 400
+    
+    consultado = datetime.now().isoformat()
+    rfcs = monitor.historial.rfcs_con_cambios(desde, limite)
+    return jsonify({
+        'desde': datetime.fromtimestamp(desde).isoformat(),
+        'rfcs': rfcs,
+        'total': len(rfcs),
+        'consultado': consultado
+    }), 200
+
+@bp.route('/programadas', methods=['POST'])
+def registrar_programadas():
+    """Registra RFCs para refresco en segundo plano (intervalo base opcional en segundos)"""
+    if monitor.programador is None:
+        return jsonify({'error': 'Refresco programado deshabilitado'}), 404
+    
+    datos = request.json or {}
+    rfcs = datos.get('rfcs')
+    if not isinstance(rfcs, list) or len(rfcs) == 0:
+        return jsonify({'error': 'Se requiere una lista de RFCs'}), 400
+    intervalo = datos.get('intervalo')
+    if intervalo is not None and (not isinstance(intervalo, (int, float)) or intervalo <= 0):
+        return jsonify({'error': 'El intervalo debe ser un número de segundos positivo'}), 400
+    
+    aceptados = []
+    rechazados = []
+    for rfc in rfcs:
+        rfc = rfc.strip().upper() if isinstance(rfc, str) else rfc
+        motivo = monitor.motivo_rechazo(rfc)
+        if motivo is None:
+            aceptados.append(rfc)
+        else:
+            rechazados.append({'rfc': rfc, 'error': 'RFC inválido', 'motivo': motivo})
+    
+    if aceptados:
+        monitor.programador.registrar(aceptados, intervalo)
+    return jsonify({
+        'registrados': len(aceptados),
+        'rechazados': rechazados
+    }), 200
+
+@bp.route('/programadas/<rfc>', methods=['GET'])
+def estado_programada(rfc):
+    """Estado del refresco programado de un RFC"""
+    if monitor.programador is None:
+        return jsonify({'error': 'Refresco programado deshabilitado'}), 404
+    estado = monitor.programador.estado(rfc.strip().upper())
+    if estado is None:
+        return jsonify({'error': 'RFC no programado'}), 404
+    for campo in ('proxima', 'ultima'):
+        if estado[campo] is not None:
+            estado[campo] = datetime.fromtimestamp(estado[campo]).isoformat()
+    return jsonify(estado), 200
+
+@bp.route('/programadas/<rfc>', methods=['DELETE'])
+def eliminar_programada(rfc):
+    """Quita un RFC del refresco programado"""
+    if monitor.programador is None:
+        return jsonify({'error': 'Refresco programado deshabilitado'}), 404
+    if not monitor.programador.eliminar(rfc.strip().upper()):
+        return jsonify({'error': 'RFC no programado'}), 404
+    return jsonify({'rfc': rfc.strip().upper(), 'estado': 'eliminado'}), 200
+
+def identificar_cliente(recurso):
+    """Quién llama a una ruta con dueño (/webhooks, /carteras, /jobs): (dueño, error). El dueño es None
+    para el administrador y la identidad de la API key para un cliente autorizado; si no hay
+    acceso, `error` es la respuesta"""
+    if not config.API_ADMIN_TOKEN and not config.API_KEYS:
+        return None, (jsonify({'error': f'{recurso} sin credenciales configuradas'}), 403)
+    token = request.headers.get('X-Admin-Token', '')
+    if config.API_ADMIN_TOKEN and token and hmac.compare_digest(token.encode(), config.API_ADMIN_TOKEN.encode()):
+        return None, None
+    api_key = request.headers.get('X-API-Key', '')
+    # Se recorren todas las claves para no revelar por tiempo cuál coincide
+    valida = False
+    for clave in config.API_KEYS:
+        valida |= hmac.compare_digest(api_key.encode(), clave.encode())
+    if api_key and valida:
+        return clave_cliente(api_key, None), None
+    return None, (jsonify({'error': 'Se requiere X-API-Key o X-Admin-Token válidos'}), 401)
+
+@bp.route('/webhooks', methods=['POST'])
+def registrar_webhook():
+    """Registra un webhook para recibir los cambios de alertas de RFCs (filtro opcional por tipo)"""
+    if monitor.alertas is None:
+        return jsonify({'error': 'Alertas por webhook deshabilitadas'}), 404
+    from alert_dispatch import destino_no_permitido, TIPOS as TIPOS_ALERTA
+    propietario, error = identificar_cliente('Webhooks')
+    if error is not None:
+        return error
+    
+    datos = request.json or {}
+    url = datos.get('url')
+    if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        return jsonify({'error': 'Se requiere una "url" http(s)'}), 400
+    motivo = destino_no_permitido(url, config.ALERTS_PERMITIR_PRIVADOS)
+    if motivo is not None:
+        return jsonify({'error': f'"url" no permitida: {motivo}'}), 400
+    
+    rfcs = datos.get('rfcs')
+    if rfcs is not None:
+        if not isinstance(rfcs, list) or not all(isinstance(rfc, str) for rfc in rfcs):
+            return jsonify({'error': '"rfcs" debe ser una lista de RFCs'}), 400
+        rfcs = [rfc.strip().upper() for rfc in rfcs if rfc.strip()]
+    # Solo el administrador puede suscribirse a todos los RFCs
+    if propietario is not None and not rfcs:
+        return jsonify({'error': 'Se requiere "rfcs" con al menos un RFC'}), 400
+    tipos = datos.get('tipos')
+    if tipos is not None and (not isinstance(tipos, list) or not set(tipos) <= set(TIPOS_ALERTA)):
+        return jsonify({'error': f'"tipos" debe ser una lista con valores de {", ".join(TIPOS_ALERTA)}'}), 400
+    secreto = datos.get('secreto')
+    if secreto is not None and not isinstance(secreto, str):
+        return jsonify({'error': '"secreto" debe ser texto'}), 400
+    
+    webhook_id = monitor.alertas.registrar_webhook(url, rfcs, tipos, secreto, propietario)
+    return jsonify({'id': webhook_id, 'url': url, 'rfcs': rfcs, 'tipos': tipos, 'firmado': bool(secreto)}), 201
+
+@bp.route('/webhooks', methods=['GET'])
+def listar_webhooks():
+    """Webhooks registrados (los propios; todos para el administrador)"""
+    if monitor.alertas is None:
+        return jsonify({'error': 'Alertas por webhook deshabilitadas'}), 404
+    propietario, error = identificar_cliente('Webhooks')
+    if error is not None:
+        return error
+    webhooks = monitor.alertas.listar_webhooks(propietario)
+    return jsonify({'webhooks': webhooks, 'total': len(webhooks)}), 200
+
+@bp.route('/webhooks/<webhook_id>', methods=['DELETE'])
+def eliminar_webhook(webhook_id):
+    """Da de baja un webhook (propio; cualquiera para el administrador)"""
+    if monitor.alertas is None:
+        return jsonify({'error': 'Alertas por webhook deshabilitadas'}), 404
+    propietario, error = identificar_cliente('Webhooks')
+    if error is not None:
+        return error
+    if not monitor.alertas.eliminar_webhook(webhook_id, propietario):
+        return jsonify({'error': 'Webhook no encontrado'}), 404
+    return jsonify({'id': webhook_id, 'estado': 'eliminado'}), 200
+
+def dueno_carteras():
+    """Dueño de las carteras de la petición: (propietario, error). Un cliente solo ve las suyas;
+    el administrador las propias o, con ?propietario=, las de un cliente"""
+    propietario, error = identificar_cliente('Carteras')
+    if error is not None:
+        return None, error
+    if propietario is None:
+        return request.args.get('propietario') or None, None
+    return propietario, None
+
+def validar_cartera(cartera):
+    """Identificador de cartera: letras, dígitos, '.', '_' o '-' (máximo 64)"""
+    return 0 < len(cartera) <= 64 and all(c.isascii() and (c.isalnum() or c in '._-') for c in cartera)
+
+@bp.route('/carteras/<cartera>', methods=['POST'])
+def agregar_a_cartera(cartera):
+    """Agrega RFCs a una cartera (la crea si no existe); opcionalmente los programa para refresco"""
+    if monitor.carteras is None:
+        return jsonify({'error': 'Carteras deshabilitadas'}), 404
+    propietario, error = dueno_carteras()
+    if error is not None:
+        return error
+    if not validar_cartera(cartera):
+        return jsonify({'error': 'Identificador de cartera inválido'}), 400
+    
+    datos = request.json or {}
+    rfcs = datos.get('rfcs')
+    if not isinstance(rfcs, list) or len(rfcs) == 0:
+        return jsonify({'error': 'Se requiere una lista de RFCs'}), 400
+    if len(rfcs) > config.PORTFOLIO_MAX_RFCS:
+        return jsonify({'error': f'Máximo {config.PORTFOLIO_MAX_RFCS} RFCs por petición'}), 400
+    programar = datos.get('programar', False)
+    if not isinstance(programar, bool):
+        return jsonify({'error': '"programar" debe ser true o false'}), 400
+    if programar and monitor.programador is None:
+        return jsonify({'error': 'Refresco programado deshabilitado'}), 400
+    
+    aceptados = []
+    rechazados = []
+    for rfc in rfcs:
+        rfc = rfc.strip().upper() if isinstance(rfc, str) else rfc
+        motivo = monitor.motivo_rechazo(rfc)
+        if motivo is None:
+            aceptados.append(rfc)
+        else:
+            rechazados.append({'rfc': rfc, 'error': 'RFC inválido', 'motivo': motivo})
+    
+    agregados = monitor.carteras.agregar(cartera, aceptados, propietario) if aceptados else 0
+    if programar and aceptados:
+        monitor.programador.registrar(aceptados)
+    return jsonify({
+        'cartera': cartera,
+        'agregados': agregados,
+        'programados': len(aceptados) if programar else 0,
+        'rechazados': rechazados
+    }), 200
+
+@bp.route('/carteras/<cartera>', methods=['GET'])
+def resumen_cartera(cartera):
+    """Totales, alertas por tipo y RFCs más riesgosos de la cartera (?top=10)"""
+    if monitor.carteras is None:
+        return jsonify({'error': 'Carteras deshabilitadas'}), 404
+    propietario, error = dueno_carteras()
+    if error is not None:
+        return error
+    try:
+        top = min(max(int(request.args.get('top', 10)), 0), config.PORTFOLIO_TOP_MAX)
+    except ValueError:
+        return jsonify({'error': 'Parámetro top inválido'}), 400
+    
+    resumen = monitor.carteras.resumen(cartera, top, propietario)
+    if resumen is None:
+        return jsonify({'error': 'Cartera no encontrada'}), 404
+    for campo in ('creada', 'ultimo_cambio'):
+        if resumen[campo] is not None:
+            resumen[campo] = datetime.fromtimestamp(resumen[campo]).isoformat()
+    for riesgoso in resumen['top_riesgo']:
+        riesgoso['actualizado'] = datetime.fromtimestamp(riesgoso['actualizado']).isoformat()
+    return jsonify(resumen), 200
+
+@bp.route('/carteras/<cartera>', methods=['DELETE'])
+def eliminar_cartera(cartera):
+    """Borra una cartera (no afecta el historial ni el refresco programado de sus RFCs)"""
+    if monitor.carteras is None:
+        return jsonify({'error': 'Carteras deshabilitadas'}), 404
+    propietario, error = dueno_carteras()
+    if error is not None:
+        return error
+    if not monitor.carteras.eliminar(cartera, propietario):
+        return jsonify({'error': 'Cartera no encontrada'}), 404
+    return jsonify({'cartera': cartera, 'estado': 'eliminada'}), 200
+
+@bp.route('/carteras/<cartera>/<rfc>', methods=['DELETE'])
+def quitar_de_cartera(cartera, rfc):
+    """Quita un RFC de la cartera"""
+    if monitor.carteras is None:
+        return jsonify({'error': 'Carteras deshabilitadas'}), 404
+    propietario, error = dueno_carteras()
+    if error is not None:
+        return error
+    rfc = rfc.strip().upper()
+    if not monitor.carteras.quitar(cartera, [rfc], propietario):
+        return jsonify({'error': 'RFC no encontrado en la cartera'}), 404
+    return jsonify({'cartera': cartera, 'rfc': rfc, 'estado': 'eliminado'}), 200
+
+@bp.app_errorhandler(400)
 def bad_request(error):
     return jsonify({'error': 'Petición incorrecta'}), 400
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def not_found(error):
     return jsonify({'error': 'Endpoint no encontrado'}), 404
 
-@app.errorhandler(405)
+@bp.app_errorhandler(405)
 def method_not_allowed(error):
     return jsonify({'error': 'Método no permitido'}), 405
 
-@app.errorhandler(500)
+@bp.app_errorhandler(500)
 def internal_error(error):
     logger.error(f"Error interno: {str(error)}")
     return jsonify({'error': 'Error interno del servidor'}), 500
 
+@bp.after_app_request
+def contar_respuesta(response):
+    metricas.incrementar('respuestas')
+    if response.status_code >= 500:
+        metricas.incrementar('respuestas_5xx')
+    return response
+
+# Trazas por petición (se registran antes que validate_json para medir el parseo)
+from flask import g
+
+@bp.before_app_request
+def iniciar_traza():
+    g.traza = tracer.iniciar(request.method, request.path)
+
+@bp.before_app_request
+def iniciar_programador():
+    # Se arranca con la primera petición del worker (y no al importar app,
+    # que también hace la CLI de bulk_jobs); las siguientes llamadas no hacen nada
+    if monitor.programador is not None:
+        monitor.programador.iniciar()
+
+@bp.after_app_request
+def cerrar_traza(response):
+    server_timing = tracer.finalizar(g.pop('traza', None), response.status_code)
+    if server_timing:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
 # Manejador para JSON malformado
 from werkzeug.exceptions import BadRequest
 
-@app.before_request
+@bp.before_app_request
 def validate_json():
     if request.endpoint and request.method == 'POST':
         if request.content_type and 'application/json' in request.content_type:
             try:
-                request.get_json(force=True)
+                # El resultado queda en caché: las vistas no vuelven a parsear
+                with fase('parseo'):
+                    request.get_json(force=True)
             except BadRequest:
                 return jsonify({'error': 'JSON malformado'}), 400
 
+@bp.before_app_request
+def controlar_admision():
+    # Después de validate_json: el cuerpo ya está parseado para calcular el costo
+    if request.method != 'POST' or costo_admision(request.path, request.get_json(silent=True)) is None:
+        return None
+    ip = (request.headers.get('X-Real-IP') if config.RATE_LIMIT_TRUST_PROXY else None) or request.remote_addr
+    status, cuerpo, cabeceras = admitir(
+        request.path,
+        request.get_json(silent=True),
+        request.headers.get('X-API-Key'),
+        ip,
+        request.headers.get('X-Request-Start'),
+        flujo=formato_flujo() is not None
+    )
+    if status is not None:
+        return jsonify(cuerpo), status, cabeceras
+    g.cabeceras_cuota = cabeceras
+    g.cliente_cuota = clave_cliente(request.headers.get('X-API-Key'), ip)
+    g.admitida = True
+    admision.entrar()
+
+@bp.after_app_request
+def agregar_cabeceras_cuota(response):
+    response.headers.extend(g.pop('cabeceras_cuota', {}))
+    return response
+
+@bp.teardown_app_request
+def liberar_admision(error):
+    if g.pop('admitida', False):
+        admision.salir()
+
+# Registrado al final: corre antes que cerrar_traza y su fase entra en Server-Timing
+@bp.after_app_request
+def comprimir_respuesta(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code < 200
+            or response.status_code == 204 or 'Content-Encoding' in response.headers):
+        return response
+    tamano = response.content_length
+    if tamano is None or tamano < config.COMPRESSION_MIN_BYTES:
+        return response
+    response.vary.add('Accept-Encoding')
+    codificacion = elegir_codificacion(request.headers.get('Accept-Encoding'))
+    if codificacion is None:
+        return response
+    with fase('compresion'):
+        response.set_data(comprimir(
+            response.get_data(), codificacion,
+            nivel_gzip=config.COMPRESSION_GZIP_LEVEL,
+            calidad_brotli=config.COMPRESSION_BROTLI_QUALITY
+        ))
+    response.headers['Content-Encoding'] = codificacion
+    return response
+
+def crear_app():
+    """Construye la aplicación Flask con las rutas del monitor.
+    
+    El estado compartido (monitor, caché, métricas, trabajos) se crea al
+    importar el módulo, así que con `preload_app` (gunicorn.conf.py) se
+    construye una sola vez en el proceso maestro y los workers lo heredan;
+    varias llamadas comparten ese estado. Los módulos de las funciones
+    opcionales (historial, alertas, carteras, refresco programado y trabajos
+    masivos) solo se importan si su *_ENABLED está activo.
+    """
+    aplicacion = Flask(__name__)
+    # jsonify y request.get_json() usan orjson/msgspec si están instalados
+    aplicacion.json = FastJSONProvider(aplicacion)
+    CORS(aplicacion)  # Permite CORS para desarrollo
+    aplicacion.register_blueprint(bp)
+    return aplicacion
+
+app = crear_app()
+
 if __name__ == '__main__':
     # Crear directorio para certificados si no existe
     os.makedirs('certificados', exist_ok=True)
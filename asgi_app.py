@@ -0,0 +1,607 @@
+"""
+Modo de servicio asíncrono (ASGI) del Monitor SAT.
+
+Expone las mismas rutas, payloads y manejadores de error que la aplicación
+Flask (`/`, `/listo`, `/consultar_sat`, `/consultar_multiple`,
+`/estadisticas`, `/metrics`), pero las consultas a Finkok no bloquean: un solo proceso puede
+mantener cientos de consultas en vuelo. La cuota por cliente se calcula con
+`costo_admision` de app.py, igual que en Flask; las rutas con dueño o en
+segundo plano (/jobs, /programadas, /carteras, /webhooks, /historial) solo
+existen en la aplicación Flask y aquí responden 404. Lo que sí bloquea (SQLite de la caché
+y del limitador, lectura de certificados) corre en el executor por defecto
+del loop con `asyncio.to_thread`.
+
+Ejecutar con:
+    uvicorn asgi_app:app --host 127.0.0.1 --port 5000
+    gunicorn -k uvicorn.workers.UvicornWorker asgi_app:app
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from urllib.parse import parse_qs
+
+import rfc_validator
+from app import (config, monitor, metricas, tracer, admision, registrar_metricas, registrar_resultado,
+                 construir_estadisticas, construir_metricas_prometheus, construir_disponibilidad,
+                 FORMATOS_FLUJO, serializar_evento, costo_admision, admitir, limitador)
+from response_codec import dumps, loads, elegir_codificacion, comprimir
+from tracing import fase, anotar
+from micro_batch import crear_lotes_async
+from result_cache import MemoryBackend
+from upstream import crear_cliente_async, CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+RUTAS = {
+    '/': ('GET',),
+    '/consultar_sat': ('POST',),
+    '/consultar_multiple': ('POST',),
+    '/estadisticas': ('GET',),
+    '/metrics': ('GET',),
+    '/listo': ('GET',),
+}
+
+
+class ErrorHTTP(Exception):
+    def __init__(self, status, cuerpo):
+        super().__init__(cuerpo)
+        self.status = status
+        self.cuerpo = cuerpo
+
+
+class Flujo:
+    """Respuesta en flujo: cada fragmento del generador se envía en cuanto está listo"""
+
+    def __init__(self, fragmentos, tipo):
+        self.fragmentos = fragmentos
+        self.tipo = tipo
+
+
+class AsyncSATService:
+    """Consultas SAT asíncronas que reutilizan validación, caché y procesamiento de SATMonitor"""
+
+    def __init__(self):
+        self.cliente = None
+        self.lotes = None
+        self._vuelos = {}
+        # La caché en memoria responde sin bloquear; la de SQLite va a un hilo
+        self._cache_en_hilo = not isinstance(monitor.cache.backend, MemoryBackend)
+
+    async def _cache(self, funcion, *args):
+        if self._cache_en_hilo:
+            return await asyncio.to_thread(funcion, *args)
+        return funcion(*args)
+
+    async def iniciar(self):
+        # El breaker se comparte con el cliente síncrono del mismo proceso
+        self.cliente = crear_cliente_async(config, breaker=monitor.cliente.breaker)
+        self.lotes = crear_lotes_async(config, self.cliente.post_json)
+        if monitor.programador is not None:
+            # Los refrescos programados usan el cliente síncrono en hilos propios
+            monitor.programador.iniciar()
+
+    async def detener(self):
+        if self.cliente is not None:
+            await self.cliente.cerrar()
+
+    async def consultar_finkok(self, rfc):
+        """Equivalente asíncrono de SATMonitor.consultar_finkok"""
+        try:
+            with fase('certificados'):
+                payload = await asyncio.to_thread(monitor.construir_payload, rfc)
+            if payload is None:
+                return {"error": "Error cargando certificados"}
+
+            inicio = time.perf_counter()
+            try:
+                with fase('finkok'):
+                    if self.lotes is not None:
+                        return await self.lotes.consultar(payload)
+                    return await self.cliente.post_json(payload)
+            finally:
+                duracion = time.perf_counter() - inicio
+                metricas.observar('latencia_upstream', duracion)
+                admision.observar_upstream(duracion)
+
+        except self.cliente.errores_conexion as e:
+            metricas.incrementar('errores_upstream')
+            logger.error(f"Error en petición a Finkok: {str(e)}")
+            return {"error": f"Error de conexión: {str(e)}"}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error inesperado: {str(e)}")
+            return {"error": f"Error interno: {str(e)}"}
+
+    async def consultar_rfc(self, rfc, max_edad=0):
+        """Equivalente asíncrono de SATMonitor.consultar_rfc, con coalescencia por RFC"""
+        cache = monitor.cache
+        clave = cache.normalizar(rfc)
+        respuesta = monitor.respuesta_programada(rfc)
+        if respuesta is not None:
+            return respuesta
+
+        encontrado = await self._cache(cache.obtener, clave)
+        respaldo = None
+        if encontrado is not None:
+            data_sat, edad = encontrado
+            if max_edad > 0 and cache.es_negativo(data_sat):
+                respaldo = await self._cache(cache.obtener_respaldo, clave, max_edad)
+                if respaldo is not None:
+                    return self._obsoleta(rfc, respaldo, 'error_upstream')
+            cache.hits += 1
+            return monitor.completar_respuesta(data_sat, rfc, {"hit": True, "edad_segundos": round(edad, 3)})
+        if max_edad > 0:
+            respaldo = await self._cache(cache.obtener_respaldo, clave, max_edad)
+
+        vuelo = self._vuelos.get(clave)
+        if vuelo is not None:
+            cache.coalescidas += 1
+            info_cache = {"hit": False, "coalescida": True, "edad_segundos": 0.0}
+        else:
+            cache.misses += 1
+            vuelo = self._vuelos[clave] = asyncio.ensure_future(self._consultar_y_guardar(clave, rfc))
+            info_cache = {"hit": False, "edad_segundos": 0.0}
+
+        if respaldo is None:
+            # shield: si esta petición se cancela, la consulta sigue para las demás
+            data_sat = await asyncio.shield(vuelo)
+            return monitor.completar_respuesta(data_sat, rfc, info_cache)
+
+        # Hay respaldo: se espera a Finkok a lo sumo STALE_ESPERA (nada con el
+        # breaker abierto); la consulta sigue en segundo plano y refresca la caché
+        espera = 0.0 if monitor.cliente.breaker.estado == CircuitBreaker.ABIERTO else config.STALE_ESPERA
+        terminadas, _ = await asyncio.wait({vuelo}, timeout=espera)
+        if not terminadas:
+            return self._obsoleta(rfc, respaldo, 'upstream_lento')
+        if vuelo.exception() is not None or cache.es_negativo(vuelo.result()):
+            return self._obsoleta(rfc, respaldo, 'error_upstream')
+        return monitor.completar_respuesta(vuelo.result(), rfc, info_cache)
+
+    @staticmethod
+    def _obsoleta(rfc, respaldo, motivo):
+        data_sat, info_cache = monitor.cache.respuesta_obsoleta(respaldo, motivo)
+        return monitor.completar_respuesta(data_sat, rfc, info_cache)
+
+    async def _consultar_y_guardar(self, clave, rfc):
+        try:
+            data_sat = await self.consultar_finkok(rfc)
+            await self._cache(monitor.cache.guardar, clave, data_sat)
+            return data_sat
+        finally:
+            self._vuelos.pop(clave, None)
+
+    async def consultar_varios(self, rfcs, deadline=None, max_edad=0):
+        """Consulta varios RFCs concurrentemente, en el orden de entrada"""
+        if deadline is None:
+            deadline = config.MULTIPLE_DEADLINE
+
+        semaforo = asyncio.Semaphore(config.MULTIPLE_MAX_WORKERS)
+        resultados = [None] * len(rfcs)
+
+        async def consultar(i, rfc):
+            async with semaforo:
+                try:
+                    resultados[i] = await self.consultar_rfc(rfc, max_edad)
+                except Exception as e:
+                    logger.error(f"Error consultando {rfc}: {str(e)}")
+                    resultados[i] = {'rfc': rfc, 'error': f"Error interno: {str(e)}"}
+
+        tareas = []
+        for i, rfc in enumerate(rfcs):
+            motivo = monitor.motivo_rechazo(rfc)
+            if motivo is None:
+                tareas.append(asyncio.ensure_future(consultar(i, rfc)))
+            else:
+                resultados[i] = {'rfc': rfc, 'error': 'RFC inválido', 'motivo': motivo}
+
+        if tareas:
+            _, pendientes = await asyncio.wait(tareas, timeout=deadline)
+            for tarea in pendientes:
+                tarea.cancel()
+
+        for i, resultado in enumerate(resultados):
+            if resultado is None:
+                resultados[i] = {'rfc': rfcs[i], 'error': 'Tiempo de espera agotado'}
+
+        return resultados
+
+    async def consultar_en_flujo(self, rfcs, deadline=None, ventana=None, max_edad=0):
+        """Equivalente asíncrono de SATMonitor.consultar_en_flujo.
+
+        Genera (índice, resultado) conforme terminan las consultas, con a lo
+        sumo `ventana` en vuelo; si el cliente lee despacio, `send` tarda y no
+        se lanzan consultas nuevas.
+        """
+        if deadline is None:
+            deadline = config.MULTIPLE_DEADLINE
+        if ventana is None:
+            ventana = config.MULTIPLE_MAX_WORKERS
+
+        limite = time.monotonic() + deadline
+        entrada = enumerate(rfcs)
+        en_vuelo = {}
+        agotada = False
+
+        try:
+            while True:
+                while not agotada and len(en_vuelo) < ventana:
+                    siguiente = next(entrada, None)
+                    if siguiente is None:
+                        agotada = True
+                        break
+                    i, rfc = siguiente
+                    motivo = monitor.motivo_rechazo(rfc)
+                    if motivo is None:
+                        en_vuelo[asyncio.ensure_future(self.consultar_rfc(rfc, max_edad))] = i
+                    else:
+                        yield i, {'rfc': rfc, 'error': 'RFC inválido', 'motivo': motivo}
+
+                if not en_vuelo:
+                    return
+
+                terminadas, _ = await asyncio.wait(en_vuelo, timeout=max(0.0, limite - time.monotonic()),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not terminadas:
+                    break
+
+                for tarea in terminadas:
+                    i = en_vuelo.pop(tarea)
+                    try:
+                        yield i, tarea.result()
+                    except Exception as e:
+                        logger.error(f"Error consultando {rfcs[i]}: {str(e)}")
+                        yield i, {'rfc': rfcs[i], 'error': f"Error interno: {str(e)}"}
+
+            # Deadline vencido: lo que sigue en vuelo o sin enviar se reporta como agotado
+            for tarea, i in list(en_vuelo.items()):
+                tarea.cancel()
+                del en_vuelo[tarea]
+                yield i, {'rfc': rfcs[i], 'error': 'Tiempo de espera agotado'}
+            for i, rfc in entrada:
+                motivo = monitor.motivo_rechazo(rfc)
+                if motivo is not None:
+                    yield i, {'rfc': rfc, 'error': 'RFC inválido', 'motivo': motivo}
+                else:
+                    yield i, {'rfc': rfc, 'error': 'Tiempo de espera agotado'}
+        finally:
+            # Cliente desconectado: no seguir consultando
+            for tarea in en_vuelo:
+                tarea.cancel()
+
+
+servicio = AsyncSATService()
+
+
+# Vistas (mismos payloads que app.py)
+
+async def health_check(cuerpo, scope):
+    return 200, {
+        "service": "Monitor SAT Backend",
+        "status": "running",
+        "version": "1.0.0",
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+async def consultar_sat(cuerpo, scope):
+    if not cuerpo:
+        return 400, {'error': 'Se requiere JSON en el cuerpo de la petición'}
+
+    rfc = cuerpo.get('rfc') if isinstance(cuerpo, dict) else None
+    if not rfc:
+        return 400, {'error': 'Se requiere el campo "rfc"'}
+
+    rfc = rfc.strip().upper()
+    anotar('rfc', rfc)
+
+    with fase('validacion'):
+        motivo = monitor.motivo_rechazo(rfc)
+    if motivo is not None:
+        return 400, {
+            'error': f'RFC inválido. {rfc_validator.describir(motivo)}',
+            'motivo': motivo
+        }
+
+    logger.info(f"Consultando SAT para RFC: {rfc}")
+    inicio = time.perf_counter()
+
+    respuesta = await servicio.consultar_rfc(rfc, config.STALE_MAX_EDAD_SAT)
+    registrar_metricas('consultar_sat', [respuesta], inicio)
+
+    if "error" in respuesta:
+        return 500, respuesta
+
+    return 200, respuesta
+
+
+async def consultar_multiple(cuerpo, scope):
+    if not isinstance(cuerpo, dict) or 'rfcs' not in cuerpo:
+        return 400, {'error': 'Se requiere una lista de RFCs'}
+
+    rfcs = cuerpo['rfcs']
+    if not isinstance(rfcs, list) or len(rfcs) == 0:
+        return 400, {'error': 'La lista de RFCs no puede estar vacía'}
+
+    formato = _formato_flujo(scope)
+    if formato is not None:
+        if len(rfcs) > config.MULTIPLE_STREAM_MAX_RFCS:
+            return 400, {'error': f'Máximo {config.MULTIPLE_STREAM_MAX_RFCS} RFCs por consulta en flujo'}
+        anotar('rfcs', len(rfcs))
+        return 200, Flujo(_flujo_multiple(rfcs, formato), FORMATOS_FLUJO[formato].encode())
+
+    if len(rfcs) > config.MULTIPLE_MAX_RFCS:
+        return 400, {'error': f'Máximo {config.MULTIPLE_MAX_RFCS} RFCs por consulta'}
+
+    inicio = time.perf_counter()
+    anotar('rfcs', len(rfcs))
+    resultados = await servicio.consultar_varios(rfcs, max_edad=config.STALE_MAX_EDAD_MULTIPLE)
+    registrar_metricas('consultar_multiple', resultados, inicio)
+
+    return 200, {
+        'resultados': resultados,
+        'total_consultados': len(resultados),
+        'timestamp': datetime.now().isoformat()
+    }
+
+
+def _formato_flujo(scope):
+    """Formato pedido con ?stream= o con el encabezado Accept (como formato_flujo en app.py)"""
+    formato = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('stream', [None])[0]
+    if formato in FORMATOS_FLUJO:
+        return formato
+    aceptado = dict(scope.get('headers') or []).get(b'accept', b'').decode('latin-1')
+    for formato, tipo in FORMATOS_FLUJO.items():
+        if tipo in aceptado:
+            return formato
+    return None
+
+
+async def _flujo_multiple(rfcs, formato):
+    inicio = time.perf_counter()
+    errores = 0
+    consultas = servicio.consultar_en_flujo(rfcs, config.MULTIPLE_STREAM_DEADLINE,
+                                          max_edad=config.STALE_MAX_EDAD_MULTIPLE)
+    try:
+        async for i, resultado in consultas:
+            registrar_resultado(resultado)
+            if 'error' in resultado:
+                errores += 1
+            yield serializar_evento(formato, 'resultado', {'indice': i, **resultado}).encode()
+    finally:
+        # Los generadores asíncronos no se cierran solos al descartarse
+        await consultas.aclose()
+    metricas.observar('latencia_consultar_multiple_flujo', time.perf_counter() - inicio)
+    yield serializar_evento(formato, 'resumen', {'resumen': {
+        'total_consultados': len(rfcs),
+        'errores': errores,
+        'duracion_ms': round((time.perf_counter() - inicio) * 1000, 1),
+        'timestamp': datetime.now().isoformat()
+    }}).encode()
+
+
+async def estadisticas_generales(cuerpo, scope):
+    # La agregación lee archivos de otros workers: fuera del event loop
+    return 200, await asyncio.get_running_loop().run_in_executor(None, construir_estadisticas)
+
+
+async def disponibilidad(cuerpo, scope):
+    listo, respuesta = construir_disponibilidad()
+    return (200 if listo else 503), respuesta
+
+
+VISTAS = {
+    '/': health_check,
+    '/listo': disponibilidad,
+    '/consultar_sat': consultar_sat,
+    '/consultar_multiple': consultar_multiple,
+    '/estadisticas': estadisticas_generales,
+}
+
+
+# Infraestructura ASGI
+
+def _cabeceras(tipo, longitud):
+    return [
+        (b'content-type', tipo),
+        (b'content-length', str(longitud).encode()),
+        # Equivalente a CORS(app) en la versión Flask
+        (b'access-control-allow-origin', b'*'),
+    ]
+
+
+def _serializar(cuerpo):
+    if isinstance(cuerpo, (dict, list)):
+        with fase('serializacion'):
+            return dumps(cuerpo)
+    if isinstance(cuerpo, str):
+        return cuerpo.encode()
+    return cuerpo
+
+
+def _comprimir(scope, cuerpo):
+    """(cuerpo, cabeceras extra) con la compresión negociada, igual que comprimir_respuesta en app.py"""
+    if len(cuerpo) < config.COMPRESSION_MIN_BYTES:
+        return cuerpo, []
+    aceptadas = dict(scope.get('headers') or []).get(b'accept-encoding', b'').decode('latin-1')
+    codificacion = elegir_codificacion(aceptadas)
+    if codificacion is None:
+        return cuerpo, [(b'vary', b'Accept-Encoding')]
+    with fase('compresion'):
+        cuerpo = comprimir(cuerpo, codificacion, nivel_gzip=config.COMPRESSION_GZIP_LEVEL,
+                           calidad_brotli=config.COMPRESSION_BROTLI_QUALITY)
+    return cuerpo, [(b'vary', b'Accept-Encoding'), (b'content-encoding', codificacion.encode())]
+
+
+async def _enviar(send, status, cuerpo, tipo=b'application/json', server_timing=None, extra=(),
+                  sin_cuerpo=False):
+    cabeceras = _cabeceras(tipo, len(cuerpo))
+    cabeceras.extend(extra)
+    if server_timing:
+        cabeceras.append((b'server-timing', server_timing.encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': cabeceras})
+    # HEAD: mismas cabeceras (content-length incluido) que GET, sin cuerpo
+    await send({'type': 'http.response.body', 'body': b'' if sin_cuerpo else cuerpo})
+
+
+async def _enviar_flujo(send, receive, flujo, server_timing=None):
+    # Sin content-length: el servidor usa transferencia por fragmentos
+    cabeceras = [(b'content-type', flujo.tipo), (b'cache-control', b'no-cache'),
+                 (b'x-accel-buffering', b'no'), (b'access-control-allow-origin', b'*')]
+    if server_timing:
+        cabeceras.append((b'server-timing', server_timing.encode()))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': cabeceras})
+
+    async def enviar():
+        async for fragmento in flujo.fragmentos:
+            # send espera si el cliente no lee: esa es la contrapresión
+            await send({'type': 'http.response.body', 'body': fragmento, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def vigilar():
+        # El cuerpo ya se leyó: el siguiente mensaje solo llega si el cliente se desconecta
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    envio = asyncio.ensure_future(enviar())
+    vigilancia = asyncio.ensure_future(vigilar())
+    try:
+        await asyncio.wait((envio, vigilancia), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        vigilancia.cancel()
+        envio.cancel()
+        resultado, = await asyncio.gather(envio, return_exceptions=True)
+        # Cierra el generador: cancela las consultas que sigan en vuelo
+        await flujo.fragmentos.aclose()
+    if isinstance(resultado, Exception):
+        logger.error(f"Error en respuesta en flujo: {str(resultado)}")
+
+
+async def _leer_cuerpo(receive):
+    partes = []
+    while True:
+        mensaje = await receive()
+        if mensaje['type'] == 'http.disconnect':
+            raise ErrorHTTP(400, {'error': 'Petición incorrecta'})
+        partes.append(mensaje.get('body', b''))
+        if not mensaje.get('more_body'):
+            return b''.join(partes)
+
+
+async def _atender(scope, receive, extra):
+    ruta = scope['path']
+    metodo = scope['method']
+
+    if ruta not in RUTAS:
+        return 404, {'error': 'Endpoint no encontrado'}
+    if metodo == 'OPTIONS':
+        # Respuesta de preflight como la de Flask-CORS en app.py: métodos de la ruta
+        # y las cabeceras que pide el navegador
+        metodos = set(RUTAS[ruta]) | {'OPTIONS'} | ({'HEAD'} if 'GET' in RUTAS[ruta] else set())
+        permitidos = ', '.join(sorted(metodos)).encode()
+        extra.extend(((b'allow', permitidos), (b'access-control-allow-methods', permitidos)))
+        solicitadas = dict(scope.get('headers') or []).get(b'access-control-request-headers')
+        if solicitadas:
+            extra.append((b'access-control-allow-headers', solicitadas))
+        return 200, b''
+    if metodo not in RUTAS[ruta] and not (metodo == 'HEAD' and 'GET' in RUTAS[ruta]):
+        return 405, {'error': 'Método no permitido'}
+
+    if ruta == '/metrics':
+        texto = await asyncio.get_running_loop().run_in_executor(None, construir_metricas_prometheus)
+        return 200, texto
+
+    cuerpo = None
+    if metodo == 'POST':
+        cabeceras = dict(scope.get('headers') or [])
+        content_type = cabeceras.get(b'content-type', b'').decode('latin-1')
+        if 'application/json' not in content_type:
+            if ruta == '/consultar_sat':
+                return 400, {'error': 'Content-Type debe ser application/json'}
+            return 400, {'error': 'Se requiere una lista de RFCs'}
+        datos = await _leer_cuerpo(receive)
+        try:
+            with fase('parseo'):
+                cuerpo = loads(datos)
+        except ValueError:
+            return 400, {'error': 'JSON malformado'}
+
+        if costo_admision(ruta, cuerpo) is not None:
+            # Mismo control que controlar_admision en app.py
+            ip = cabeceras.get(b'x-real-ip', b'').decode('latin-1') if config.RATE_LIMIT_TRUST_PROXY else None
+            argumentos = (
+                ruta,
+                cuerpo,
+                cabeceras.get(b'x-api-key', b'').decode('latin-1'),
+                ip or (scope.get('client') or ('',))[0],
+                cabeceras.get(b'x-request-start', b'').decode('latin-1'),
+                _formato_flujo(scope) is not None
+            )
+            # La cuota por cliente es una transacción de SQLite: fuera del event loop
+            if limitador is None:
+                status, error, cabeceras_cuota = admitir(*argumentos)
+            else:
+                status, error, cabeceras_cuota = await asyncio.to_thread(admitir, *argumentos)
+            extra.extend((nombre.lower().encode(), valor.encode()) for nombre, valor in cabeceras_cuota.items())
+            if status is not None:
+                return status, error
+            admision.entrar()
+            try:
+                return await VISTAS[ruta](cuerpo, scope)
+            finally:
+                admision.salir()
+
+    return await VISTAS[ruta](cuerpo, scope)
+
+
+async def app(scope, receive, send):
+    """Aplicación ASGI"""
+    if scope['type'] == 'lifespan':
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'lifespan.startup':
+                await servicio.iniciar()
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensaje['type'] == 'lifespan.shutdown':
+                await servicio.detener()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] != 'http':
+        return
+
+    if servicio.cliente is None:
+        # Servidores sin soporte de lifespan
+        await servicio.iniciar()
+
+    # Todas las peticiones comparten el hilo del event loop: sin perfilador por muestreo
+    traza = tracer.iniciar(scope['method'], scope['path'], muestrear=False)
+    extra = []
+    try:
+        status, cuerpo = await _atender(scope, receive, extra)
+    except ErrorHTTP as e:
+        status, cuerpo = e.status, e.cuerpo
+    except Exception as e:
+        logger.error(f"Error interno: {str(e)}")
+        status, cuerpo = 500, {'error': 'Error interno del servidor'}
+
+    metricas.incrementar('respuestas')
+    if status >= 500:
+        metricas.incrementar('respuestas_5xx')
+
+    if isinstance(cuerpo, Flujo):
+        # La traza cubre hasta el primer byte; el flujo se mide en latencia_consultar_multiple_flujo
+        await _enviar_flujo(send, receive, cuerpo, tracer.finalizar(traza, status))
+        return
+
+    cuerpo = _serializar(cuerpo)
+    cuerpo, compresion = _comprimir(scope, cuerpo)
+    extra.extend(compresion)
+    server_timing = tracer.finalizar(traza, status)
+    sin_cuerpo = scope['method'] == 'HEAD'
+    if scope['path'] == '/metrics' and status == 200:
+        await _enviar(send, status, cuerpo, b'text/plain; version=0.0.4', server_timing, extra, sin_cuerpo)
+    else:
+        await _enviar(send, status, cuerpo, server_timing=server_timing, extra=extra, sin_cuerpo=sin_cuerpo)
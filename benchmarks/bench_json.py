@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de serialización JSON y compresión de respuestas.
+
+Compara, para las respuestas típicas del servicio (un RFC, consulta múltiple,
+historial y una consulta en flujo de 1000 RFCs), el proveedor JSON por
+defecto de Flask contra response_codec y cada backend instalado; mide el
+costo y la razón de compresión de gzip (y brotli si está instalado), y
+estima los segundos de CPU por día con `--peticiones-dia` peticiones de
+cada tipo.
+
+Ejecutar con: python benchmarks/bench_json.py [--iteraciones N] [--peticiones-dia N]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+import response_codec  # noqa: E402
+from common import generar_rfcs  # noqa: E402
+
+
+def resultado(rfc, i):
+    datos = {'pendientes': i % 17, 'vencidas': i % 3, 'discrepancias': i % 2,
+             'total_facturas': 100 + i, 'monto_total': round(1234.5 * (i + 1), 2)}
+    alertas = []
+    if datos['vencidas']:
+        alertas.append({'tipo': 'critico',
+                        'mensaje': f"Tienes {datos['vencidas']} facturas vencidas que requieren atención inmediata"})
+    if datos['discrepancias']:
+        alertas.append({'tipo': 'atencion',
+                        'mensaje': f"Se encontraron {datos['discrepancias']} discrepancias en tus facturas"})
+    return {'rfc': rfc, 'timestamp': '2025-07-28T10:30:00.000000', 'status': 'success',
+            'datos': datos, 'alertas': alertas,
+            'cache': {'hit': False, 'edad_segundos': 0.0}}
+
+
+def cargas():
+    rfcs = generar_rfcs(1000)
+    multiple = [resultado(rfc, i) for i, rfc in enumerate(rfcs[:10])]
+    historial = [{'desde': '2025-07-28T10:00:00', 'hasta': '2025-07-28T11:00:00', 'observaciones': i % 9 + 1,
+                  'datos': resultado('X', i)['datos']} for i in range(200)]
+    return {
+        'consultar_sat': resultado(rfcs[0], 1),
+        'consultar_multiple (10)': {'resultados': multiple, 'total_consultados': 10,
+                                    'timestamp': '2025-07-28T10:30:00.000000'},
+        'historial (200 tramos)': {'rfc': rfcs[0], 'tramos': historial, 'total': 200},
+        # En flujo cada resultado se serializa por separado
+        'flujo (1000 líneas)': [dict(resultado(rfc, i), indice=i) for i, rfc in enumerate(rfcs)],
+    }
+
+
+def medir(funcion, iteraciones):
+    inicio = time.process_time()
+    for _ in range(iteraciones):
+        funcion()
+    return (time.process_time() - inicio) / iteraciones * 1e6
+
+
+def serializadores(app, flujo=False):
+    """Funciones a comparar; en flujo cada línea se serializa sin construir un Response"""
+    flask_defecto = DefaultJSONProvider(app)
+    rapido = response_codec.FastJSONProvider(app)
+    if flujo:
+        defecto, codec = flask_defecto.dumps, response_codec.dumps_texto
+    else:
+        defecto = lambda obj: flask_defecto.response(obj).get_data()  # noqa: E731
+        codec = lambda obj: rapido.response(obj).get_data()  # noqa: E731
+    opciones = {
+        'flask (stdlib, sort_keys, ensure_ascii)': defecto,
+        f'response_codec ({response_codec.BACKEND})': codec,
+        'stdlib compacto': lambda obj: json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode(),
+    }
+    try:
+        import orjson
+        opciones['orjson'] = orjson.dumps
+    except ImportError:
+        pass
+    try:
+        import msgspec
+        opciones['msgspec'] = msgspec.json.encode
+    except ImportError:
+        pass
+    return opciones
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iteraciones', type=int, default=2000)
+    parser.add_argument('--peticiones-dia', type=int, default=100_000)
+    args = parser.parse_args()
+
+    app = Flask('bench')
+    reporte = {'backend': response_codec.BACKEND, 'iteraciones': args.iteraciones,
+               'peticiones_dia': args.peticiones_dia, 'cargas': {}}
+
+    with app.app_context():
+        for nombre, carga in cargas().items():
+            flujo = isinstance(carga, list)
+            iteraciones = max(1, args.iteraciones // (100 if flujo else 1))
+            tiempos = {}
+            for serializador, dumps in serializadores(app, flujo).items():
+                if flujo:
+                    tiempos[serializador] = medir(lambda: [dumps(linea) for linea in carga], iteraciones)
+                else:
+                    tiempos[serializador] = medir(lambda: dumps(carga), iteraciones)
+
+            cuerpo = response_codec.dumps(carga)
+            compresion = {}
+            # Las respuestas en flujo no se comprimen: se mide solo la serialización
+            niveles = () if flujo else (1, 5, 9)
+            calidades = () if flujo or response_codec.brotli is None else (1, 4, 11)
+            for nivel in niveles:
+                comprimido = gzip.compress(cuerpo, compresslevel=nivel, mtime=0)
+                compresion[f'gzip-{nivel}'] = {
+                    'us': round(medir(lambda: gzip.compress(cuerpo, compresslevel=nivel, mtime=0), iteraciones), 1),
+                    'bytes': len(comprimido),
+                }
+            for calidad in calidades:
+                comprimido = response_codec.brotli.compress(cuerpo, quality=calidad)
+                compresion[f'br-{calidad}'] = {
+                    'us': round(medir(lambda: response_codec.brotli.compress(cuerpo, quality=calidad),
+                                      max(1, iteraciones // 10)), 1),
+                    'bytes': len(comprimido),
+                }
+
+            base = tiempos['flask (stdlib, sort_keys, ensure_ascii)']
+            actual = tiempos[f'response_codec ({response_codec.BACKEND})']
+            reporte['cargas'][nombre] = {
+                'bytes': len(cuerpo),
+                'us_por_peticion': {k: round(v, 1) for k, v in tiempos.items()},
+                'aceleracion': round(base / actual, 2) if actual else None,
+                'cpu_ahorrada_s_dia': round((base - actual) * args.peticiones_dia / 1e6, 1),
+                'compresion': compresion or None,
+            }
+
+    print(json.dumps(reporte, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
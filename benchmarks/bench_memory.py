@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Memoria por RFC programado: diccionarios contra instantáneas compactas (snapshots.py).
+
+Guarda N instantáneas en SQLite con el mismo formato que el programador y
+las carga como lo hace cada worker al sincronizar, en tres
+representaciones: la respuesta procesada completa (fecha ISO y alertas con
+mensaje), el diccionario crudo de Finkok con su momento (lo que se guardaba
+antes) y `Snapshot`. Reporta bytes por RFC medidos con tracemalloc y el costo
+de armar la respuesta de la API desde una instantánea compacta.
+
+Ejecutar con: python benchmarks/bench_memory.py [--rfcs N]
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+from common import generar_rfcs
+from fake_finkok import FakeFinkok
+from history_store import CAMPOS
+from snapshots import Snapshot, codigos_alerta, renderizar_alertas
+
+
+def respuesta_procesada(rfc, datos):
+    # Misma forma que SATMonitor.procesar_respuesta_sat
+    return {
+        "rfc": rfc,
+        "timestamp": datetime.now().isoformat(),
+        "status": "success",
+        "datos": {campo: datos[campo] for campo in CAMPOS},
+        "alertas": renderizar_alertas(codigos_alerta(datos['pendientes'], datos['vencidas'], datos['discrepancias']),
+                                      datos['pendientes'], datos['vencidas'], datos['discrepancias']),
+    }
+
+
+def instantanea_compacta(rfc, datos, actualizada):
+    instantanea = Snapshot.desde_datos(rfc, json.loads(datos), actualizada)
+    return instantanea.rfc, instantanea
+
+
+REPRESENTACIONES = {
+    'respuesta_procesada': lambda rfc, datos, actualizada: (rfc, respuesta_procesada(rfc, json.loads(datos))),
+    'diccionario_crudo': lambda rfc, datos, actualizada: (rfc, (json.loads(datos), actualizada)),
+    'snapshot': instantanea_compacta,
+}
+
+
+def medir(conexion, construir):
+    """Bytes retenidos por el diccionario {rfc: representación} cargado desde SQLite"""
+    tracemalloc.start()
+    inicio = tracemalloc.get_traced_memory()[0]
+    memoria = {}
+    for rfc, datos, actualizada in conexion.execute("SELECT rfc, datos, actualizada FROM instantaneas"):
+        clave, valor = construir(rfc, datos, actualizada)
+        memoria[clave] = valor
+    retenido = tracemalloc.get_traced_memory()[0] - inicio
+    tracemalloc.stop()
+    return memoria, retenido
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rfcs', type=int, default=50000)
+    parser.add_argument('--renders', type=int, default=100000)
+    args = parser.parse_args()
+
+    conexion = sqlite3.connect(':memory:')
+    conexion.execute("CREATE TABLE instantaneas (rfc TEXT PRIMARY KEY, datos TEXT NOT NULL, actualizada REAL NOT NULL)")
+    ahora = time.time()
+    conexion.executemany(
+        "INSERT INTO instantaneas VALUES (?, ?, ?)",
+        ((rfc, json.dumps(FakeFinkok.datos_para(rfc)), ahora) for rfc in generar_rfcs(args.rfcs))
+    )
+
+    reporte = {'parametros': vars(args), 'bytes_por_rfc': {}}
+    for nombre, construir in REPRESENTACIONES.items():
+        print(f"Midiendo {nombre}...", file=sys.stderr, flush=True)
+        memoria, retenido = medir(conexion, construir)
+        reporte['bytes_por_rfc'][nombre] = round(retenido / len(memoria))
+        if nombre == 'snapshot':
+            instantaneas = list(memoria.values())
+        del memoria
+
+    antes = reporte['bytes_por_rfc']['diccionario_crudo']
+    despues = reporte['bytes_por_rfc']['snapshot']
+    reporte['reduccion'] = f"{antes / despues:.1f}x"
+
+    # Costo de armar la respuesta de la API desde la instantánea compacta (respuesta_programada)
+    inicio = time.perf_counter()
+    for i in range(args.renders):
+        instantaneas[i % len(instantaneas)].respuesta()
+    reporte['render_us'] = round((time.perf_counter() - inicio) / args.renders * 1e6, 2)
+
+    print(json.dumps(reporte, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Consultas individuales contra lotes (micro_batch.py) con Finkok simulado.
+
+Lanza benchmarks/fake_finkok.py con soporte de lotes y hace las mismas
+consultas simultáneas (payload con certificado y llave de tamaño real) en
+cuatro modos: una petición por RFC, lotes con el cliente síncrono, lotes con
+el cliente asíncrono y lotes contra un proveedor sin soporte (debe volver a
+las peticiones individuales). Reporta peticiones y bytes recibidos por el
+servidor, latencia por consulta y verifica que cada llamador recibe los
+datos de su propio RFC.
+
+Ejecutar con: python benchmarks/bench_micro_batch.py [--consultas N] [--concurrencia N]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from common import detener_proceso, generar_rfcs, iniciar_fake_finkok, percentiles, puerto_libre
+from fake_finkok import FakeFinkok
+from micro_batch import AsyncMicroBatcher, MicroBatcher
+from upstream import AsyncFinkokClient, FinkokClient
+
+
+def payloads(rfcs):
+    # Tamaños típicos de un .cer y un .key de e.firma
+    certificado = base64.b64encode(os.urandom(1900)).decode()
+    llave = base64.b64encode(os.urandom(1300)).decode()
+    return [{"username": "usuario", "password": "password", "rfc": rfc,
+             "certificate": certificado, "private_key": llave} for rfc in rfcs]
+
+
+def medir_hilos(consultar, lista, concurrencia):
+    latencias = []
+    errores = 0
+
+    def una(payload):
+        nonlocal errores
+        inicio = time.perf_counter()
+        datos = consultar(payload)
+        latencias.append(time.perf_counter() - inicio)
+        if datos != FakeFinkok.datos_para(payload['rfc']):
+            errores += 1
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrencia) as executor:
+        list(executor.map(una, lista))
+    return time.perf_counter() - inicio, latencias, errores
+
+
+async def medir_async(url, url_lote, lista, concurrencia, ventana, max_lote):
+    cliente = AsyncFinkokClient(url, pool_max=concurrencia)
+    lotes = AsyncMicroBatcher(cliente.post_json, url_lote, ventana=ventana, max_lote=max_lote)
+    semaforo = asyncio.Semaphore(concurrencia)
+    latencias = []
+    errores = 0
+
+    async def una(payload):
+        nonlocal errores
+        async with semaforo:
+            inicio = time.perf_counter()
+            datos = await lotes.consultar(payload)
+            latencias.append(time.perf_counter() - inicio)
+            if datos != FakeFinkok.datos_para(payload['rfc']):
+                errores += 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(una(p) for p in lista))
+    transcurrido = time.perf_counter() - inicio
+    await cliente.client.aclose()
+    return transcurrido, latencias, errores, lotes.estadisticas()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--consultas', type=int, default=2000)
+    parser.add_argument('--concurrencia', type=int, default=50)
+    parser.add_argument('--latencia-ms', type=float, default=50.0)
+    parser.add_argument('--ventana-ms', type=float, default=5.0)
+    parser.add_argument('--max-lote', type=int, default=50)
+    args = parser.parse_args()
+
+    puerto = puerto_libre()
+    fake = iniciar_fake_finkok(puerto, '--latencia-ms', str(args.latencia_ms), '--lotes')
+    base = f'http://127.0.0.1:{puerto}'
+    url, url_lote = f'{base}/status', f'{base}/status/lote'
+    lista = payloads(generar_rfcs(args.consultas))
+    ventana = args.ventana_ms / 1000.0
+    reporte = {'parametros': vars(args), 'modos': {}}
+
+    def estadisticas_fake():
+        return httpx.get(f'{base}/__stats?reiniciar=1').json()
+
+    try:
+        for modo in ('individual', 'lotes', 'lotes_async', 'sin_soporte'):
+            print(f"Midiendo {modo}...", file=sys.stderr, flush=True)
+            httpx.post(f'{base}/__config', json={'lotes': modo != 'sin_soporte'})
+            estadisticas_fake()
+            lotes = None
+            if modo == 'lotes_async':
+                transcurrido, latencias, errores, stats_lotes = asyncio.run(
+                    medir_async(url, url_lote, lista, args.concurrencia, ventana, args.max_lote))
+            else:
+                cliente = FinkokClient(url, pool_max=args.concurrencia)
+                consultar = cliente.post_json
+                if modo != 'individual':
+                    lotes = MicroBatcher(cliente.post_json, url_lote, ventana=ventana, max_lote=args.max_lote)
+                    consultar = lotes.consultar
+                transcurrido, latencias, errores = medir_hilos(consultar, lista, args.concurrencia)
+                stats_lotes = lotes.estadisticas() if lotes is not None else None
+            servidor = estadisticas_fake()
+            reporte['modos'][modo] = {
+                'segundos': round(transcurrido, 2),
+                'consultas_por_s': round(len(lista) / transcurrido, 1),
+                **percentiles(latencias),
+                'datos_incorrectos': errores,
+                'peticiones_upstream': servidor['peticiones'],
+                'bytes_recibidos_upstream': servidor['bytes_recibidos'],
+                'bytes_por_rfc': round(servidor['bytes_recibidos'] / len(lista)),
+                'lotes': stats_lotes,
+            }
+    finally:
+        detener_proceso(fake)
+
+    print(json.dumps(reporte, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Resumen de carteras (portfolio_store.py): agregados incrementales contra recálculo.
+
+Crea varias carteras de N RFCs (con RFCs compartidos entre carteras), aplica
+rondas de instantáneas donde cambia una fracción de los RFCs y mide el
+throughput de escritura, la latencia de `resumen()` (una fila y el índice de
+riesgo) y la de calcular lo mismo desde las instantáneas en cada lectura.
+Al final compara los totales incrementales con los esperados.
+
+Ejecutar con: python benchmarks/bench_portfolio.py [--rfcs N] [--carteras N]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from common import generar_rfcs, percentiles
+from fake_finkok import FakeFinkok
+from history_store import CAMPOS
+from portfolio_store import ACUMULADOS, PortfolioStore
+
+
+def alertas_para(datos):
+    # Mismas reglas que SATMonitor.generar_alertas
+    alertas = []
+    if datos['vencidas'] > 0:
+        alertas.append({'tipo': 'critico'})
+    if datos['pendientes'] > 10:
+        alertas.append({'tipo': 'advertencia'})
+    if datos['discrepancias'] > 0:
+        alertas.append({'tipo': 'atencion'})
+    return alertas
+
+
+def datos_aleatorios(rfc, aleatorio):
+    return {
+        'rfc': rfc,
+        'pendientes': aleatorio.randrange(20),
+        'vencidas': aleatorio.choice((0, 0, 0, 1, 2, 5)),
+        'discrepancias': aleatorio.choice((0, 0, 0, 1, 3)),
+        'total_facturas': aleatorio.randrange(20, 300),
+        'monto_total': round(aleatorio.uniform(0, 500000), 2),
+    }
+
+
+def resumen_recalculado(store, cartera, top):
+    """Lo mismo que resumen() pero agregando las instantáneas de los miembros en cada lectura"""
+    conexion = store._conexion()
+    totales = conexion.execute(
+        f"SELECT count(*), count(e.rfc), {', '.join(f'coalesce(sum(e.{c}), 0)' for c in ACUMULADOS)}"
+        " FROM miembros m LEFT JOIN estados e ON e.rfc = m.rfc WHERE m.propietario = '' AND m.cartera = ?",
+        (cartera,)
+    ).fetchone()
+    riesgosos = conexion.execute(
+        "SELECT e.rfc, e.riesgo FROM miembros m JOIN estados e ON e.rfc = m.rfc"
+        " WHERE m.propietario = '' AND m.cartera = ?"
+        " ORDER BY e.riesgo DESC, e.vencidas DESC, e.monto_total DESC LIMIT ?", (cartera, top)
+    ).fetchall()
+    return totales, riesgosos
+
+
+def medir(funcion, repeticiones):
+    latencias = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        funcion()
+        latencias.append(time.perf_counter() - inicio)
+    return latencias
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rfcs', type=int, default=1000, help='RFCs por cartera')
+    parser.add_argument('--carteras', type=int, default=20)
+    parser.add_argument('--rondas', type=int, default=5)
+    parser.add_argument('--fraccion-cambios', type=float, default=0.1)
+    parser.add_argument('--lecturas', type=int, default=200)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    aleatorio = random.Random(11)
+    # Cada RFC queda en dos carteras en promedio
+    universo = generar_rfcs(max(args.rfcs, args.rfcs * args.carteras // 2))
+    carteras = {f'despacho-{i}': aleatorio.sample(universo, args.rfcs) for i in range(args.carteras)}
+    directorio = tempfile.mkdtemp(prefix='bench_carteras_')
+    store = PortfolioStore(os.path.join(directorio, 'carteras.sqlite3'), intervalo_escritura=3600)
+    ultimos = {}
+
+    def observar(rfc, datos):
+        ultimos[rfc] = datos
+        store.observar(rfc, alertas_para(datos), datos)
+
+    try:
+        inicio = time.perf_counter()
+        for cartera, rfcs in carteras.items():
+            store.agregar(cartera, rfcs)
+        alta = time.perf_counter() - inicio
+
+        print("Aplicando instantáneas...", file=sys.stderr, flush=True)
+        inicio = time.perf_counter()
+        for rfc in universo:
+            observar(rfc, FakeFinkok.datos_para(rfc))
+        store.vaciar()
+        inicial = time.perf_counter() - inicio
+
+        cambios = max(1, int(len(universo) * args.fraccion_cambios))
+        rondas = []
+        for _ in range(args.rondas):
+            inicio = time.perf_counter()
+            for rfc in universo:
+                if aleatorio.random() < args.fraccion_cambios:
+                    observar(rfc, datos_aleatorios(rfc, aleatorio))
+                else:
+                    # Sin cambios: solo actualiza el momento de la instantánea
+                    observar(rfc, ultimos[rfc])
+            store.vaciar()
+            rondas.append(time.perf_counter() - inicio)
+
+        print("Midiendo lecturas...", file=sys.stderr, flush=True)
+        nombres = list(carteras)
+        incremental = medir(lambda: store.resumen(aleatorio.choice(nombres), args.top), args.lecturas)
+        recalculado = medir(lambda: resumen_recalculado(store, aleatorio.choice(nombres), args.top),
+                            args.lecturas)
+
+        # Totales incrementales contra los calculados aquí desde las últimas instantáneas
+        diferencias = 0
+        for cartera, rfcs in carteras.items():
+            resumen = store.resumen(cartera, args.top)
+            for campo in CAMPOS:
+                esperado = sum(ultimos[rfc][campo] for rfc in rfcs)
+                if abs(resumen['totales'][campo] - esperado) > 0.01:
+                    diferencias += 1
+        reporte = {
+            'parametros': vars(args),
+            'rfcs_distintos': len(universo),
+            'alta_miembros_s': round(alta, 3),
+            'instantaneas_iniciales_por_s': round(len(universo) / inicial),
+            'instantaneas_por_s': round(len(universo) * len(rondas) / sum(rondas)),
+            'cambios_por_ronda_aprox': cambios,
+            'resumen_incremental': percentiles(incremental),
+            'resumen_recalculado': percentiles(recalculado),
+            'totales_incorrectos': diferencias,
+            'estadisticas': store.estadisticas(),
+        }
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    print(json.dumps(reporte, indent=2))
+
+
+if __name__ == '__main__':
+    main()
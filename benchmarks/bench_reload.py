@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Recarga y reciclado de workers bajo carga (server.py): errores y latencia.
+
+Levanta un Finkok simulado lento y el supervisor de server.py con varios
+clientes consultando sin pausa; durante la prueba envía SIGHUP (maestro nuevo
+sobre el mismo socket) y los workers se reciclan por max_requests. Compara el
+worker gthread de gunicorn, que corta las conexiones aceptadas y aún no leídas
+al salir, con `server.ThreadWorker`. Reporta respuestas por código o error y
+p50/p95/p99 de cada modo.
+
+Ejecutar con: python benchmarks/bench_reload.py [--recargas N] [--max-requests N]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from common import (RAIZ, detener_proceso, entorno_aislado, entorno_certificados, generar_rfcs,
+                    iniciar_fake_finkok, iniciar_proceso, percentiles, puerto_libre)
+
+WORKERS = {
+    'gthread_gunicorn': ['-k', 'gthread'],
+    'server_thread_worker': [],
+}
+
+
+def cliente(url, rfcs, alto, resultados, latencias, lock):
+    n = 0
+    while not alto.is_set():
+        cuerpo = json.dumps({'rfc': rfcs[n % len(rfcs)]}).encode()
+        n += 1
+        peticion = urllib.request.Request(f'{url}/consultar_sat', data=cuerpo,
+                                          headers={'Content-Type': 'application/json'})
+        inicio = time.perf_counter()
+        try:
+            with urllib.request.urlopen(peticion, timeout=60) as respuesta:
+                respuesta.read()
+                clave = str(respuesta.status)
+        except urllib.error.HTTPError as e:
+            clave = str(e.code)
+        except Exception as e:
+            clave = type(e).__name__
+        with lock:
+            resultados[clave] = resultados.get(clave, 0) + 1
+            latencias.append(time.perf_counter() - inicio)
+
+
+def medir(nombre, args, env):
+    puerto = puerto_libre()
+    entorno = dict(env, SERVER_BIND=f'127.0.0.1:{puerto}', SERVER_WORKERS=str(args.workers),
+                   SERVER_THREADS=str(args.hilos), SERVER_MAX_REQUESTS=str(args.max_requests))
+    supervisor = iniciar_proceso([sys.executable, os.path.join(RAIZ, 'server.py')] + WORKERS[nombre],
+                                 entorno, puerto)
+    resultados, latencias, lock, alto = {}, [], threading.Lock(), threading.Event()
+    url = f'http://127.0.0.1:{puerto}'
+    rfcs = generar_rfcs(args.rfcs)
+    hilos = [threading.Thread(target=cliente,
+                              args=(url, rfcs[i::args.clientes], alto, resultados, latencias, lock))
+             for i in range(args.clientes)]
+    try:
+        for hilo in hilos:
+            hilo.start()
+        for _ in range(args.recargas):
+            time.sleep(args.intervalo)
+            supervisor.send_signal(signal.SIGHUP)
+        time.sleep(args.intervalo)
+    finally:
+        alto.set()
+        for hilo in hilos:
+            hilo.join()
+        detener_proceso(supervisor, timeout=120)
+    errores = sum(n for clave, n in resultados.items() if clave != '200')
+    return {
+        'respuestas': resultados,
+        'errores': errores,
+        'latencia': percentiles(latencias),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--recargas', type=int, default=3)
+    parser.add_argument('--intervalo', type=float, default=6.0, help='Segundos entre recargas')
+    parser.add_argument('--max-requests', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--hilos', type=int, default=8)
+    parser.add_argument('--clientes', type=int, default=16)
+    parser.add_argument('--latencia-ms', type=float, default=800.0)
+    parser.add_argument('--rfcs', type=int, default=2000)
+    args = parser.parse_args()
+
+    directorio, certificados = entorno_certificados()
+    puerto_fake = puerto_libre()
+    fake = iniciar_fake_finkok(puerto_fake, '--latencia-ms', str(args.latencia_ms))
+    env = entorno_aislado(directorio, certificados)
+    env.update({
+        'FINKOK_API_URL': f'http://127.0.0.1:{puerto_fake}/status',
+        'CACHE_TTL': '0',
+        'RATE_LIMIT': '0',
+        'DEBUG': 'False',
+    })
+    reporte = {'parametros': vars(args), 'modos': {}}
+    try:
+        for nombre in WORKERS:
+            print(f"Midiendo {nombre}...", file=sys.stderr, flush=True)
+            reporte['modos'][nombre] = medir(nombre, args, env)
+    finally:
+        detener_proceso(fake)
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    print(json.dumps(reporte, indent=2))
+
+
+if __name__ == '__main__':
+    main()
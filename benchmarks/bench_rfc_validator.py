@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del validador de RFCs.
+
+Compara la validación original de SATMonitor.validar_rfc (patrón elegido en
+cada llamada y re.match) contra rfc_validator sobre un millón de RFCs
+generados: válidos, con dígito verificador erróneo, con fecha imposible y
+con formato inválido.
+
+Ejecutar con: python benchmarks/bench_rfc_validator.py [--cantidad N]
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import rfc_validator  # noqa: E402
+
+LETRAS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+HOMOCLAVE = 'ABCDEFGHIJKLMNPQRSTUVWXYZ123456789'
+
+
+def validar_rfc_original(rfc):
+    """Copia de la validación anterior, como referencia"""
+    if not rfc:
+        return False
+
+    rfc = rfc.strip()
+
+    if len(rfc) < 12 or len(rfc) > 13:
+        return False
+
+    if len(rfc) == 12:
+        pattern = r'^[A-Z&Ñ]{3}[0-9]{6}[A-Z0-9]{3}$'
+    else:
+        pattern = r'^[A-Z&Ñ]{4}[0-9]{6}[A-Z0-9]{3}$'
+
+    return bool(re.match(pattern, rfc))
+
+
+def generar_rfcs(cantidad, semilla=42):
+    """Genera RFCs deterministas: 70% válidos y 30% con algún defecto"""
+    aleatorio = random.Random(semilla)
+    rfcs = []
+    for _ in range(cantidad):
+        letras = ''.join(aleatorio.choice(LETRAS) for _ in range(aleatorio.choice((3, 4))))
+        fecha = f"{aleatorio.randint(0, 99):02d}{aleatorio.randint(1, 12):02d}{aleatorio.randint(1, 28):02d}"
+        base = letras + fecha + aleatorio.choice(HOMOCLAVE) + aleatorio.choice(HOMOCLAVE) + '0'
+        rfc = base[:-1] + rfc_validator.digito_verificador(base)
+
+        tipo = aleatorio.random()
+        if tipo < 0.10:
+            # Dígito verificador incorrecto
+            digito = '1' if rfc[-1] != '1' else '2'
+            rfc = rfc[:-1] + digito
+        elif tipo < 0.20:
+            # Mes imposible
+            rfc = rfc[:len(letras) + 2] + '13' + rfc[len(letras) + 4:]
+        elif tipo < 0.30:
+            # Formato inválido
+            rfc = rfc[:len(letras)] + 'X' + rfc[len(letras) + 1:]
+        rfcs.append(rfc)
+    return rfcs
+
+
+def medir(nombre, funcion, rfcs):
+    inicio = time.perf_counter()
+    validos = funcion(rfcs)
+    duracion = time.perf_counter() - inicio
+    return {
+        'nombre': nombre,
+        'segundos': round(duracion, 3),
+        'ns_por_rfc': round(duracion / len(rfcs) * 1e9, 1),
+        'validos': validos,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--cantidad', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    rfcs = generar_rfcs(args.cantidad)
+
+    resultados = [
+        medir('original (re.match por llamada)',
+              lambda xs: sum(1 for r in xs if validar_rfc_original(r)), rfcs),
+        medir('rfc_validator.es_valido (solo formato y fecha)',
+              lambda xs: sum(1 for r in xs if rfc_validator.es_valido(r, verificar_digito=False)), rfcs),
+        medir('rfc_validator.es_valido (con dígito verificador)',
+              lambda xs: sum(1 for r in xs if rfc_validator.es_valido(r)), rfcs),
+        medir('rfc_validator.validar_lote',
+              lambda xs: sum(1 for _, motivo in rfc_validator.validar_lote(xs) if motivo is None), rfcs),
+    ]
+
+    motivos = {}
+    for _, motivo in rfc_validator.validar_lote(rfcs):
+        motivos[motivo or 'valido'] = motivos.get(motivo or 'valido', 0) + 1
+
+    print(json.dumps({'cantidad': len(rfcs), 'resultados': resultados, 'motivos': motivos}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
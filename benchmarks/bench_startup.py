@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Arranque del servicio: tiempo de importación y memoria por worker.
+
+Mide el tiempo de `import app` en procesos nuevos (mediana de varias
+corridas) y los módulos que más aportan según `python -X importtime`.
+Después lanza gunicorn con y sin `preload_app` (gunicorn.conf.py) y reporta
+el tiempo hasta la primera respuesta y RSS, PSS y USS de cada proceso: con
+preload las páginas del maestro se comparten y el PSS por worker baja.
+
+Ejecutar con: python benchmarks/bench_startup.py [--corridas N] [--workers N]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+from common import (RAIZ, detener_proceso, entorno_aislado, entorno_certificados, iniciar_proceso,
+                    memoria_kb, puerto_libre, rss_arbol)
+
+MEDIR_IMPORT = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+
+
+def medir_importacion(env, corridas, top):
+    tiempos = []
+    for _ in range(corridas):
+        salida = subprocess.run([sys.executable, '-c', MEDIR_IMPORT], cwd=RAIZ, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        tiempos.append(float(salida.strip().splitlines()[-1]))
+
+    # Módulos importados directamente por app, por tiempo acumulado
+    traza = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=RAIZ, env=env,
+                           capture_output=True, text=True, check=True).stderr
+    modulos = {}
+    for linea in traza.splitlines():
+        if not linea.startswith('import time:') or 'cumulative' in linea:
+            continue
+        _, acumulado, nombre = linea.split('|')
+        # Un nivel de sangría bajo app: sus importaciones directas
+        if nombre.startswith('   ') and not nombre.startswith('    '):
+            modulos[nombre.strip()] = int(acumulado) / 1000
+    return {
+        'mediana_ms': round(statistics.median(tiempos) * 1000, 1),
+        'min_ms': round(min(tiempos) * 1000, 1),
+        'modulos_ms': dict(sorted(modulos.items(), key=lambda m: -m[1])[:top]),
+    }
+
+
+def esperar_respuesta(url, timeout=30.0):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as r:
+                if r.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.02)
+    raise RuntimeError(f"{url} no respondió en {timeout}s")
+
+
+def medir_gunicorn(env, workers, preload):
+    puerto = puerto_libre()
+    entorno = dict(env, GUNICORN_PRELOAD=str(preload))
+    inicio = time.perf_counter()
+    servidor = iniciar_proceso(['gunicorn', '-w', str(workers), '-b', f'127.0.0.1:{puerto}',
+                                '--timeout', '60', 'app:app'], entorno)
+    try:
+        esperar_respuesta(f'http://127.0.0.1:{puerto}/')
+        primera = time.perf_counter() - inicio
+        # Todos los workers vivos antes de medir memoria
+        limite = time.monotonic() + 30
+        while len(rss_arbol(servidor.pid)) <= workers and time.monotonic() < limite:
+            time.sleep(0.05)
+        time.sleep(1.0)
+        maestro = memoria_kb(servidor.pid)
+        por_worker = [memoria_kb(pid) for pid in rss_arbol(servidor.pid) if pid != servidor.pid]
+        por_worker = [m for m in por_worker if m is not None]
+        return {
+            'primera_respuesta_s': round(primera, 3),
+            'maestro': maestro,
+            'workers': por_worker,
+            'pss_total_kb': maestro['pss_kb'] + sum(m['pss_kb'] for m in por_worker),
+        }
+    finally:
+        detener_proceso(servidor)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--corridas', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--top', type=int, default=10, help='Módulos más lentos a reportar')
+    parser.add_argument('--salida', help='Archivo JSON para el reporte')
+    args = parser.parse_args()
+
+    directorio, certificados = entorno_certificados()
+    env = entorno_aislado(directorio, certificados)
+    try:
+        print("Midiendo importación...", file=sys.stderr, flush=True)
+        reporte = {
+            'parametros': vars(args),
+            'importacion': medir_importacion(env, args.corridas, args.top),
+            'gunicorn': {},
+        }
+        for preload in (False, True):
+            print(f"Midiendo gunicorn (preload={preload})...", file=sys.stderr, flush=True)
+            reporte['gunicorn']['preload' if preload else 'sin_preload'] = medir_gunicorn(env, args.workers, preload)
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    texto = json.dumps(reporte, indent=2)
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            f.write(texto + '\n')
+    print(texto)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del costo de las trazas por petición.
+
+Mide una petición simulada con seis fases (las de /consultar_sat) sin traza
+activa, con trazas deshabilitadas, con trazas habilitadas y con el
+perfilador por muestreo encendido.
+
+Ejecutar con: python benchmarks/bench_tracing.py [--iteraciones N]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tracing  # noqa: E402
+from tracing import RequestTracer, fase  # noqa: E402
+
+FASES = ('parseo', 'validacion', 'certificados', 'finkok', 'procesamiento', 'serializacion')
+
+
+def peticion_sin_instrumentar():
+    for _ in FASES:
+        pass
+
+
+def peticion(tracer):
+    token = tracer.iniciar('POST', '/consultar_sat')
+    for nombre in FASES:
+        with fase(nombre):
+            pass
+    tracer.finalizar(token, 200)
+
+
+def medir(nombre, funcion, iteraciones):
+    inicio = time.perf_counter()
+    for _ in range(iteraciones):
+        funcion()
+    duracion = time.perf_counter() - inicio
+    return {'nombre': nombre, 'us_por_peticion': round(duracion / iteraciones * 1e6, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--iteraciones', type=int, default=200_000)
+    args = parser.parse_args()
+
+    deshabilitado = RequestTracer(habilitado=False)
+    habilitado = RequestTracer(umbral_lento=60.0)
+    perfilador = RequestTracer(umbral_lento=60.0, perfilador=True, directorio_perfiles=None)
+
+    resultados = [
+        medir('sin instrumentar', peticion_sin_instrumentar, args.iteraciones),
+        medir('trazas deshabilitadas', lambda: peticion(deshabilitado), args.iteraciones),
+        medir('trazas habilitadas', lambda: peticion(habilitado), args.iteraciones),
+        medir('trazas + perfilador', lambda: peticion(perfilador), args.iteraciones),
+    ]
+    # Costo aislado de fase() sin traza activa (lo que pagan los hilos de trabajos masivos)
+    inicio = time.perf_counter()
+    for _ in range(args.iteraciones):
+        with tracing.fase('x'):
+            pass
+    resultados.append({'nombre': 'fase() sin traza activa',
+                       'us_por_peticion': round((time.perf_counter() - inicio) / args.iteraciones * 1e6, 3)})
+
+    print(json.dumps({'iteraciones': args.iteraciones, 'resultados': resultados}, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Utilidades compartidas por los benchmarks: procesos auxiliares, espera de
+puertos, memoria residente (y compartida) por proceso y percentiles.
+"""
+
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if RAIZ not in sys.path:
+    sys.path.insert(0, RAIZ)
+
+import rfc_validator  # noqa: E402
+
+# Variables con rutas de trabajo del servicio y su archivo dentro del directorio de la corrida
+RUTAS_TRABAJO = (
+    ('METRICS_DIR', 'metrics'),
+    ('JOBS_DIR', 'jobs'),
+    ('TRACING_PROFILER_DIR', 'perfiles'),
+    ('CACHE_SQLITE_PATH', 'cache.sqlite3'),
+    ('HISTORY_DB_PATH', 'historial.sqlite3'),
+    ('SCHEDULER_DB_PATH', 'programador.sqlite3'),
+    ('ALERTS_DB_PATH', 'alertas.sqlite3'),
+    ('ALERTS_DEAD_LETTER_PATH', 'alertas_dead_letter.ndjson'),
+    ('RATE_LIMIT_DB_PATH', 'limites.sqlite3'),
+    ('PORTFOLIO_DB_PATH', 'carteras.sqlite3'),
+)
+
+
+def puerto_libre():
+    """Devuelve un puerto TCP libre en localhost"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def esperar_puerto(puerto, timeout=15.0):
+    """Espera hasta que algo acepte conexiones en el puerto"""
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            with socket.create_connection(('127.0.0.1', puerto), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nada escucha en el puerto {puerto} tras {timeout}s")
+
+
+def iniciar_proceso(argumentos, entorno=None, puerto=None):
+    """Lanza un proceso desde la raíz del repositorio y espera su puerto"""
+    env = dict(os.environ)
+    env.update(entorno or {})
+    env['PYTHONPATH'] = RAIZ + os.pathsep + env.get('PYTHONPATH', '')
+    proceso = subprocess.Popen(
+        argumentos, cwd=RAIZ, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    if puerto is not None:
+        try:
+            esperar_puerto(puerto)
+        except RuntimeError:
+            detener_proceso(proceso)
+            raise
+    return proceso
+
+
+def iniciar_fake_finkok(puerto, *argumentos):
+    """Lanza benchmarks/fake_finkok.py con los argumentos dados"""
+    return iniciar_proceso(
+        [sys.executable, os.path.join(RAIZ, 'benchmarks', 'fake_finkok.py'),
+         '--puerto', str(puerto), *argumentos],
+        puerto=puerto,
+    )
+
+
+def detener_proceso(proceso, timeout=10.0):
+    """Termina un proceso (y su grupo) con SIGTERM y, si no responde, SIGKILL"""
+    if proceso.poll() is not None:
+        return
+    try:
+        os.killpg(proceso.pid, 15)
+        proceso.wait(timeout)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        try:
+            os.killpg(proceso.pid, 9)
+        except ProcessLookupError:
+            pass
+        proceso.wait()
+
+
+def entorno_certificados():
+    """Certificados de prueba en un directorio temporal (su contenido no se valida)"""
+    directorio = tempfile.mkdtemp(prefix='monitor_sat_bench_')
+    rutas = {}
+    for nombre, variable in (('cert.cer', 'CERT_PATH'), ('key.key', 'KEY_PATH')):
+        ruta = os.path.join(directorio, nombre)
+        with open(ruta, 'wb') as f:
+            f.write(os.urandom(1200))
+        rutas[variable] = ruta
+    return directorio, rutas
+
+
+def rutas_aisladas(directorio):
+    """Rutas de trabajo (bases SQLite, métricas, trabajos, dead-letter) dentro de `directorio`:
+    el servidor de la prueba no comparte estado con otras corridas ni toca /tmp/monitor_sat"""
+    return {variable: os.path.join(directorio, archivo) for variable, archivo in RUTAS_TRABAJO}
+
+
+def entorno_aislado(directorio, certificados):
+    """Entorno completo para un proceso del servicio con sus rutas de trabajo en `directorio`"""
+    env = dict(os.environ)
+    env.update(certificados)
+    env['PYTHONPATH'] = RAIZ
+    env.update(rutas_aisladas(directorio))
+    return env
+
+
+def generar_rfcs(n, semilla=7):
+    """RFCs de persona moral con fecha y dígito verificador válidos"""
+    aleatorio = random.Random(semilla)
+    letras = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    rfcs = []
+    for _ in range(n):
+        base = (''.join(aleatorio.choice(letras) for _ in range(3))
+                + f"{aleatorio.randrange(100):02d}{aleatorio.randrange(1, 13):02d}{aleatorio.randrange(1, 29):02d}"
+                + ''.join(aleatorio.choice(letras + '0123456789') for _ in range(2)))
+        rfcs.append(base + rfc_validator.digito_verificador(base + '0'))
+    return rfcs
+
+
+def _hijos(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def rss_kb(pid):
+    """Memoria residente (kB) de un proceso, o None si no existe"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for linea in f:
+                if linea.startswith('VmRSS:'):
+                    return int(linea.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def rss_arbol(pid):
+    """RSS (kB) de un proceso y todos sus descendientes: {pid: kB}"""
+    resultado = {}
+    pendientes = [pid]
+    while pendientes:
+        actual = pendientes.pop()
+        rss = rss_kb(actual)
+        if rss is not None:
+            resultado[actual] = rss
+        pendientes.extend(_hijos(actual))
+    return resultado
+
+
+def memoria_kb(pid):
+    """RSS, PSS y USS (kB) de un proceso, o None si no existe.
+
+    PSS reparte cada página compartida entre los procesos que la usan y USS
+    cuenta solo las privadas: la suma de PSS de un árbol es su memoria real.
+    """
+    campos = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for linea in f:
+                partes = linea.split()
+                if len(partes) == 3 and partes[2] == 'kB':
+                    campos[partes[0].rstrip(':')] = int(partes[1])
+    except OSError:
+        return None
+    return {
+        'rss_kb': campos.get('Rss'),
+        'pss_kb': campos.get('Pss'),
+        'uss_kb': campos.get('Private_Clean', 0) + campos.get('Private_Dirty', 0),
+    }
+
+
+def percentiles(valores, puntos=(0.50, 0.95, 0.99)):
+    """Percentiles (en ms) de una lista de latencias en segundos"""
+    if not valores:
+        return {f"p{int(p * 100)}_ms": None for p in puntos}
+    ordenados = sorted(valores)
+    n = len(ordenados)
+    return {
+        f"p{int(p * 100)}_ms": round(ordenados[min(n - 1, int(p * n))] * 1000, 1)
+        for p in puntos
+    }
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Servidor local que imita la API de estatus de Finkok para pruebas de carga.
+
+Responde a cualquier POST con datos SAT deterministas por RFC, después de
+una latencia configurable, y puede devolver 503 o dejar peticiones sin
+respuesta en la proporción indicada. Usa asyncio, así que cientos de
+peticiones simultáneas no necesitan cientos de hilos.
+
+Con `--lotes`, un payload con la lista `rfcs` recibe `{"resultados": [...]}`
+con los datos de cada RFC (ver micro_batch.py); sin esa opción responde 404,
+como un proveedor que no acepta lotes.
+
+Rutas de control (sin latencia simulada):
+    GET  /__stats              contadores de peticiones, errores y timeouts
+    GET  /__stats?reiniciar=1  devuelve los contadores y los pone en cero
+    POST /__config             cambia latencia/errores en caliente (JSON)
+
+Ejecutar con:
+    python benchmarks/fake_finkok.py --puerto 8900 --latencia-ms 300 --distribucion lognormal
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+
+
+class FakeFinkok:
+    """Imitación de Finkok con latencia y tasa de error configurables"""
+
+    # Parámetros que se pueden cambiar en caliente con POST /__config
+    AJUSTABLES = ('latencia_ms', 'distribucion', 'dispersion', 'tasa_error', 'tasa_timeout', 'timeout_s', 'lotes')
+
+    def __init__(self, latencia_ms=200.0, distribucion='fija', dispersion=0.5,
+                 tasa_error=0.0, tasa_timeout=0.0, timeout_s=30.0, semilla=None, lotes=False):
+        self.latencia_ms = latencia_ms
+        self.distribucion = distribucion
+        self.dispersion = dispersion
+        self.tasa_error = tasa_error
+        self.tasa_timeout = tasa_timeout
+        self.timeout_s = timeout_s
+        self.lotes = lotes
+        self.aleatorio = random.Random(semilla)
+        self.peticiones = 0
+        self.errores = 0
+        self.timeouts = 0
+        self.peticiones_lote = 0
+        self.rfcs = 0
+        self.bytes_recibidos = 0
+        self.en_vuelo = 0
+        self.max_en_vuelo = 0
+
+    def configurar(self, cambios):
+        """Aplica cambios de configuración (p. ej. para simular una degradación)"""
+        for nombre in self.AJUSTABLES:
+            if nombre in cambios:
+                setattr(self, nombre, cambios[nombre])
+        return {nombre: getattr(self, nombre) for nombre in self.AJUSTABLES}
+
+    def estadisticas(self, reiniciar=False):
+        datos = {
+            "peticiones": self.peticiones,
+            "errores": self.errores,
+            "timeouts": self.timeouts,
+            "peticiones_lote": self.peticiones_lote,
+            "rfcs": self.rfcs,
+            "bytes_recibidos": self.bytes_recibidos,
+            "max_en_vuelo": self.max_en_vuelo,
+        }
+        if reiniciar:
+            self.peticiones = self.errores = self.timeouts = 0
+            self.peticiones_lote = self.rfcs = self.bytes_recibidos = 0
+            self.max_en_vuelo = self.en_vuelo
+        return datos
+
+    def latencia(self):
+        """Latencia (segundos) de la siguiente respuesta"""
+        base = self.latencia_ms / 1000.0
+        if self.distribucion == 'uniforme':
+            return self.aleatorio.uniform(base * (1 - self.dispersion), base * (1 + self.dispersion))
+        if self.distribucion == 'lognormal':
+            # Mediana = latencia_ms, cola larga controlada por la dispersión
+            return base * self.aleatorio.lognormvariate(0, self.dispersion)
+        return base
+
+    @staticmethod
+    def datos_para(rfc):
+        """Datos SAT deterministas para un RFC"""
+        h = hashlib.sha256((rfc or '').encode()).digest()
+        return {
+            "rfc": rfc,
+            "pendientes": h[0] % 20,
+            "vencidas": h[1] % 4 if h[2] % 3 == 0 else 0,
+            "discrepancias": h[3] % 3 if h[4] % 4 == 0 else 0,
+            "total_facturas": 20 + h[5],
+            "monto_total": round(int.from_bytes(h[6:9], 'big') / 100, 2),
+        }
+
+    async def responder(self, metodo, ruta, cuerpo):
+        """Devuelve (status, payload) para una petición; None si se deja colgada"""
+        # Rutas de control, sin latencia ni errores simulados
+        if ruta.startswith('/__stats'):
+            return 200, self.estadisticas(reiniciar='reiniciar' in ruta)
+        if ruta == '/__config':
+            try:
+                return 200, self.configurar(json.loads(cuerpo or b'{}'))
+            except ValueError:
+                return 400, {"error": "JSON inválido"}
+
+        self.peticiones += 1
+        self.bytes_recibidos += len(cuerpo or b'')
+        self.en_vuelo += 1
+        self.max_en_vuelo = max(self.max_en_vuelo, self.en_vuelo)
+        try:
+            if self.tasa_timeout and self.aleatorio.random() < self.tasa_timeout:
+                # Finkok no contesta: el cliente debe cortar por su timeout de lectura
+                self.timeouts += 1
+                await asyncio.sleep(self.timeout_s)
+                return None
+            await asyncio.sleep(self.latencia())
+            if self.tasa_error and self.aleatorio.random() < self.tasa_error:
+                self.errores += 1
+                return 503, {"error": "Servicio no disponible"}
+            try:
+                payload = json.loads(cuerpo or b'{}')
+            except ValueError:
+                return 400, {"error": "JSON inválido"}
+            if isinstance(payload.get("rfcs"), list):
+                if not self.lotes:
+                    return 404, {"error": "No encontrado"}
+                self.peticiones_lote += 1
+                self.rfcs += len(payload["rfcs"])
+                return 200, {"resultados": [self.datos_para(rfc) for rfc in payload["rfcs"]]}
+            self.rfcs += 1
+            return 200, self.datos_para(payload.get("rfc"))
+        finally:
+            self.en_vuelo -= 1
+
+    async def _conexion(self, reader, writer):
+        try:
+            while True:
+                linea = await reader.readline()
+                if not linea:
+                    break
+                metodo, ruta, _ = linea.decode('latin-1').split(' ', 2)
+                cabeceras = {}
+                while True:
+                    linea = await reader.readline()
+                    if linea in (b'\r\n', b'\n', b''):
+                        break
+                    nombre, _, valor = linea.decode('latin-1').partition(':')
+                    cabeceras[nombre.strip().lower()] = valor.strip()
+                longitud = int(cabeceras.get('content-length', 0))
+                cuerpo = await reader.readexactly(longitud) if longitud else b''
+
+                respuesta = await self.responder(metodo, ruta, cuerpo)
+                if respuesta is None:
+                    break
+                status, payload = respuesta
+                datos = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} OK\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(datos)}\r\n\r\n".encode() + datos
+                )
+                await writer.drain()
+                if cabeceras.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def servir(self, host, puerto):
+        servidor = await asyncio.start_server(self._conexion, host, puerto, backlog=1024)
+        async with servidor:
+            await servidor.serve_forever()
+
+
+def agregar_argumentos(parser):
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--puerto', type=int, default=8900)
+    parser.add_argument('--latencia-ms', type=float, default=200.0)
+    parser.add_argument('--distribucion', choices=('fija', 'uniforme', 'lognormal'), default='fija')
+    parser.add_argument('--dispersion', type=float, default=0.5,
+                        help='Ancho relativo (uniforme) o sigma (lognormal) de la latencia')
+    parser.add_argument('--tasa-error', type=float, default=0.0, help='Fracción de respuestas 503')
+    parser.add_argument('--tasa-timeout', type=float, default=0.0,
+                        help='Fracción de peticiones que no reciben respuesta')
+    parser.add_argument('--timeout-s', type=float, default=30.0,
+                        help='Segundos que se retienen las peticiones sin respuesta')
+    parser.add_argument('--semilla', type=int)
+    parser.add_argument('--lotes', action='store_true', help='Acepta consultas de varios RFCs (campo rfcs)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor falso de Finkok para pruebas de carga')
+    agregar_argumentos(parser)
+    args = parser.parse_args()
+    fake = FakeFinkok(args.latencia_ms, args.distribucion, args.dispersion, args.tasa_error,
+                      args.tasa_timeout, args.timeout_s, args.semilla, args.lotes)
+    print(f"Fake Finkok escuchando en http://{args.host}:{args.puerto}", flush=True)
+    try:
+        asyncio.run(fake.servir(args.host, args.puerto))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga: modo WSGI (gunicorn sync) contra modo ASGI (uvicorn) con
+Finkok simulado por benchmarks/fake_finkok.py.
+
+Ambos modos corren con el mismo número de workers y con la caché desactivada
+(CACHE_TTL=0) para que cada petición llegue a Finkok. Se reporta throughput,
+percentiles de latencia, errores y RSS por worker.
+
+Ejecutar con:
+    python benchmarks/load_asgi_vs_wsgi.py --concurrencia 200 --duracion 15 --latencia-ms 300
+"""
+
+import argparse
+import asyncio
+import json
+import shutil
+import sys
+import time
+
+import httpx
+
+from common import (detener_proceso, entorno_certificados, generar_rfcs, iniciar_fake_finkok,
+                    iniciar_proceso, percentiles, puerto_libre, rss_arbol, rutas_aisladas)
+
+
+async def generar_carga(url, rfcs, concurrencia, duracion):
+    """Clientes cerrados: cada uno envía la siguiente petición al recibir la anterior"""
+    latencias = []
+    estados = {}
+    limites = httpx.Limits(max_connections=concurrencia, max_keepalive_connections=concurrencia)
+    async with httpx.AsyncClient(base_url=url, limits=limites, timeout=60) as cliente:
+        fin = time.monotonic() + duracion
+
+        async def usuario(i):
+            j = i
+            while time.monotonic() < fin:
+                rfc = rfcs[j % len(rfcs)]
+                j += concurrencia
+                inicio = time.perf_counter()
+                try:
+                    r = await cliente.post('/consultar_sat', json={'rfc': rfc})
+                    clave = str(r.status_code)
+                except httpx.HTTPError as e:
+                    clave = type(e).__name__
+                latencias.append(time.perf_counter() - inicio)
+                estados[clave] = estados.get(clave, 0) + 1
+
+        inicio = time.monotonic()
+        await asyncio.gather(*(usuario(i) for i in range(concurrencia)))
+        transcurrido = time.monotonic() - inicio
+
+    return {
+        'peticiones': len(latencias),
+        'throughput_rps': round(len(latencias) / transcurrido, 1),
+        **percentiles(latencias),
+        'estados': estados,
+    }
+
+
+def medir_modo(modo, args, entorno):
+    puerto = puerto_libre()
+    # gunicorn.conf.py aplica el perfil de server.py (hilos > 1 convierte sync en
+    # gthread, reciclado por max_requests): se fijan en la línea de comandos
+    fijos = ['-w', str(args.workers), '--threads', '1', '--max-requests', '0',
+             '-b', f'127.0.0.1:{puerto}', '--timeout', '120']
+    if modo == 'wsgi':
+        comando = ['gunicorn', *fijos, '-k', 'sync', 'app:app']
+    else:
+        comando = ['gunicorn', *fijos, '-k', 'uvicorn.workers.UvicornWorker', 'asgi_app:app']
+    servidor = iniciar_proceso(comando, entorno, puerto)
+    try:
+        url = f'http://127.0.0.1:{puerto}'
+        rfcs = generar_rfcs(args.rfcs)
+        # Calentamiento: conexiones, imports perezosos, hilos de métricas
+        asyncio.run(generar_carga(url, rfcs, min(args.concurrencia, 20), 1.0))
+        resultado = asyncio.run(generar_carga(url, rfcs, args.concurrencia, args.duracion))
+        rss = rss_arbol(servidor.pid)
+        rss.pop(servidor.pid, None)  # el proceso maestro no atiende peticiones
+        resultado['rss_por_worker_kb'] = sorted(rss.values())
+        return resultado
+    finally:
+        detener_proceso(servidor)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prueba de carga WSGI contra ASGI')
+    parser.add_argument('--modos', default='wsgi,asgi')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrencia', type=int, default=200)
+    parser.add_argument('--duracion', type=float, default=15.0)
+    parser.add_argument('--rfcs', type=int, default=5000)
+    parser.add_argument('--latencia-ms', type=float, default=300.0)
+    parser.add_argument('--distribucion', default='lognormal')
+    parser.add_argument('--salida', help='Archivo JSON para el reporte')
+    args = parser.parse_args()
+
+    puerto_fake = puerto_libre()
+    fake = iniciar_fake_finkok(puerto_fake, '--latencia-ms', str(args.latencia_ms),
+                               '--distribucion', args.distribucion, '--dispersion', '0.3')
+    directorio, certificados = entorno_certificados()
+    entorno = {
+        **certificados,
+        'FINKOK_API_URL': f'http://127.0.0.1:{puerto_fake}/status',
+        'CACHE_TTL': '0',
+        'CACHE_TTL_NEGATIVO': '0',
+        **rutas_aisladas(directorio),
+        'BREAKER_UMBRAL': '1000000',
+        # Todas las peticiones salen de la misma IP: sin límite por cliente
+        'RATE_LIMIT': '0',
+    }
+
+    reporte = {
+        'parametros': vars(args),
+        'resultados': {},
+    }
+    try:
+        for modo in args.modos.split(','):
+            print(f"Midiendo {modo}...", file=sys.stderr, flush=True)
+            reporte['resultados'][modo] = medir_modo(modo, args, entorno)
+    finally:
+        detener_proceso(fake)
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    texto = json.dumps(reporte, indent=2)
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            f.write(texto + '\n')
+    print(texto)
+
+
+if __name__ == '__main__':
+    main()
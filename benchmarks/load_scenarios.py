@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+"""
+Escenarios de carga para /consultar_sat y /consultar_multiple contra un
+Finkok simulado (benchmarks/fake_finkok.py).
+
+Escenarios:
+    estable            carga constante de /consultar_sat con RFCs distintos
+    estable_multiple   carga constante de /consultar_multiple (lotes de 10)
+    rafaga             llegadas a tasa fija con ráfagas periódicas (lazo abierto)
+    rfc_caliente       RFCs con distribución Zipf: pocos RFCs concentran el tráfico
+    degradacion        Finkok se vuelve lento y falla a mitad de la prueba y se recupera
+
+Cada escenario arranca un servidor nuevo (caché y métricas vacías) y produce
+throughput, percentiles de latencia, tasa de error, llamadas a Finkok y RSS
+máximo por worker. Con --verificar se compara contra benchmarks/thresholds.json
+y se termina con código 1 si algún umbral no se cumple.
+
+Ejecutar con:
+    python benchmarks/load_scenarios.py --salida reporte.json --verificar
+    python benchmarks/load_scenarios.py --escenarios rfc_caliente,degradacion --servidor asgi
+"""
+
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import threading
+import time
+
+import httpx
+
+from common import (RAIZ, detener_proceso, entorno_certificados, generar_rfcs, iniciar_fake_finkok,
+                    iniciar_proceso, percentiles, puerto_libre, rss_arbol, rutas_aisladas)
+
+UMBRALES = os.path.join(RAIZ, 'benchmarks', 'thresholds.json')
+
+# modo 'cerrado': `concurrencia` clientes que envían la siguiente petición al
+# recibir la anterior. modo 'abierto': llegadas a `tasa` por segundo (con
+# ráfagas de `tasa_rafaga` durante `duracion_rafaga` cada `periodo_rafaga`),
+# independientes de lo que tarde el servidor.
+ESCENARIOS = {
+    'estable': {
+        'endpoint': '/consultar_sat',
+        'modo': 'cerrado',
+        'concurrencia': 8,
+        'rfcs': 'uniforme',
+        'fake': {'latencia_ms': 150, 'distribucion': 'lognormal', 'dispersion': 0.3},
+    },
+    'estable_multiple': {
+        'endpoint': '/consultar_multiple',
+        'modo': 'cerrado',
+        'concurrencia': 4,
+        'tamano_lote': 10,
+        'rfcs': 'uniforme',
+        'fake': {'latencia_ms': 150, 'distribucion': 'lognormal', 'dispersion': 0.3},
+    },
+    'rafaga': {
+        'endpoint': '/consultar_sat',
+        'modo': 'abierto',
+        'tasa': 5,
+        'tasa_rafaga': 40,
+        'duracion_rafaga': 2.0,
+        'periodo_rafaga': 6.0,
+        'rfcs': 'uniforme',
+        'fake': {'latencia_ms': 150, 'distribucion': 'lognormal', 'dispersion': 0.3},
+    },
+    'rfc_caliente': {
+        'endpoint': '/consultar_sat',
+        'modo': 'cerrado',
+        'concurrencia': 16,
+        'rfcs': 'zipf',
+        'zipf_s': 1.1,
+        'fake': {'latencia_ms': 150, 'distribucion': 'lognormal', 'dispersion': 0.3},
+    },
+    'degradacion': {
+        'endpoint': '/consultar_sat',
+        'modo': 'cerrado',
+        'concurrencia': 8,
+        'rfcs': 'uniforme',
+        'fake': {'latencia_ms': 150, 'distribucion': 'lognormal', 'dispersion': 0.3},
+        # Fracción de la duración en la que empieza y termina la degradación
+        'degradacion': {
+            'inicio': 0.3,
+            'fin': 0.7,
+            'fake': {'latencia_ms': 1500, 'tasa_error': 0.3, 'tasa_timeout': 0.05, 'timeout_s': 10},
+        },
+        'entorno': {'FINKOK_READ_TIMEOUT': '3'},
+    },
+}
+
+
+class SelectorRFC:
+    """Elige el siguiente RFC según la distribución del escenario"""
+
+    def __init__(self, rfcs, distribucion='uniforme', zipf_s=1.1, semilla=11):
+        self.rfcs = rfcs
+        self.distribucion = distribucion
+        self.aleatorio = random.Random(semilla)
+        self._ciclo = itertools.cycle(rfcs)
+        if distribucion == 'zipf':
+            acumulado = 0.0
+            self._acumulados = []
+            for rango in range(1, len(rfcs) + 1):
+                acumulado += 1.0 / rango ** zipf_s
+                self._acumulados.append(acumulado)
+
+    def siguiente(self):
+        if self.distribucion == 'zipf':
+            x = self.aleatorio.random() * self._acumulados[-1]
+            return self.rfcs[bisect.bisect_left(self._acumulados, x)]
+        return next(self._ciclo)
+
+    def lote(self, n):
+        return [self.siguiente() for _ in range(n)]
+
+
+class MuestreoRSS:
+    """Muestrea en segundo plano el RSS de los workers y guarda el máximo por pid"""
+
+    def __init__(self, pid_maestro, intervalo=0.5):
+        self.pid_maestro = pid_maestro
+        self.intervalo = intervalo
+        self.maximos = {}
+        self._detener = threading.Event()
+        self._hilo = threading.Thread(target=self._ciclo, daemon=True)
+
+    def _ciclo(self):
+        while not self._detener.is_set():
+            self._muestra()
+            self._detener.wait(self.intervalo)
+
+    def _muestra(self):
+        for pid, rss in rss_arbol(self.pid_maestro).items():
+            if pid != self.pid_maestro and rss > self.maximos.get(pid, 0):
+                self.maximos[pid] = rss
+
+    def __enter__(self):
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._detener.set()
+        self._hilo.join()
+        self._muestra()
+
+
+async def _peticion(cliente, escenario, selector, inicio_prueba, registros):
+    if escenario['endpoint'] == '/consultar_multiple':
+        cuerpo = {'rfcs': selector.lote(escenario.get('tamano_lote', 10))}
+    else:
+        cuerpo = {'rfc': selector.siguiente()}
+
+    t0 = time.perf_counter()
+    errores_rfc = 0
+    try:
+        r = await cliente.post(escenario['endpoint'], json=cuerpo)
+        clave = str(r.status_code)
+        if r.status_code == 200 and escenario['endpoint'] == '/consultar_multiple':
+            errores_rfc = sum(1 for x in r.json()['resultados'] if 'error' in x)
+    except httpx.HTTPError as e:
+        clave = type(e).__name__
+    registros.append((t0 - inicio_prueba, time.perf_counter() - t0, clave, errores_rfc))
+
+
+async def _carga_cerrada(cliente, escenario, selector, duracion, inicio, registros):
+    fin = inicio + duracion
+
+    async def usuario():
+        while time.perf_counter() < fin:
+            await _peticion(cliente, escenario, selector, inicio, registros)
+
+    await asyncio.gather(*(usuario() for _ in range(escenario['concurrencia'])))
+
+
+async def _carga_abierta(cliente, escenario, selector, duracion, inicio, registros, max_en_vuelo=2000):
+    tareas = set()
+    descartadas = 0
+    t = 0.0
+    while t < duracion:
+        en_rafaga = (escenario.get('tasa_rafaga')
+                     and t % escenario['periodo_rafaga'] >= escenario['periodo_rafaga'] - escenario['duracion_rafaga'])
+        tasa = escenario['tasa_rafaga'] if en_rafaga else escenario['tasa']
+        t += 1.0 / tasa
+        espera = inicio + t - time.perf_counter()
+        if espera > 0:
+            await asyncio.sleep(espera)
+        if len(tareas) >= max_en_vuelo:
+            descartadas += 1
+            continue
+        tarea = asyncio.ensure_future(_peticion(cliente, escenario, selector, inicio, registros))
+        tareas.add(tarea)
+        tarea.add_done_callback(tareas.discard)
+    if tareas:
+        await asyncio.wait(tareas)
+    return descartadas
+
+
+async def _cambios_programados(url_fake, cambios, inicio):
+    async with httpx.AsyncClient() as cliente:
+        for t, config_fake in cambios:
+            espera = inicio + t - time.perf_counter()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            await cliente.post(f"{url_fake}/__config", json=config_fake)
+
+
+async def generar_carga(url, url_fake, escenario, selector, duracion):
+    """Ejecuta la carga del escenario; devuelve (registros, descartadas, segundos)"""
+    registros = []
+    limites = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+    async with httpx.AsyncClient(base_url=url, limits=limites, timeout=120) as cliente:
+        inicio = time.perf_counter()
+        cambios = []
+        if 'degradacion' in escenario:
+            d = escenario['degradacion']
+            cambios = [(d['inicio'] * duracion, d['fake']),
+                       (d['fin'] * duracion, {'tasa_error': 0.0, 'tasa_timeout': 0.0, **escenario['fake']})]
+        programados = asyncio.ensure_future(_cambios_programados(url_fake, cambios, inicio))
+
+        descartadas = 0
+        if escenario['modo'] == 'abierto':
+            descartadas = await _carga_abierta(cliente, escenario, selector, duracion, inicio, registros)
+        else:
+            await _carga_cerrada(cliente, escenario, selector, duracion, inicio, registros)
+        await programados
+        return registros, descartadas, time.perf_counter() - inicio
+
+
+def resumir(registros, segundos, descartadas=0):
+    """Throughput, percentiles y tasa de error de un conjunto de registros"""
+    latencias = [r[1] for r in registros]
+    estados = {}
+    errores = 0
+    errores_rfc = 0
+    for _, _, clave, n in registros:
+        estados[clave] = estados.get(clave, 0) + 1
+        if clave != '200':
+            errores += 1
+        errores_rfc += n
+    total = len(registros)
+    resumen = {
+        'peticiones': total,
+        'throughput_rps': round(total / segundos, 2) if segundos else 0.0,
+        **percentiles(latencias),
+        'max_ms': round(max(latencias) * 1000, 1) if latencias else None,
+        'tasa_error': round(errores / total, 4) if total else 0.0,
+        'estados': estados,
+    }
+    if errores_rfc:
+        resumen['errores_por_rfc'] = errores_rfc
+    if descartadas:
+        resumen['descartadas'] = descartadas
+    return resumen
+
+
+def _fases(escenario, registros, duracion):
+    """Resumen antes, durante y después de la degradación de Finkok"""
+    d = escenario['degradacion']
+    limites = (('antes', 0, d['inicio'] * duracion),
+               ('durante', d['inicio'] * duracion, d['fin'] * duracion),
+               ('despues', d['fin'] * duracion, duracion))
+    return {
+        nombre: resumir([r for r in registros if desde <= r[0] < hasta], hasta - desde)
+        for nombre, desde, hasta in limites
+    }
+
+
+def ejecutar_escenario(nombre, args, url_fake, rfcs):
+    escenario = ESCENARIOS[nombre]
+    duracion = args.duracion
+    httpx.post(f"{url_fake}/__config", json={'tasa_error': 0.0, 'tasa_timeout': 0.0, **escenario['fake']})
+
+    directorio, certificados = entorno_certificados()
+    entorno = {
+        **certificados,
+        **rutas_aisladas(directorio),
+        'FINKOK_API_URL': f"{url_fake}/status",
+        # Todas las peticiones salen de la misma IP: sin límite por cliente
+        'RATE_LIMIT': '0',
+        **escenario.get('entorno', {}),
+    }
+    puerto = puerto_libre()
+    if args.servidor == 'asgi':
+        comando = ['gunicorn', '-w', str(args.workers), '-k', 'uvicorn.workers.UvicornWorker',
+                   '-b', f'127.0.0.1:{puerto}', '--timeout', '60', 'asgi_app:app']
+    else:
+        # Clase, workers e hilos fijos (no el perfil de gunicorn.conf.py) para comparar corridas
+        comando = ['gunicorn', '-w', str(args.workers), '-k', 'gthread' if args.threads > 1 else 'sync',
+                   '--threads', str(args.threads), '-b', f'127.0.0.1:{puerto}', '--timeout', '60', 'app:app']
+
+    servidor = iniciar_proceso(comando, entorno, puerto)
+    try:
+        selector = SelectorRFC(rfcs, escenario['rfcs'], escenario.get('zipf_s', 1.1))
+        httpx.get(f"{url_fake}/__stats?reiniciar=1")
+        with MuestreoRSS(servidor.pid) as rss:
+            registros, descartadas, segundos = asyncio.run(
+                generar_carga(f'http://127.0.0.1:{puerto}', url_fake, escenario, selector, duracion)
+            )
+        resultado = resumir(registros, segundos, descartadas)
+        resultado['upstream'] = httpx.get(f"{url_fake}/__stats?reiniciar=1").json()
+        resultado['rss_por_worker_kb'] = sorted(rss.maximos.values())
+        if 'degradacion' in escenario:
+            resultado['fases'] = _fases(escenario, registros, duracion)
+        return resultado
+    finally:
+        detener_proceso(servidor)
+        shutil.rmtree(directorio, ignore_errors=True)
+
+
+def verificar(reporte, umbrales):
+    """Lista de umbrales incumplidos ('escenario: métrica valor fuera de límite')"""
+    fallas = []
+    for nombre, resultado in reporte['resultados'].items():
+        limites = umbrales.get('escenarios', {}).get(nombre, {})
+        valores = {
+            'throughput_rps': resultado['throughput_rps'],
+            'p95_ms': resultado['p95_ms'],
+            'p99_ms': resultado['p99_ms'],
+            'tasa_error': resultado['tasa_error'],
+            'rss_worker_kb': max(resultado['rss_por_worker_kb'] or [0]),
+            'llamadas_upstream_por_peticion': (
+                resultado['upstream']['peticiones'] / resultado['peticiones'] if resultado['peticiones'] else 0
+            ),
+        }
+        for clave, limite in limites.items():
+            tipo, _, metrica = clave.partition('_')
+            valor = valores.get(metrica)
+            if valor is None:
+                continue
+            if (tipo == 'min' and valor < limite) or (tipo == 'max' and valor > limite):
+                fallas.append(f"{nombre}: {metrica} = {round(valor, 3)} (límite {tipo} {limite})")
+    return fallas
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Escenarios de carga del Monitor SAT')
+    parser.add_argument('--escenarios', default=','.join(ESCENARIOS))
+    parser.add_argument('--servidor', choices=('wsgi', 'asgi'), default='wsgi')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=1, help='Hilos por worker en modo WSGI (gthread)')
+    parser.add_argument('--duracion', type=float, default=15.0, help='Segundos por escenario')
+    parser.add_argument('--rfcs', type=int, default=20000, help='Tamaño del universo de RFCs')
+    parser.add_argument('--salida', help='Archivo JSON para el reporte')
+    parser.add_argument('--verificar', action='store_true', help='Comparar contra thresholds.json')
+    parser.add_argument('--umbrales', default=UMBRALES)
+    args = parser.parse_args()
+
+    nombres = [n for n in args.escenarios.split(',') if n]
+    desconocidos = [n for n in nombres if n not in ESCENARIOS]
+    if desconocidos:
+        parser.error(f"Escenarios desconocidos: {', '.join(desconocidos)}")
+
+    puerto_fake = puerto_libre()
+    fake = iniciar_fake_finkok(puerto_fake)
+    url_fake = f'http://127.0.0.1:{puerto_fake}'
+    rfcs = generar_rfcs(args.rfcs)
+
+    reporte = {
+        'parametros': {k: v for k, v in vars(args).items() if k not in ('salida', 'umbrales')},
+        'cpus': os.cpu_count(),
+        'resultados': {},
+    }
+    try:
+        for nombre in nombres:
+            print(f"Escenario {nombre}...", file=sys.stderr, flush=True)
+            reporte['resultados'][nombre] = ejecutar_escenario(nombre, args, url_fake, rfcs)
+    finally:
+        detener_proceso(fake)
+
+    codigo = 0
+    if args.verificar:
+        with open(args.umbrales) as f:
+            fallas = verificar(reporte, json.load(f))
+        reporte['umbrales_incumplidos'] = fallas
+        codigo = 1 if fallas else 0
+
+    texto = json.dumps(reporte, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            f.write(texto + '\n')
+    print(texto)
+    sys.exit(codigo)
+
+
+if __name__ == '__main__':
+    main()
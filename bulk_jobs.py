@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+"""
+Monitoreo masivo de RFCs a partir de archivos CSV o JSONL.
+
+Los RFCs se leen en streaming, se consultan con concurrencia y tasa
+limitadas y los resultados se escriben como NDJSON en el orden de entrada.
+El progreso se guarda en un checkpoint para poder reanudar el trabajo.
+
+Uso:
+    python bulk_jobs.py cartera.csv -o resultados.ndjson --concurrencia 5 --tasa 10
+"""
+
+import argparse
+import csv
+import fcntl
+import functools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+FORMATOS = ('csv', 'jsonl')
+
+
+class EntradaDemasiadoGrande(ValueError):
+    """La entrada de un trabajo supera el tamaño máximo permitido"""
+
+
+def detectar_formato(ruta):
+    """Deduce el formato a partir de la extensión del archivo"""
+    extension = os.path.splitext(ruta)[1].lower()
+    if extension in ('.jsonl', '.ndjson', '.json'):
+        return 'jsonl'
+    return 'csv'
+
+
+def leer_rfcs(archivo, formato):
+    """Genera los RFCs de un archivo de texto abierto, sin cargarlo completo en memoria"""
+    if formato == 'jsonl':
+        for linea in archivo:
+            linea = linea.strip()
+            if not linea:
+                continue
+            try:
+                registro = json.loads(linea)
+            except ValueError:
+                yield linea
+                continue
+            if isinstance(registro, dict):
+                yield registro.get('rfc') or ''
+            else:
+                yield str(registro)
+        return
+
+    lector = csv.reader(archivo)
+    columna = 0
+    primera = True
+    for fila in lector:
+        if not fila:
+            continue
+        if primera:
+            primera = False
+            # Si hay encabezado con una columna "rfc", se usa esa columna
+            encabezados = [c.strip().lower() for c in fila]
+            if 'rfc' in encabezados:
+                columna = encabezados.index('rfc')
+                continue
+        yield fila[columna] if columna < len(fila) else ''
+
+
+def crear_procesador(monitor, max_edad=0):
+    """Devuelve la función que normaliza, valida y consulta un RFC de la entrada.
+
+    `max_edad` es la antigüedad máxima del resultado de respaldo que se acepta
+    si Finkok falla (0: siempre el resultado de la consulta).
+    """
+    def procesar(rfc):
+        rfc = (rfc or '').strip().upper()
+        motivo = monitor.motivo_rechazo(rfc)
+        if motivo is not None:
+            return {'rfc': rfc, 'error': 'RFC inválido', 'motivo': motivo}
+        return monitor.consultar_rfc(rfc, max_edad)
+    return procesar
+
+
+def _guardar_json(ruta, datos):
+    # Escritura atómica: el checkpoint nunca queda a medias
+    temporal = f"{ruta}.tmp"
+    with open(temporal, 'w') as f:
+        json.dump(datos, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporal, ruta)
+
+
+def leer_estado(ruta):
+    try:
+        with open(ruta) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def ejecutar_lote(rfcs, procesar, ruta_salida, ruta_estado, concurrencia=5, tasa=0,
+                  checkpoint_cada=50, extra_estado=None, cobrar=None, limitador=None):
+    """Procesa un iterable de RFCs escribiendo un NDJSON ordenado y reanudable.
+
+    `procesar(rfc)` devuelve el resultado (dict) de un RFC. Como máximo hay
+    `concurrencia * 2` resultados en memoria a la vez, sin importar el tamaño
+    de la entrada. `cobrar()`, si se indica, se llama antes de consultar cada
+    RFC pendiente y puede bloquear (p. ej. hasta que haya cuota del cliente).
+    Un `limitador` (TokenBucket) reemplaza la tasa propia del lote para
+    repartir una sola tasa entre varios lotes.
+    """
+    estado = leer_estado(ruta_estado) or {}
+    ya_procesados = estado.get('procesados', 0)
+    offset = estado.get('offset_salida', 0)
+    errores = estado.get('errores', 0)
+    estado.update(extra_estado or {})
+    estado.update({'estado': 'en_proceso', 'pid': os.getpid()})
+
+    if ya_procesados:
+        logger.info(f"Reanudando trabajo desde el registro {ya_procesados}")
+
+    if limitador is None:
+        limitador = TokenBucket(tasa)
+    procesados = ya_procesados
+    modo = 'r+b' if os.path.exists(ruta_salida) else 'wb'
+
+    def guardar_checkpoint(final=None):
+        estado.update({
+            'procesados': procesados,
+            'errores': errores,
+            'offset_salida': salida.tell(),
+            'actualizado': datetime.now().isoformat()
+        })
+        if final:
+            estado['estado'] = final
+        _guardar_json(ruta_estado, estado)
+
+    with open(ruta_salida, modo) as salida, \
+            ThreadPoolExecutor(max_workers=concurrencia, thread_name_prefix='lote-sat') as executor:
+        # Se descarta cualquier resultado escrito después del último checkpoint
+        salida.seek(offset)
+        salida.truncate()
+
+        en_vuelo = deque()
+
+        def escribir(siguiente):
+            nonlocal procesados, errores
+            rfc, futuro = siguiente
+            try:
+                resultado = futuro.result()
+            except Exception as e:
+                logger.error(f"Error procesando {rfc}: {str(e)}")
+                resultado = {'rfc': rfc, 'error': f"Error interno: {str(e)}"}
+            if 'error' in resultado:
+                errores += 1
+            salida.write(json.dumps(resultado, ensure_ascii=False).encode() + b'\n')
+            procesados += 1
+            if procesados % checkpoint_cada == 0:
+                salida.flush()
+                guardar_checkpoint()
+
+        try:
+            for indice, rfc in enumerate(rfcs):
+                if indice < ya_procesados:
+                    continue
+                limitador.adquirir()
+                if cobrar is not None:
+                    cobrar()
+                en_vuelo.append((rfc, executor.submit(procesar, rfc)))
+                if len(en_vuelo) >= concurrencia * 2:
+                    escribir(en_vuelo.popleft())
+
+            while en_vuelo:
+                escribir(en_vuelo.popleft())
+        except BaseException:
+            for _, futuro in en_vuelo:
+                futuro.cancel()
+            salida.flush()
+            guardar_checkpoint('interrumpido')
+            raise
+
+        salida.flush()
+        guardar_checkpoint('completado')
+
+    return estado
+
+
+class JobManager:
+    """Administra trabajos masivos en segundo plano dentro de un directorio.
+
+    Cada trabajo vive en <directorio>/<id>/ con la entrada, los resultados
+    NDJSON y el estado en JSON, por lo que cualquier worker puede consultarlo.
+    Quien ejecuta un trabajo mantiene un flock sobre su candado: ningún otro
+    worker puede reanudarlo mientras tanto, y si el proceso muere el candado
+    se libera y el trabajo se puede reanudar desde su checkpoint.
+
+    Todos los trabajos del proceso comparten la tasa `tasa`. Con
+    `max_concurrentes`, como mucho esa cantidad de trabajos se ejecuta a la
+    vez entre todos los workers (un flock por turno en <directorio>/turnos/);
+    los demás esperan en cola, en orden de llegada dentro de cada worker.
+    Con `cobrar`, cada RFC de un trabajo se cobra con `cobrar(cliente)` al
+    cliente que lo creó, también al reanudarlo. `max_bytes` limita el tamaño
+    de la entrada (0: sin límite).
+    """
+
+    def __init__(self, directorio, procesar, concurrencia=5, tasa=0, cobrar=None,
+                 max_concurrentes=0, max_bytes=0):
+        self.directorio = directorio
+        self.procesar = procesar
+        self.concurrencia = concurrencia
+        self.tasa = tasa
+        self.cobrar = cobrar
+        self.max_concurrentes = max_concurrentes
+        self.max_bytes = max_bytes
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        # El despachador no sobrevive a fork(): cada worker arranca el suyo al encolar
+        self._limitador = TokenBucket(self.tasa)
+        self._condicion = threading.Condition()
+        self._pendientes = deque()
+        self._despachador = None
+
+    def _rutas(self, job_id):
+        base = os.path.join(self.directorio, job_id)
+        return {
+            'base': base,
+            'salida': os.path.join(base, 'resultados.ndjson'),
+            'estado': os.path.join(base, 'estado.json'),
+            'candado': os.path.join(base, 'ejecucion.lock'),
+        }
+
+    def _bloquear(self, job_id):
+        """Toma el candado del trabajo; None si otro hilo o proceso lo está ejecutando"""
+        candado = open(self._rutas(job_id)['candado'], 'a')
+        try:
+            fcntl.flock(candado, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            candado.close()
+            return None
+        return candado
+
+    def en_ejecucion(self, job_id):
+        """Indica si algún worker está ejecutando el trabajo"""
+        candado = self._bloquear(job_id)
+        if candado is None:
+            return True
+        candado.close()
+        return False
+
+    def _ruta_entrada(self, job_id, formato):
+        return os.path.join(self.directorio, job_id, f"entrada.{formato}")
+
+    @staticmethod
+    def id_valido(job_id):
+        try:
+            return uuid.UUID(job_id).hex == job_id
+        except ValueError:
+            return False
+
+    def crear(self, flujo, formato, cliente=None, propietario=None):
+        """Guarda la entrada (un flujo binario) en disco y arranca el trabajo.
+
+        Lanza EntradaDemasiadoGrande, sin dejar nada en disco, si la entrada
+        supera `max_bytes`.
+        """
+        if formato not in FORMATOS:
+            raise ValueError(f"Formato no soportado: {formato}")
+
+        job_id = uuid.uuid4().hex
+        rutas = self._rutas(job_id)
+        os.makedirs(rutas['base'], exist_ok=True)
+
+        leidos = 0
+        with open(self._ruta_entrada(job_id, formato), 'wb') as destino:
+            while True:
+                bloque = flujo.read(64 * 1024)
+                if not bloque:
+                    break
+                leidos += len(bloque)
+                if self.max_bytes > 0 and leidos > self.max_bytes:
+                    break
+                destino.write(bloque)
+        if self.max_bytes > 0 and leidos > self.max_bytes:
+            shutil.rmtree(rutas['base'], ignore_errors=True)
+            raise EntradaDemasiadoGrande(f"La entrada excede el máximo de {self.max_bytes} bytes")
+
+        _guardar_json(rutas['estado'], {
+            'id': job_id,
+            'formato': formato,
+            'cliente': cliente,
+            'propietario': propietario,
+            'estado': 'en_cola',
+            'procesados': 0,
+            'errores': 0,
+            'offset_salida': 0,
+            'creado': datetime.now().isoformat()
+        })
+        self.iniciar(job_id)
+        return job_id
+
+    def iniciar(self, job_id):
+        """Arranca (o reanuda) un trabajo en un hilo de fondo; False si ya se está ejecutando.
+
+        Si ya corren `max_concurrentes` trabajos, el trabajo queda en cola
+        (conservando su candado) hasta que se libere un turno.
+        """
+        candado = self._bloquear(job_id)
+        if candado is None:
+            return False
+        if self.max_concurrentes <= 0:
+            self._arrancar(job_id, candado, None)
+            return True
+
+        ruta_estado = self._rutas(job_id)['estado']
+        estado = leer_estado(ruta_estado) or {}
+        if estado.get('estado') != 'en_cola':
+            estado['estado'] = 'en_cola'
+            _guardar_json(ruta_estado, estado)
+        with self._condicion:
+            self._pendientes.append((job_id, candado))
+            if self._despachador is None:
+                self._despachador = threading.Thread(target=self._despachar, name='jobs-cola', daemon=True)
+                self._despachador.start()
+            self._condicion.notify()
+        return True
+
+    def _despachar(self):
+        while True:
+            with self._condicion:
+                while not self._pendientes:
+                    self._condicion.wait()
+            turno = self._tomar_turno()
+            with self._condicion:
+                job_id, candado = self._pendientes.popleft()
+            self._arrancar(job_id, candado, turno)
+
+    def _tomar_turno(self):
+        """Bloquea hasta tomar uno de los `max_concurrentes` turnos, comunes a todos los workers"""
+        directorio = os.path.join(self.directorio, 'turnos')
+        os.makedirs(directorio, exist_ok=True)
+        while True:
+            for numero in range(self.max_concurrentes):
+                turno = open(os.path.join(directorio, f"{numero}.lock"), 'a')
+                try:
+                    fcntl.flock(turno, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    turno.close()
+                    continue
+                return turno
+            time.sleep(1.0)
+
+    def _arrancar(self, job_id, candado, turno):
+        threading.Thread(
+            target=self._ejecutar, args=(job_id, candado, turno), name=f"job-{job_id[:8]}", daemon=True
+        ).start()
+
+    def _ejecutar(self, job_id, candado, turno=None):
+        with candado:
+            try:
+                self._ejecutar_lote(job_id)
+            finally:
+                if turno is not None:
+                    turno.close()
+
+    def reanudar_interrumpidos(self):
+        """Reanuda los trabajos que quedaron a medias porque su worker terminó (p. ej. al
+        reciclarse); los que otro worker está ejecutando o tiene en cola se dejan. Devuelve
+        cuántos se reanudaron."""
+        try:
+            entradas = [entrada.name for entrada in os.scandir(self.directorio) if entrada.is_dir()]
+        except FileNotFoundError:
+            return 0
+        reanudados = 0
+        for job_id in entradas:
+            if not self.id_valido(job_id):
+                continue
+            estado = leer_estado(self._rutas(job_id)['estado'])
+            if estado is not None and estado.get('estado') in ('en_cola', 'en_proceso') and self.iniciar(job_id):
+                logger.info(f"Reanudando trabajo {job_id}")
+                reanudados += 1
+        return reanudados
+
+    def _ejecutar_lote(self, job_id):
+        rutas = self._rutas(job_id)
+        estado = leer_estado(rutas['estado']) or {}
+        formato = estado.get('formato', 'csv')
+        cliente = estado.get('cliente')
+        cobrar = functools.partial(self.cobrar, cliente) if self.cobrar is not None else None
+        try:
+            with open(self._ruta_entrada(job_id, formato), newline='', encoding='utf-8-sig') as entrada:
+                ejecutar_lote(
+                    leer_rfcs(entrada, formato),
+                    self.procesar,
+                    rutas['salida'],
+                    rutas['estado'],
+                    concurrencia=self.concurrencia,
+                    cobrar=cobrar,
+                    limitador=self._limitador
+                )
+            logger.info(f"Trabajo {job_id} completado")
+        except Exception as e:
+            logger.error(f"Error en trabajo {job_id}: {str(e)}")
+            estado = leer_estado(rutas['estado']) or {}
+            estado.update({'estado': 'error', 'error': str(e)})
+            _guardar_json(rutas['estado'], estado)
+
+    def estado(self, job_id):
+        """Devuelve el estado del trabajo, o None si no existe"""
+        if not self.id_valido(job_id):
+            return None
+        estado = leer_estado(self._rutas(job_id)['estado'])
+        if estado is not None and estado.get('estado') in ('en_cola', 'en_proceso') and not self.en_ejecucion(job_id):
+            # El worker que lo ejecutaba (o lo tenía en cola) terminó sin cerrar el checkpoint
+            estado['estado'] = 'interrumpido'
+        return estado
+
+    def ruta_resultados(self, job_id):
+        if not self.id_valido(job_id):
+            return None
+        ruta = self._rutas(job_id)['salida']
+        return ruta if os.path.exists(ruta) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitoreo masivo de RFCs (CSV o JSONL → NDJSON)')
+    parser.add_argument('entrada', help='Archivo CSV o JSONL con los RFCs')
+    parser.add_argument('-o', '--salida', help='Archivo NDJSON de resultados')
+    parser.add_argument('--formato', choices=FORMATOS, help='Formato de la entrada (por defecto según la extensión)')
+    parser.add_argument('--concurrencia', type=int, default=5, help='Consultas simultáneas a Finkok')
+    parser.add_argument('--tasa', type=float, default=0, help='Máximo de consultas por segundo (0 = sin límite)')
+    parser.add_argument('--checkpoint', help='Archivo de checkpoint (por defecto <salida>.estado.json)')
+    parser.add_argument('--reiniciar', action='store_true', help='Ignorar el checkpoint y empezar de cero')
+    args = parser.parse_args()
+
+    from app import monitor
+
+    formato = args.formato or detectar_formato(args.entrada)
+    salida = args.salida or f"{os.path.splitext(args.entrada)[0]}.resultados.ndjson"
+    checkpoint = args.checkpoint or f"{salida}.estado.json"
+    if args.reiniciar and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    inicio = time.time()
+    with open(args.entrada, newline='', encoding='utf-8-sig') as entrada:
+        estado = ejecutar_lote(
+            leer_rfcs(entrada, formato), crear_procesador(monitor), salida, checkpoint,
+            concurrencia=args.concurrencia, tasa=args.tasa
+        )
+    print(f"{estado['procesados']} RFCs procesados ({estado['errores']} con error) "
+          f"en {time.time() - inicio:.1f}s → {salida}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import base64
+import logging
+import os
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CertificateStore:
+    """Almacén de certificados e.firma codificados en base64, por RFC.
+
+    Cada worker lee y codifica los archivos una sola vez; solo vuelve a
+    cargarlos cuando cambian su mtime/inode/tamaño o al recibir SIGHUP. Con
+    `certs_dir` se guarda el conjunto de RFCs que tienen .cer y .key propios
+    (acotado por los archivos del directorio, no por los RFCs consultados);
+    el directorio se vuelve a listar cuando cambia su mtime, revisado cada
+    `intervalo_stat` segundos.
+    """
+
+    def __init__(self, cert_path, key_path, certs_dir=None, intervalo_stat=5.0):
+        self.cert_path = cert_path
+        self.key_path = key_path
+        self.certs_dir = certs_dir
+        self.intervalo_stat = intervalo_stat
+        self._entradas = {}
+        # (RFCs con certificado propio, mtime del directorio, generación, revisado)
+        self._propios = (frozenset(), None, None, 0.0)
+        self._lock = threading.Lock()
+        self._generacion = 0
+        self.hits = 0
+        self.recargas = 0
+        self.errores = 0
+
+    def rutas_para(self, rfc=None):
+        """Devuelve las rutas (cert, key) a usar para un RFC"""
+        if not rfc or not self.certs_dir:
+            return self.cert_path, self.key_path
+        if rfc in self._rfcs_propios():
+            return os.path.join(self.certs_dir, f"{rfc}.cer"), os.path.join(self.certs_dir, f"{rfc}.key")
+        return self.cert_path, self.key_path
+
+    def _rfcs_propios(self):
+        """RFCs con .cer y .key en `certs_dir`; solo se vuelve a listar si cambió el directorio"""
+        propios, mtime, generacion, revisado = self._propios
+        ahora = time.monotonic()
+        if generacion == self._generacion and ahora - revisado < self.intervalo_stat:
+            return propios
+        try:
+            actual = os.stat(self.certs_dir).st_mtime_ns
+            if actual != mtime or generacion != self._generacion:
+                cer, key = set(), set()
+                with os.scandir(self.certs_dir) as entradas:
+                    for entrada in entradas:
+                        nombre, extension = os.path.splitext(entrada.name)
+                        if extension == '.cer':
+                            cer.add(nombre)
+                        elif extension == '.key':
+                            key.add(nombre)
+                propios = frozenset(cer & key)
+        except OSError as e:
+            logger.error(f"Error listando {self.certs_dir}: {str(e)}")
+            actual, propios = None, frozenset()
+        # Una sola asignación: los demás hilos ven el conjunto anterior o el nuevo completo
+        self._propios = (propios, actual, self._generacion, ahora)
+        return propios
+
+    @staticmethod
+    def _firma(cert, key):
+        st_cert = os.stat(cert)
+        st_key = os.stat(key)
+        return (
+            st_cert.st_ino, st_cert.st_mtime_ns, st_cert.st_size,
+            st_key.st_ino, st_key.st_mtime_ns, st_key.st_size,
+        )
+
+    def obtener(self, rfc=None):
+        """Devuelve (cert_b64, key_b64) para el RFC, recargando solo si cambió"""
+        rutas = self.rutas_para(rfc)
+        ahora = time.monotonic()
+        entrada = self._entradas.get(rutas)
+
+        # Camino rápido: entrada vigente y revisada hace poco
+        if (entrada is not None and entrada["generacion"] == self._generacion
+                and ahora - entrada["revisado"] < self.intervalo_stat):
+            self.hits += 1
+            return entrada["cert_b64"], entrada["key_b64"]
+
+        with self._lock:
+            try:
+                firma = self._firma(*rutas)
+            except FileNotFoundError:
+                self.errores += 1
+                logger.error("Archivos de certificado no encontrados")
+                return None, None
+            except OSError as e:
+                self.errores += 1
+                logger.error(f"Error cargando certificados: {str(e)}")
+                return None, None
+
+            entrada = self._entradas.get(rutas)
+            if (entrada is not None and entrada["firma"] == firma
+                    and entrada["generacion"] == self._generacion):
+                entrada["revisado"] = ahora
+                self.hits += 1
+                return entrada["cert_b64"], entrada["key_b64"]
+
+            try:
+                cert_b64, key_b64 = self._leer(*rutas)
+            except Exception as e:
+                self.errores += 1
+                logger.error(f"Error cargando certificados: {str(e)}")
+                return None, None
+
+            self._entradas[rutas] = {
+                "cert_b64": cert_b64,
+                "key_b64": key_b64,
+                "firma": firma,
+                "generacion": self._generacion,
+                "revisado": ahora,
+            }
+            self.recargas += 1
+            logger.info(f"Certificado cargado: {rutas[0]}")
+            return cert_b64, key_b64
+
+    @staticmethod
+    def _leer(cert, key):
+        with open(cert, 'rb') as cert_file:
+            cert_data = cert_file.read()
+
+        with open(key, 'rb') as key_file:
+            key_data = key_file.read()
+
+        return base64.b64encode(cert_data).decode(), base64.b64encode(key_data).decode()
+
+    def invalidar(self):
+        """Fuerza la recarga de todos los certificados en el siguiente uso"""
+        self._generacion += 1
+        logger.info("Certificados invalidados; se recargarán en la siguiente consulta")
+
+    def instalar_manejador_sighup(self):
+        """Invalida el almacén al recibir SIGHUP, encadenando el manejador previo"""
+        if not hasattr(signal, 'SIGHUP'):
+            return False
+        if threading.current_thread() is not threading.main_thread():
+            return False
+
+        previo = signal.getsignal(signal.SIGHUP)
+
+        def manejador(signum, frame):
+            self.invalidar()
+            if callable(previo):
+                previo(signum, frame)
+
+        signal.signal(signal.SIGHUP, manejador)
+        return True
+
+    def estadisticas(self):
+        """Contadores de uso del almacén"""
+        return {
+            "hits": self.hits,
+            "recargas": self.recargas,
+            "errores": self.errores,
+            "certificados_cargados": len(self._entradas),
+            "rfcs_con_certificado": len(self._propios[0]),
+        }
@@ -0,0 +1,73 @@
+"""
+Configuración de gunicorn; se carga sola al lanzar gunicorn desde este directorio.
+
+Con `preload_app` la aplicación se importa una vez en el proceso maestro y
+los workers nacen con fork() de un padre ya caliente: no repiten las
+importaciones ni la construcción del monitor, y comparten esas páginas de
+memoria (copy-on-write). `gc.freeze()` evita que el recolector del worker
+toque los objetos heredados y fuerce su copia.
+
+Los hilos de fondo nunca arrancan en el maestro (todos son perezosos y se
+reinician tras fork()); el refresco programado, el de secretos y el manejador
+de SIGHUP de los certificados se instalan en cada worker en `post_worker_init`.
+
+Clase de worker, workers, hilos, timeouts y reciclado salen de
+`server.perfil()` (CPUs, memoria y espera medida a Finkok; ver server.py).
+Bajo `server.py` el socket llega ya abierto (LISTEN_FDS) y cada worker avisa
+por SERVER_AVISO_FD cuando está listo para que la recarga no corte peticiones.
+
+Con GUNICORN_PRELOAD=False se vuelve a importar la aplicación en cada worker.
+Los argumentos de la línea de comandos (--bind, --workers, --timeout) tienen
+prioridad sobre este archivo.
+"""
+
+import gc
+import os
+
+from server import perfil as _calcular_perfil
+from settings import Config as _Config
+
+_perfil = _calcular_perfil(_Config())
+
+bind = _Config.SERVER_BIND
+wsgi_app = _perfil['wsgi_app']
+worker_class = _perfil['worker_class']
+workers = _perfil['workers']
+threads = _perfil['threads']
+timeout = _perfil['timeout']
+graceful_timeout = _perfil['graceful_timeout']
+max_requests = _perfil['max_requests']
+max_requests_jitter = _perfil['max_requests_jitter']
+
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True').lower() == 'true'
+
+
+def when_ready(server):
+    for advertencia in _perfil['advertencias']:
+        server.log.warning(advertencia)
+    if preload_app:
+        # Lo importado hasta aquí queda fuera del recolector en todos los workers
+        gc.collect()
+        gc.freeze()
+
+
+def post_worker_init(worker):
+    import app
+
+    # gunicorn restablece las señales del worker después del fork: se reinstala el manejador
+    app.monitor.certificados.instalar_manejador_sighup()
+    app.monitor.secretos.iniciar()
+    if app.monitor.programador is not None:
+        app.monitor.programador.iniciar()
+    # Los trabajos de un worker reciclado (max_requests) o caído mueren con él: se
+    # reanudan desde su checkpoint en el worker que lo reemplaza
+    if app.jobs is not None:
+        app.jobs.reanudar_interrumpidos()
+
+    # Aviso al supervisor (server.py) de que este worker ya puede atender
+    aviso = os.getenv('SERVER_AVISO_FD')
+    if aviso:
+        try:
+            os.write(int(aviso), b'.')
+        except OSError:
+            pass
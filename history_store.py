@@ -0,0 +1,271 @@
+"""
+Historial persistente de estatus SAT por RFC.
+
+Cada consulta a Finkok produce una instantánea (pendientes, vencidas,
+discrepancias, total_facturas, monto_total). Las instantáneas se encolan y
+un hilo las escribe por lotes en SQLite (modo WAL), fuera del camino de la
+petición. Las instantáneas iguales a la anterior del mismo RFC no agregan
+fila: extienden el intervalo de la última (codificación por tramos), así que
+consultar miles de RFCs cada hora sin cambios no hace crecer el archivo.
+
+Las lecturas no esperan a la cola: ven lo escrito por todos los workers hasta
+el último lote (a lo sumo `intervalo_escritura` segundos de retraso).
+"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CAMPOS = ('pendientes', 'vencidas', 'discrepancias', 'total_facturas', 'monto_total')
+
+
+class HistoryStore:
+    """Historial de instantáneas por RFC con escritura por lotes en segundo plano.
+
+    Cada fila es un tramo: los mismos valores observados `observaciones`
+    veces entre `desde` y `hasta` (epoch en segundos).
+    """
+
+    def __init__(self, ruta, intervalo_escritura=1.0, tamano_lote=500, max_pendientes=10000):
+        self.ruta = ruta
+        self.intervalo_escritura = intervalo_escritura
+        self.tamano_lote = tamano_lote
+        self.max_pendientes = max_pendientes
+        self.escritas = 0
+        self.tramos_nuevos = 0
+        self.descartadas = 0
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        # Conexión temporal: las de trabajo se abren por hilo y no cruzan fork()
+        conexion = sqlite3.connect(ruta, timeout=10, isolation_level=None)
+        try:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS historial ("
+                " id INTEGER PRIMARY KEY,"
+                " rfc TEXT NOT NULL,"
+                " desde REAL NOT NULL,"
+                " hasta REAL NOT NULL,"
+                " observaciones INTEGER NOT NULL,"
+                " pendientes INTEGER NOT NULL,"
+                " vencidas INTEGER NOT NULL,"
+                " discrepancias INTEGER NOT NULL,"
+                " total_facturas INTEGER NOT NULL,"
+                " monto_total REAL NOT NULL)"
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS historial_rfc_desde ON historial (rfc, desde)")
+            conexion.execute("CREATE INDEX IF NOT EXISTS historial_desde ON historial (desde)")
+        finally:
+            conexion.close()
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+        atexit.register(self.vaciar)
+
+    def _reiniciar(self):
+        # También se usa tras un fork(): cola, hilo y conexiones propios del proceso
+        self._local = threading.local()
+        self._pendientes = []
+        self._lock = threading.Lock()
+        self._lock_escritura = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def _conexion(self):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    # Escritura
+
+    def registrar(self, rfc, datos, momento=None):
+        """Encola una instantánea; no toca el disco en el hilo de la petición"""
+        fila = (rfc, momento if momento is not None else time.time()) + tuple(datos.get(c, 0) for c in CAMPOS)
+        with self._lock:
+            if len(self._pendientes) >= self.max_pendientes:
+                self.descartadas += 1
+                return
+            self._pendientes.append(fila)
+            lleno = len(self._pendientes) >= self.tamano_lote
+        self._iniciar_escritor()
+        if lleno:
+            self._despertar.set()
+
+    def _iniciar_escritor(self):
+        if self._hilo is not None:
+            return
+        with self._lock:
+            if self._hilo is not None:
+                return
+
+            def ciclo():
+                while True:
+                    self._despertar.wait(self.intervalo_escritura)
+                    self._despertar.clear()
+                    try:
+                        self.vaciar()
+                    except Exception:
+                        # Un lote con un error inesperado se pierde, pero el hilo sigue escribiendo
+                        logger.exception("Error inesperado escribiendo historial")
+
+            self._hilo = threading.Thread(target=ciclo, name='historial-escritura', daemon=True)
+            self._hilo.start()
+
+    def vaciar(self):
+        """Escribe las instantáneas pendientes en una sola transacción"""
+        with self._lock:
+            lote, self._pendientes = self._pendientes, []
+        if not lote:
+            return
+        with self._lock_escritura:
+            try:
+                self._escribir(lote)
+            except sqlite3.Error as e:
+                logger.error(f"Error escribiendo historial ({len(lote)} instantáneas): {str(e)}")
+
+    def _escribir(self, lote):
+        conexion = self._conexion()
+        # IMMEDIATE: otro worker no puede insertar un tramo del mismo RFC a la vez
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            ultimos = {}
+            nuevos = 0
+            for fila in sorted(lote, key=lambda f: f[1]):
+                rfc, momento, valores = fila[0], fila[1], fila[2:]
+                ultimo = ultimos.get(rfc)
+                if ultimo is None:
+                    ultimo = conexion.execute(
+                        "SELECT id, hasta, pendientes, vencidas, discrepancias, total_facturas, monto_total"
+                        " FROM historial WHERE rfc = ? ORDER BY desde DESC LIMIT 1", (rfc,)
+                    ).fetchone()
+                if ultimo is not None and tuple(ultimo[2:]) == valores:
+                    conexion.execute(
+                        "UPDATE historial SET hasta = max(hasta, ?), observaciones = observaciones + 1"
+                        " WHERE id = ?", (momento, ultimo[0])
+                    )
+                else:
+                    cursor = conexion.execute(
+                        "INSERT INTO historial (rfc, desde, hasta, observaciones, pendientes, vencidas,"
+                        " discrepancias, total_facturas, monto_total) VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?)",
+                        (rfc, momento, momento) + valores
+                    )
+                    ultimo = (cursor.lastrowid, momento) + valores
+                    nuevos += 1
+                ultimos[rfc] = ultimo
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        self.escritas += len(lote)
+        self.tramos_nuevos += nuevos
+
+    # Lectura
+
+    @staticmethod
+    def _tramo(fila):
+        return {
+            'desde': fila[0],
+            'hasta': fila[1],
+            'observaciones': fila[2],
+            'datos': dict(zip(CAMPOS, fila[3:])),
+        }
+
+    def historial(self, rfc, desde=None, hasta=None, limite=1000):
+        """Tramos del RFC que se traslapan con [desde, hasta], del más reciente al más antiguo"""
+        filas = self._conexion().execute(
+            "SELECT desde, hasta, observaciones, pendientes, vencidas, discrepancias, total_facturas,"
+            " monto_total FROM historial WHERE rfc = ? AND desde <= ? AND hasta >= ?"
+            " ORDER BY desde DESC LIMIT ?",
+            (rfc, hasta if hasta is not None else float('inf'), desde if desde is not None else 0.0, limite)
+        ).fetchall()
+        return [self._tramo(fila) for fila in filas]
+
+    def _vigente(self, conexion, rfc, momento=None):
+        """Tramo vigente del RFC en un momento (el último si momento es None)"""
+        if momento is None:
+            fila = conexion.execute(
+                "SELECT desde, hasta, observaciones, pendientes, vencidas, discrepancias, total_facturas,"
+                " monto_total FROM historial WHERE rfc = ? ORDER BY desde DESC LIMIT 1", (rfc,)
+            ).fetchone()
+        else:
+            fila = conexion.execute(
+                "SELECT desde, hasta, observaciones, pendientes, vencidas, discrepancias, total_facturas,"
+                " monto_total FROM historial WHERE rfc = ? AND desde <= ? ORDER BY desde DESC LIMIT 1",
+                (rfc, momento)
+            ).fetchone()
+        return self._tramo(fila) if fila is not None else None
+
+    def cambios(self, rfc, desde):
+        """Qué cambió en el RFC desde el momento `desde` (p. ej. la última revisión).
+
+        Compara el tramo vigente en `desde` contra el más reciente. Devuelve
+        None si no hay historial del RFC.
+        """
+        conexion = self._conexion()
+        actual = self._vigente(conexion, rfc)
+        if actual is None:
+            return None
+        anterior = self._vigente(conexion, rfc, desde)
+        diferencias = {}
+        if anterior is None or anterior['desde'] != actual['desde']:
+            previos = anterior['datos'] if anterior else {}
+            for campo in CAMPOS:
+                antes = previos.get(campo)
+                ahora = actual['datos'][campo]
+                if antes != ahora:
+                    diferencias[campo] = {
+                        'anterior': antes,
+                        'actual': ahora,
+                        'diferencia': round(ahora - antes, 2) if antes is not None else None,
+                    }
+        return {
+            'rfc': rfc,
+            'desde': desde,
+            'cambio': bool(diferencias),
+            'anterior': anterior,
+            'actual': actual,
+            'diferencias': diferencias,
+        }
+
+    def rfcs_con_cambios(self, desde, limite=1000):
+        """RFCs con algún tramo nuevo desde el momento `desde`"""
+        filas = self._conexion().execute(
+            "SELECT rfc, max(desde) FROM historial WHERE desde > ? GROUP BY rfc"
+            " ORDER BY max(desde) DESC LIMIT ?", (desde, limite)
+        ).fetchall()
+        return [fila[0] for fila in filas]
+
+    def estadisticas(self):
+        try:
+            # Nunca se borran filas: max(id) es el total de tramos sin recorrer la tabla
+            tramos = self._conexion().execute("SELECT max(id) FROM historial").fetchone()[0] or 0
+        except sqlite3.Error:
+            tramos = None
+        return {
+            "tramos": tramos,
+            "escritas": self.escritas,
+            "tramos_nuevos": self.tramos_nuevos,
+            "pendientes": len(self._pendientes),
+            "descartadas": self.descartadas,
+        }
+
+
+def crear_historial(config):
+    """Construye el historial a partir de la configuración (None si está deshabilitado)"""
+    if not config.HISTORY_ENABLED:
+        return None
+    return HistoryStore(
+        config.HISTORY_DB_PATH,
+        intervalo_escritura=config.HISTORY_FLUSH_INTERVAL,
+        tamano_lote=config.HISTORY_BATCH,
+        max_pendientes=config.HISTORY_QUEUE_MAX
+    )
@@ -0,0 +1,488 @@
+"""
+Agregador de métricas en proceso.
+
+Cada hilo escribe en su propio fragmento (contadores, histogramas de
+buckets fijos y registros HyperLogLog), así que registrar una métrica no
+toma ningún lock; los fragmentos de hilos ya terminados se pliegan en uno
+compartido. Cada worker vuelca periódicamente su instantánea a un
+directorio compartido (`<pid>-<arranque>.json`) y las lecturas combinan las
+de todos los workers; los archivos de workers muertos se acumulan en
+`retirados.json` y se borran.
+"""
+
+import base64
+import bisect
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Límites de los buckets de latencia (segundos): serie geométrica de 1 ms a ~2 min
+BUCKETS_LATENCIA = tuple(round(0.001 * (1.25 ** i), 6) for i in range(53))
+
+# Precisión del HyperLogLog: 2**12 registros, error estándar ≈ 1.6%
+HLL_P = 12
+HLL_M = 1 << HLL_P
+
+# Instantánea acumulada de los workers que ya terminaron
+RETIRADOS = 'retirados.json'
+
+
+def _dia_actual():
+    # Día local como entero; más barato que construir un datetime en cada registro
+    return int((time.time() - time.timezone) // 86400)
+
+
+def _hll_alpha(m):
+    return 0.7213 / (1 + 1.079 / m)
+
+
+def hll_estimar(registros):
+    """Estimación de cardinalidad a partir de los registros de un HyperLogLog"""
+    m = len(registros)
+    suma = 0.0
+    ceros = 0
+    for r in registros:
+        suma += 2.0 ** -r
+        if r == 0:
+            ceros += 1
+    estimacion = _hll_alpha(m) * m * m / suma
+    if estimacion <= 2.5 * m and ceros:
+        # Corrección para rangos pequeños (conteo lineal)
+        estimacion = m * math.log(m / ceros)
+    return int(round(estimacion))
+
+
+def percentil(buckets, cuenta, p):
+    """Estima el percentil p (0-1) de un histograma por interpolación lineal"""
+    if cuenta == 0:
+        return None
+    objetivo = p * cuenta
+    acumulado = 0
+    for i, n in enumerate(buckets):
+        if n and acumulado + n >= objetivo:
+            inferior = BUCKETS_LATENCIA[i - 1] if i > 0 else 0.0
+            superior = BUCKETS_LATENCIA[i] if i < len(BUCKETS_LATENCIA) else inferior * 1.25
+            return inferior + (superior - inferior) * (objetivo - acumulado) / n
+        acumulado += n
+    return BUCKETS_LATENCIA[-1]
+
+
+class _Fragmento:
+    """Métricas escritas por un solo hilo"""
+
+    __slots__ = ('contadores', 'contadores_dia', 'histogramas', 'hll', 'dia')
+
+    def __init__(self):
+        self.contadores = {}
+        self.contadores_dia = {}
+        self.histogramas = {}
+        self.hll = bytearray(HLL_M)
+        self.dia = _dia_actual()
+
+    def revisar_dia(self):
+        dia = _dia_actual()
+        if dia != self.dia:
+            self.contadores_dia = {}
+            self.hll = bytearray(HLL_M)
+            self.dia = dia
+
+    def absorber(self, otro):
+        """Suma los valores de otro fragmento (de un hilo ya terminado)"""
+        self.revisar_dia()
+        for nombre, valor in otro.contadores.items():
+            self.contadores[nombre] = self.contadores.get(nombre, 0) + valor
+        for nombre, valores in otro.histogramas.items():
+            _sumar_histograma(self.histogramas, nombre, valores)
+        if otro.dia == self.dia:
+            for nombre, valor in otro.contadores_dia.items():
+                self.contadores_dia[nombre] = self.contadores_dia.get(nombre, 0) + valor
+            _max_registros(self.hll, otro.hll)
+
+
+class MetricsRegistry:
+    """Registro de métricas con fragmentos por hilo y agregación entre workers"""
+
+    def __init__(self, directorio=None, intervalo_volcado=5.0, prefijo='monitor_sat'):
+        self.directorio = directorio
+        self.intervalo_volcado = intervalo_volcado
+        self.prefijo = prefijo
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        # También se usa tras un fork(): el hijo empieza con fragmentos propios
+        self._pid = os.getpid()
+        self._inicio = time.time()
+        # pid + hora de arranque: un pid reutilizado no pisa el archivo de un worker muerto
+        self._archivo = f"{self._pid}-{_arranque(self._pid) or int(self._inicio)}.json"
+        self._local = threading.local()
+        # (hilo, fragmento); los de hilos terminados se pliegan en `_terminados`
+        self._fragmentos = []
+        self._terminados = _Fragmento()
+        self._lock = threading.Lock()
+        self._hilo_volcado = None
+
+    def _fragmento(self):
+        fragmento = getattr(self._local, 'fragmento', None)
+        if fragmento is None:
+            fragmento = _Fragmento()
+            with self._lock:
+                self._plegar_terminados()
+                self._fragmentos.append((threading.current_thread(), fragmento))
+            self._local.fragmento = fragmento
+            self._iniciar_volcado()
+        return fragmento
+
+    def _plegar_terminados(self):
+        # Con self._lock tomado. Un hilo terminado ya no escribe en su fragmento:
+        # se suma al compartido y se suelta (los executors de trabajos crean hilos nuevos)
+        vivos = []
+        for hilo, fragmento in self._fragmentos:
+            if hilo.is_alive():
+                vivos.append((hilo, fragmento))
+            else:
+                self._terminados.absorber(fragmento)
+        self._fragmentos = vivos
+
+    # Registro (camino rápido, sin locks)
+
+    def incrementar(self, nombre, n=1):
+        """Suma n a un contador acumulado desde el arranque"""
+        contadores = self._fragmento().contadores
+        contadores[nombre] = contadores.get(nombre, 0) + n
+
+    def incrementar_dia(self, nombre, n=1):
+        """Suma n a un contador que se reinicia cada día"""
+        fragmento = self._fragmento()
+        fragmento.revisar_dia()
+        fragmento.contadores_dia[nombre] = fragmento.contadores_dia.get(nombre, 0) + n
+
+    def observar(self, nombre, valor):
+        """Registra un valor (en segundos) en un histograma de memoria fija"""
+        histogramas = self._fragmento().histogramas
+        histograma = histogramas.get(nombre)
+        if histograma is None:
+            # Buckets + desbordamiento, seguidos de suma y cuenta
+            histograma = histogramas[nombre] = [0] * (len(BUCKETS_LATENCIA) + 3)
+        histograma[bisect.bisect_left(BUCKETS_LATENCIA, valor)] += 1
+        histograma[-2] += valor
+        histograma[-1] += 1
+
+    def registrar_rfc(self, rfc):
+        """Agrega un RFC al estimador de RFCs distintos del día"""
+        fragmento = self._fragmento()
+        fragmento.revisar_dia()
+        h = int.from_bytes(hashlib.blake2b(rfc.encode(), digest_size=8).digest(), 'big')
+        indice = h >> (64 - HLL_P)
+        resto = h & ((1 << (64 - HLL_P)) - 1)
+        rho = (64 - HLL_P) - resto.bit_length() + 1
+        if rho > fragmento.hll[indice]:
+            fragmento.hll[indice] = rho
+
+    # Lectura y agregación
+
+    def instantanea(self):
+        """Combina los fragmentos de todos los hilos de este worker"""
+        dia = _dia_actual()
+        contadores = {}
+        contadores_dia = {}
+        histogramas = {}
+        hll = bytearray(HLL_M)
+        with self._lock:
+            self._plegar_terminados()
+            fragmentos = [fragmento for _, fragmento in self._fragmentos]
+            # Copia: el compartido solo cambia bajo el lock
+            terminados = _Fragmento()
+            terminados.absorber(self._terminados)
+        fragmentos.append(terminados)
+        for fragmento in fragmentos:
+            for nombre, valor in list(fragmento.contadores.items()):
+                contadores[nombre] = contadores.get(nombre, 0) + valor
+            for nombre, valores in list(fragmento.histogramas.items()):
+                _sumar_histograma(histogramas, nombre, valores)
+            if fragmento.dia == dia:
+                for nombre, valor in list(fragmento.contadores_dia.items()):
+                    contadores_dia[nombre] = contadores_dia.get(nombre, 0) + valor
+                _max_registros(hll, fragmento.hll)
+        return {
+            'pid': self._pid,
+            'inicio': self._inicio,
+            'dia': dia,
+            'contadores': contadores,
+            'contadores_dia': contadores_dia,
+            'histogramas': histogramas,
+            'hll': base64.b64encode(bytes(hll)).decode(),
+        }
+
+    def volcar(self):
+        """Escribe la instantánea de este worker en el directorio compartido"""
+        if not self.directorio:
+            return
+        try:
+            os.makedirs(self.directorio, exist_ok=True)
+            ruta = os.path.join(self.directorio, self._archivo)
+            temporal = f"{ruta}.tmp"
+            with open(temporal, 'w') as f:
+                json.dump(self.instantanea(), f)
+            os.replace(temporal, ruta)
+        except OSError as e:
+            logger.error(f"Error volcando métricas: {str(e)}")
+
+    def _iniciar_volcado(self):
+        if not self.directorio or self._hilo_volcado is not None:
+            return
+        with self._lock:
+            if self._hilo_volcado is not None:
+                return
+
+            def ciclo():
+                while True:
+                    time.sleep(self.intervalo_volcado)
+                    self.volcar()
+
+            self._hilo_volcado = threading.Thread(target=ciclo, name='metricas-volcado', daemon=True)
+            self._hilo_volcado.start()
+
+    def agregado(self):
+        """Combina las instantáneas de todos los workers (incluido este)"""
+        propia = self.instantanea()
+        instantaneas = [propia]
+        workers = 1
+        if self.directorio:
+            self.volcar()
+            muertos = []
+            for ruta in glob.glob(os.path.join(self.directorio, '*.json')):
+                nombre = os.path.basename(ruta)
+                if nombre in (self._archivo, RETIRADOS):
+                    continue
+                if not _archivo_vivo(nombre):
+                    muertos.append(ruta)
+                    continue
+                try:
+                    with open(ruta) as f:
+                        instantaneas.append(json.load(f))
+                    workers += 1
+                except (OSError, ValueError):
+                    continue
+            retirados = self._retirar(muertos, propia['dia'])
+            if retirados is not None:
+                instantaneas.append(retirados)
+
+        contadores = {}
+        contadores_dia = {}
+        histogramas = {}
+        hll = bytearray(HLL_M)
+        inicio = propia['inicio']
+        for inst in instantaneas:
+            # Los workers ya terminados aportan sus conteos, no su hora de inicio
+            if _vivo(inst.get('pid')):
+                inicio = min(inicio, inst.get('inicio', inicio))
+            for nombre, valor in inst['contadores'].items():
+                contadores[nombre] = contadores.get(nombre, 0) + valor
+            for nombre, valores in inst['histogramas'].items():
+                _sumar_histograma(histogramas, nombre, valores)
+            if inst.get('dia') == propia['dia']:
+                for nombre, valor in inst['contadores_dia'].items():
+                    contadores_dia[nombre] = contadores_dia.get(nombre, 0) + valor
+                _max_registros(hll, base64.b64decode(inst['hll']))
+
+        return {
+            'workers': workers,
+            'inicio': inicio,
+            'contadores': contadores,
+            'contadores_dia': contadores_dia,
+            'histogramas': histogramas,
+            'rfcs_distintos_hoy': hll_estimar(hll),
+        }
+
+    def _retirar(self, muertos, dia):
+        """Acumula en RETIRADOS los archivos de workers muertos, los borra y devuelve el acumulado"""
+        ruta = os.path.join(self.directorio, RETIRADOS)
+        try:
+            with open(f"{ruta}.lock", 'a') as candado:
+                # Varios workers pueden leer a la vez: solo uno acumula cada archivo
+                fcntl.flock(candado, fcntl.LOCK_EX)
+                try:
+                    with open(ruta) as f:
+                        retirados = json.load(f)
+                except (OSError, ValueError):
+                    retirados = _instantanea_vacia(dia)
+                if not muertos:
+                    return retirados
+                if retirados.get('dia') != dia:
+                    retirados.update(dia=dia, contadores_dia={}, hll=_instantanea_vacia(dia)['hll'])
+                hll = bytearray(base64.b64decode(retirados['hll']))
+                for muerto in muertos:
+                    try:
+                        with open(muerto) as f:
+                            inst = json.load(f)
+                    except FileNotFoundError:
+                        continue
+                    except (OSError, ValueError):
+                        inst = None
+                    if inst is not None:
+                        for nombre, valor in inst.get('contadores', {}).items():
+                            retirados['contadores'][nombre] = retirados['contadores'].get(nombre, 0) + valor
+                        for nombre, valores in inst.get('histogramas', {}).items():
+                            _sumar_histograma(retirados['histogramas'], nombre, valores)
+                        if inst.get('dia') == dia:
+                            for nombre, valor in inst.get('contadores_dia', {}).items():
+                                retirados['contadores_dia'][nombre] = \
+                                    retirados['contadores_dia'].get(nombre, 0) + valor
+                            _max_registros(hll, base64.b64decode(inst['hll']))
+                retirados['hll'] = base64.b64encode(bytes(hll)).decode()
+                temporal = f"{ruta}.tmp"
+                with open(temporal, 'w') as f:
+                    json.dump(retirados, f)
+                os.replace(temporal, ruta)
+                # Borrar después de guardar el acumulado: si algo falla antes, el archivo sigue ahí
+                for muerto in muertos:
+                    try:
+                        os.remove(muerto)
+                    except FileNotFoundError:
+                        pass
+                return retirados
+        except OSError as e:
+            logger.error(f"Error acumulando métricas de workers terminados: {str(e)}")
+            return None
+
+    @staticmethod
+    def resumen_histograma(valores):
+        """Devuelve cuenta, promedio y p50/p95/p99 (en ms) de un histograma agregado"""
+        buckets, suma, cuenta = valores[:-2], valores[-2], valores[-1]
+
+        def ms(p):
+            valor = percentil(buckets, cuenta, p)
+            return round(valor * 1000, 1) if valor is not None else None
+
+        return {
+            'cuenta': cuenta,
+            'promedio_ms': round(suma / cuenta * 1000, 1) if cuenta else None,
+            'p50_ms': ms(0.50),
+            'p95_ms': ms(0.95),
+            'p99_ms': ms(0.99),
+        }
+
+    def prometheus(self, agregado=None, extra=None):
+        """Formato de exposición de texto de Prometheus"""
+        agregado = agregado or self.agregado()
+        p = self.prefijo
+        lineas = []
+
+        for nombre, valor in sorted(agregado['contadores'].items()):
+            lineas.append(f"# TYPE {p}_{nombre}_total counter")
+            lineas.append(f"{p}_{nombre}_total {valor}")
+
+        for nombre, valor in sorted(agregado['contadores_dia'].items()):
+            lineas.append(f"# TYPE {p}_{nombre}_hoy gauge")
+            lineas.append(f"{p}_{nombre}_hoy {valor}")
+
+        lineas.append(f"# TYPE {p}_rfcs_distintos_hoy gauge")
+        lineas.append(f"{p}_rfcs_distintos_hoy {agregado['rfcs_distintos_hoy']}")
+        lineas.append(f"# TYPE {p}_workers gauge")
+        lineas.append(f"{p}_workers {agregado['workers']}")
+
+        for nombre, valores in sorted(agregado['histogramas'].items()):
+            metrica = f"{p}_{nombre}_segundos"
+            lineas.append(f"# TYPE {metrica} histogram")
+            acumulado = 0
+            for limite, n in zip(BUCKETS_LATENCIA, valores):
+                acumulado += n
+                lineas.append(f'{metrica}_bucket{{le="{limite}"}} {acumulado}')
+            lineas.append(f'{metrica}_bucket{{le="+Inf"}} {valores[-1]}')
+            lineas.append(f"{metrica}_sum {valores[-2]}")
+            lineas.append(f"{metrica}_count {valores[-1]}")
+
+        for nombre, valor in sorted((extra or {}).items()):
+            lineas.append(f"# TYPE {p}_{nombre} gauge")
+            lineas.append(f"{p}_{nombre} {valor}")
+
+        return '\n'.join(lineas) + '\n'
+
+
+def histogramas_volcados(directorio):
+    """Suma los histogramas volcados por los workers en el directorio, sin registrar un worker propio"""
+    histogramas = {}
+    for ruta in glob.glob(os.path.join(directorio, '*.json')):
+        try:
+            with open(ruta) as f:
+                instantanea = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for nombre, valores in instantanea.get('histogramas', {}).items():
+            _sumar_histograma(histogramas, nombre, valores)
+    return histogramas
+
+
+def _instantanea_vacia(dia):
+    return {
+        'pid': None,
+        'dia': dia,
+        'contadores': {},
+        'contadores_dia': {},
+        'histogramas': {},
+        'hll': base64.b64encode(bytes(HLL_M)).decode(),
+    }
+
+
+def _arranque(pid):
+    """Hora de arranque del proceso (ticks desde el boot, /proc/<pid>/stat), o None"""
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            # El nombre del proceso va entre paréntesis y puede contener espacios
+            campos = f.read().rsplit(b')', 1)[1].split()
+        return int(campos[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _archivo_vivo(nombre):
+    """Si el worker que escribe `<pid>-<arranque>.json` (o `<pid>.json`) sigue en marcha"""
+    pid, _, arranque = nombre[:-len('.json')].partition('-')
+    try:
+        pid = int(pid)
+    except ValueError:
+        # No es un volcado de worker: se lee como cualquier otro, sin borrarlo
+        return True
+    if not _vivo(pid):
+        return False
+    if arranque:
+        actual = _arranque(pid)
+        # Mismo pid con otra hora de arranque: el pid se reutilizó
+        if actual is not None and str(actual) != arranque:
+            return False
+    return True
+
+
+def _vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, TypeError):
+        return pid is not None
+    return True
+
+
+def _sumar_histograma(destino, nombre, valores):
+    actual = destino.get(nombre)
+    if actual is None:
+        destino[nombre] = list(valores)
+    else:
+        for i, v in enumerate(valores):
+            actual[i] += v
+
+
+def _max_registros(destino, origen):
+    for i, r in enumerate(origen):
+        if r > destino[i]:
+            destino[i] = r
@@ -0,0 +1,270 @@
+"""
+Agrupación de consultas individuales a Finkok en lotes de varios RFCs.
+
+Las consultas simultáneas que comparten credenciales y certificado se juntan
+durante una ventana corta (unos milisegundos, o hasta `max_lote` RFCs) y se
+envían como una sola petición a `url_lote` con la lista `rfcs`; así el
+certificado y la llave en base64 viajan una vez por lote y no una por RFC.
+Cada llamador recibe solo el resultado de su RFC.
+
+La respuesta del lote debe traer `resultados`, como lista de objetos con
+`rfc` o como objeto indexado por RFC. Si el endpoint de lotes no existe
+(404/405) o responde en otro formato, se deja de intentar durante
+`reintento_deteccion` segundos y cada consulta vuelve a su petición
+individual; un RFC que falte en la respuesta también se consulta solo.
+
+`MicroBatcher` es para hilos (el primero en llegar espera la ventana y envía
+el lote); `AsyncMicroBatcher` es su equivalente para el modo ASGI.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Estados HTTP con los que se concluye que el proveedor no acepta lotes
+NO_SOPORTADO = (404, 405)
+
+# Marca para que el llamador haga su propia petición individual
+INDIVIDUAL = object()
+
+
+def _status(error):
+    return getattr(getattr(error, 'response', None), 'status_code', None)
+
+
+def dividir(respuesta):
+    """{rfc: datos} de la respuesta de un lote, o None si el formato no es el esperado"""
+    resultados = respuesta.get('resultados') if isinstance(respuesta, dict) else None
+    if isinstance(resultados, dict):
+        return resultados
+    if isinstance(resultados, list):
+        return {item['rfc']: item for item in resultados if isinstance(item, dict) and 'rfc' in item}
+    return None
+
+
+class _Pendiente:
+    __slots__ = ('payload', 'evento', 'valor', 'error')
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.evento = None
+        self.valor = None
+        self.error = None
+
+
+class _Agrupador:
+    """Lógica común: grupos por credenciales, armado del lote y reparto de resultados"""
+
+    def __init__(self, url_lote, ventana=0.005, max_lote=50, reintento_deteccion=3600.0):
+        self.url_lote = url_lote
+        self.ventana = ventana
+        self.max_lote = max_lote
+        self.reintento_deteccion = reintento_deteccion
+        self._grupos = {}
+        self._no_soportado_hasta = 0.0
+        self.lotes = 0
+        self.rfcs_en_lotes = 0
+        self.individuales = 0
+        self.no_soportado = 0
+
+    def _activo(self):
+        return self.max_lote > 1 and time.monotonic() >= self._no_soportado_hasta
+
+    @staticmethod
+    def _clave(payload):
+        # Mismas credenciales y certificado: todo el payload salvo el RFC
+        return tuple(sorted((k, v) for k, v in payload.items() if k != 'rfc'))
+
+    def _armar(self, grupo):
+        lote = {k: v for k, v in grupo[0].payload.items() if k != 'rfc'}
+        lote['rfcs'] = [p.payload['rfc'] for p in grupo]
+        self.lotes += 1
+        self.rfcs_en_lotes += len(grupo)
+        return lote
+
+    def _marcar_no_soportado(self, motivo):
+        self.no_soportado += 1
+        self._no_soportado_hasta = time.monotonic() + self.reintento_deteccion
+        logger.warning(f"Finkok no acepta lotes ({motivo}); consultas individuales por "
+                       f"{self.reintento_deteccion:.0f}s")
+
+    def _repartir(self, grupo, respuesta=None, error=None):
+        """Asigna a cada pendiente su resultado, el error del lote o INDIVIDUAL"""
+        if error is not None:
+            status = _status(error)
+            if status in NO_SOPORTADO:
+                self._marcar_no_soportado(f"HTTP {status}")
+            if status is not None and 400 <= status < 500 and status != 429:
+                # El lote fue rechazado como petición: cada RFC se consulta solo
+                for pendiente in grupo:
+                    pendiente.valor = INDIVIDUAL
+            else:
+                for pendiente in grupo:
+                    pendiente.error = error
+            return
+        resultados = dividir(respuesta)
+        if resultados is None:
+            self._marcar_no_soportado("formato de respuesta desconocido")
+            resultados = {}
+        for pendiente in grupo:
+            pendiente.valor = resultados.get(pendiente.payload['rfc'], INDIVIDUAL)
+
+    def estadisticas(self):
+        return {
+            "activo": self._activo(),
+            "lotes": self.lotes,
+            "rfcs_en_lotes": self.rfcs_en_lotes,
+            "rfcs_por_lote": round(self.rfcs_en_lotes / self.lotes, 2) if self.lotes else None,
+            "individuales": self.individuales,
+            "no_soportado": self.no_soportado,
+        }
+
+
+class MicroBatcher(_Agrupador):
+    """Agrupa consultas de varios hilos; `enviar(payload, url=None)` es FinkokClient.post_json"""
+
+    def __init__(self, enviar, url_lote, **kwargs):
+        super().__init__(url_lote, **kwargs)
+        self.enviar = enviar
+        self._lock = threading.Lock()
+
+    def consultar(self, payload):
+        """Resultado de Finkok para el payload de un RFC (bloquea a lo sumo la ventana más el envío)"""
+        if not self._activo():
+            self.individuales += 1
+            return self.enviar(payload)
+
+        clave = self._clave(payload)
+        pendiente = _Pendiente(payload)
+        pendiente.evento = threading.Event()
+        with self._lock:
+            entrada = self._grupos.get(clave)
+            lider = entrada is None
+            if lider:
+                entrada = self._grupos[clave] = ([], threading.Event())
+            grupo, lleno = entrada
+            grupo.append(pendiente)
+            if len(grupo) >= self.max_lote:
+                # Lleno: los siguientes abren otro grupo y el líder envía ya
+                del self._grupos[clave]
+                lleno.set()
+
+        if lider:
+            lleno.wait(self.ventana)
+            with self._lock:
+                if self._grupos.get(clave) is entrada:
+                    del self._grupos[clave]
+            self._despachar(grupo)
+        else:
+            pendiente.evento.wait()
+
+        if pendiente.error is not None:
+            raise pendiente.error
+        if pendiente.valor is INDIVIDUAL:
+            self.individuales += 1
+            return self.enviar(payload)
+        return pendiente.valor
+
+    def _despachar(self, grupo):
+        try:
+            if len(grupo) == 1:
+                grupo[0].valor = INDIVIDUAL
+                return
+            try:
+                respuesta = self.enviar(self._armar(grupo), url=self.url_lote)
+            except Exception as e:
+                self._repartir(grupo, error=e)
+            else:
+                self._repartir(grupo, respuesta)
+        finally:
+            for pendiente in grupo:
+                pendiente.evento.set()
+
+
+class AsyncMicroBatcher(_Agrupador):
+    """Equivalente asíncrono; `enviar` es AsyncFinkokClient.post_json.
+
+    El lote se envía desde una tarea propia, así que cancelar a uno de los
+    llamadores (p. ej. por el deadline de su consulta) no afecta a los demás.
+    """
+
+    def __init__(self, enviar, url_lote, **kwargs):
+        import asyncio
+
+        super().__init__(url_lote, **kwargs)
+        self._asyncio = asyncio
+        self.enviar = enviar
+
+    async def consultar(self, payload):
+        asyncio = self._asyncio
+        if not self._activo():
+            self.individuales += 1
+            return await self.enviar(payload)
+
+        clave = self._clave(payload)
+        pendiente = _Pendiente(payload)
+        pendiente.evento = asyncio.get_running_loop().create_future()
+        entrada = self._grupos.get(clave)
+        if entrada is None:
+            entrada = self._grupos[clave] = ([], asyncio.Event())
+            asyncio.ensure_future(self._despachar(clave, entrada))
+        grupo, lleno = entrada
+        grupo.append(pendiente)
+        if len(grupo) >= self.max_lote:
+            del self._grupos[clave]
+            lleno.set()
+
+        await asyncio.shield(pendiente.evento)
+        if pendiente.error is not None:
+            raise pendiente.error
+        if pendiente.valor is INDIVIDUAL:
+            self.individuales += 1
+            return await self.enviar(payload)
+        return pendiente.valor
+
+    async def _despachar(self, clave, entrada):
+        asyncio = self._asyncio
+        grupo, lleno = entrada
+        try:
+            try:
+                await asyncio.wait_for(lleno.wait(), self.ventana)
+            except asyncio.TimeoutError:
+                pass
+            if self._grupos.get(clave) is entrada:
+                del self._grupos[clave]
+            if len(grupo) == 1:
+                grupo[0].valor = INDIVIDUAL
+                return
+            try:
+                respuesta = await self.enviar(self._armar(grupo), url=self.url_lote)
+            except Exception as e:
+                self._repartir(grupo, error=e)
+            else:
+                self._repartir(grupo, respuesta)
+        finally:
+            for pendiente in grupo:
+                if not pendiente.evento.done():
+                    pendiente.evento.set_result(None)
+
+
+def _parametros(config):
+    return {
+        'ventana': config.FINKOK_BATCH_VENTANA_MS / 1000.0,
+        'max_lote': config.FINKOK_BATCH_MAX,
+    }
+
+
+def crear_lotes(config, enviar):
+    """Agrupador para el cliente síncrono (None si FINKOK_BATCH_URL está vacío)"""
+    if not config.FINKOK_BATCH_URL:
+        return None
+    return MicroBatcher(enviar, config.FINKOK_BATCH_URL, **_parametros(config))
+
+
+def crear_lotes_async(config, enviar):
+    """Agrupador para el cliente asíncrono (None si FINKOK_BATCH_URL está vacío)"""
+    if not config.FINKOK_BATCH_URL:
+        return None
+    return AsyncMicroBatcher(enviar, config.FINKOK_BATCH_URL, **_parametros(config))
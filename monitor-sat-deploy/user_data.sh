@@ -168,6 +168,7 @@ echo "Configurando variables de entorno..."
 cat > $PROJECT_DIR/.env << EOF
 DEBUG=False
 PORT=5000
+SECRETS_BACKEND=aws
 SECRET_NAME=$SECRET_NAME
 AWS_REGION=$AWS_REGION
 ENVIRONMENT=production
@@ -175,6 +176,17 @@ EOF
 chown monitor-sat:monitor-sat $PROJECT_DIR/.env
 chmod 600 $PROJECT_DIR/.env
 
+# Servidor: server.py calcula workers, hilos y timeouts para esta instancia
+# (CPUs, memoria, timeouts de Finkok); nginx usa el mismo timeout de proxy
+if [ -f $PROJECT_DIR/server.py ]; then
+    EXEC_START="$PROJECT_DIR/venv/bin/python $PROJECT_DIR/server.py --access-logfile - --error-logfile -"
+    PROXY_TIMEOUT=$(sudo -u monitor-sat bash -c "cd $PROJECT_DIR && set -a && source .env && set +a && venv/bin/python server.py --campo timeouts.proxy")
+    PROXY_TIMEOUT=${PROXY_TIMEOUT:-105}
+else
+    EXEC_START="$PROJECT_DIR/venv/bin/gunicorn --bind 127.0.0.1:5000 --workers 2 --timeout 60 --access-logfile - --error-logfile - app:app"
+    PROXY_TIMEOUT=65
+fi
+
 # Configurar Nginx
 echo "Configurando Nginx..."
 cat > /etc/nginx/sites-available/$PROJECT_NAME << EOF
@@ -214,11 +226,13 @@ server {
         proxy_set_header X-Real-IP \$remote_addr;
         proxy_set_header X-Forwarded-For \$proxy_add_x_forwarded_for;
         proxy_set_header X-Forwarded-Proto \$scheme;
+        # Hora de llegada para el control de admisión (descarta peticiones que esperaron demasiado)
+        proxy_set_header X-Request-Start "t=\${msec}";
         
-        # Timeouts
+        # Timeouts: por encima del timeout de gunicorn (ver server.py --perfil)
         proxy_connect_timeout 60s;
-        proxy_send_timeout 60s;
-        proxy_read_timeout 60s;
+        proxy_send_timeout ${PROXY_TIMEOUT}s;
+        proxy_read_timeout ${PROXY_TIMEOUT}s;
     }
     
     # Health check endpoint
@@ -226,6 +240,12 @@ server {
         access_log off;
         proxy_pass http://127.0.0.1:5000/;
     }
+
+    # Readiness: 503 mientras el worker no puede atender consultas
+    location /ready {
+        access_log off;
+        proxy_pass http://127.0.0.1:5000/listo;
+    }
 }
 EOF
 
@@ -244,14 +264,18 @@ Description=Monitor SAT Backend
 After=network.target
 
 [Service]
-Type=exec
+Type=notify
+NotifyAccess=main
 User=monitor-sat
 Group=monitor-sat
 WorkingDirectory=$PROJECT_DIR
 Environment=PATH=$PROJECT_DIR/venv/bin
 EnvironmentFile=$PROJECT_DIR/.env
-ExecStart=$PROJECT_DIR/venv/bin/gunicorn --bind 127.0.0.1:5000 --workers 2 --timeout 60 --access-logfile - --error-logfile - app:app
+ExecStart=$EXEC_START
+# SIGHUP: maestro nuevo sobre el mismo socket; el anterior termina sus consultas
 ExecReload=/bin/kill -s HUP \$MAINPID
+KillMode=mixed
+TimeoutStopSec=${PROXY_TIMEOUT}
 Restart=always
 RestartSec=10
 
@@ -0,0 +1,474 @@
+"""
+Carteras de RFCs (p. ej. los clientes de un despacho contable) con agregados incrementales.
+
+Cada cartera guarda sus totales (pendientes, vencidas, discrepancias,
+total_facturas, monto_total), el número de alertas por tipo y, por miembro,
+el puntaje de riesgo con el que se ordena el top de RFCs más riesgosos. Nada
+de esto se recalcula al consultar la cartera: cada instantánea nueva de un RFC
+se encola (como en el historial) y un hilo la aplica por lotes en SQLite como
+una diferencia contra la última del RFC, sumada a cada cartera que lo
+contiene. Leer una cartera de miles de RFCs es leer una fila y recorrer el
+índice de riesgo hasta `top`.
+
+Con varios workers la lectura de la instantánea anterior, la actualización de
+los totales y la de la instantánea van en una sola transacción, así que cada
+cambio se suma una sola vez. Las lecturas no esperan a la cola: reflejan lo
+aplicado por todos los workers hasta el último lote.
+
+Cada cartera pertenece a un dueño (la identidad de la API key, o '' para las
+del administrador) y su nombre es único solo entre las de ese dueño: todas
+las operaciones sobre una cartera reciben el dueño y filtran por él.
+"""
+
+import atexit
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from alert_dispatch import TIPOS
+from history_store import CAMPOS
+
+logger = logging.getLogger(__name__)
+
+# Columnas que se suman por cartera: datos del SAT y alertas por tipo
+ACUMULADOS = CAMPOS + TIPOS
+
+# Peso de cada tipo de alerta en el puntaje de riesgo de un RFC; los empates se
+# ordenan por vencidas y después por monto total
+PESOS = {'critico': 100, 'advertencia': 10, 'atencion': 1}
+
+_COLUMNAS = ', '.join(ACUMULADOS)
+_SUMAS = ', '.join(f'{c} = {c} + ?' for c in ACUMULADOS)
+
+
+def _dueno(propietario):
+    # El administrador (None) y las carteras anteriores a los dueños comparten ''
+    return propietario or ''
+
+
+def puntaje(conteos):
+    """Riesgo de un RFC a partir de sus alertas por tipo (en el orden de TIPOS)"""
+    return sum(PESOS.get(tipo, 0) * n for tipo, n in zip(TIPOS, conteos))
+
+
+class PortfolioStore:
+    """Carteras de RFCs con totales, alertas por tipo y top de riesgo mantenidos al escribir"""
+
+    def __init__(self, ruta, intervalo_escritura=1.0, tamano_lote=500, max_pendientes=10000):
+        self.ruta = ruta
+        self.intervalo_escritura = intervalo_escritura
+        self.tamano_lote = tamano_lote
+        self.max_pendientes = max_pendientes
+        self.escritas = 0
+        self.cambios = 0
+        self.descartadas = 0
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        # Conexión temporal: las de trabajo se abren por hilo y no cruzan fork()
+        conexion = sqlite3.connect(ruta, timeout=10, isolation_level=None)
+        try:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            # Una sola transacción: con varios workers arrancando, solo uno migra
+            conexion.execute("BEGIN IMMEDIATE")
+            try:
+                sin_dueno = self._apartar_sin_dueno(conexion)
+                # Última instantánea de cada RFC observado, esté o no en alguna cartera
+                conexion.execute(
+                    "CREATE TABLE IF NOT EXISTS estados ("
+                    " rfc TEXT PRIMARY KEY,"
+                    " momento REAL NOT NULL,"
+                    " pendientes INTEGER NOT NULL,"
+                    " vencidas INTEGER NOT NULL,"
+                    " discrepancias INTEGER NOT NULL,"
+                    " total_facturas INTEGER NOT NULL,"
+                    " monto_total REAL NOT NULL,"
+                    " critico INTEGER NOT NULL,"
+                    " advertencia INTEGER NOT NULL,"
+                    " atencion INTEGER NOT NULL,"
+                    " riesgo INTEGER NOT NULL)"
+                )
+                conexion.execute(
+                    "CREATE TABLE IF NOT EXISTS carteras ("
+                    " propietario TEXT NOT NULL DEFAULT '',"
+                    " cartera TEXT NOT NULL,"
+                    " creada REAL NOT NULL,"
+                    " ultimo_cambio REAL,"
+                    " rfcs INTEGER NOT NULL DEFAULT 0,"
+                    " con_datos INTEGER NOT NULL DEFAULT 0,"
+                    " pendientes INTEGER NOT NULL DEFAULT 0,"
+                    " vencidas INTEGER NOT NULL DEFAULT 0,"
+                    " discrepancias INTEGER NOT NULL DEFAULT 0,"
+                    " total_facturas INTEGER NOT NULL DEFAULT 0,"
+                    " monto_total REAL NOT NULL DEFAULT 0,"
+                    " critico INTEGER NOT NULL DEFAULT 0,"
+                    " advertencia INTEGER NOT NULL DEFAULT 0,"
+                    " atencion INTEGER NOT NULL DEFAULT 0,"
+                    " PRIMARY KEY (propietario, cartera))"
+                )
+                # riesgo/vencidas/monto_total copiados del estado (NULL sin datos) para
+                # leer el top de una cartera directo del índice
+                conexion.execute(
+                    "CREATE TABLE IF NOT EXISTS miembros ("
+                    " propietario TEXT NOT NULL DEFAULT '',"
+                    " cartera TEXT NOT NULL,"
+                    " rfc TEXT NOT NULL,"
+                    " riesgo INTEGER,"
+                    " vencidas INTEGER,"
+                    " monto_total REAL,"
+                    " PRIMARY KEY (propietario, cartera, rfc)) WITHOUT ROWID"
+                )
+                conexion.execute(
+                    "CREATE INDEX IF NOT EXISTS miembros_riesgo"
+                    " ON miembros (propietario, cartera, riesgo, vencidas, monto_total)"
+                )
+                conexion.execute("CREATE INDEX IF NOT EXISTS miembros_rfc ON miembros (rfc)")
+                if sin_dueno:
+                    self._migrar_sin_dueno(conexion)
+                conexion.execute("COMMIT")
+            except BaseException:
+                conexion.execute("ROLLBACK")
+                raise
+        finally:
+            conexion.close()
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+        atexit.register(self.vaciar)
+
+    @staticmethod
+    def _apartar_sin_dueno(conexion):
+        """Renombra las tablas de antes de los dueños (una cartera por nombre); True si las había"""
+        columnas = [fila[1] for fila in conexion.execute("PRAGMA table_info(carteras)")]
+        if not columnas or 'propietario' in columnas:
+            return False
+        # Los índices viajan con la tabla renombrada: se borran para crearlos sobre la nueva
+        conexion.execute("DROP INDEX IF EXISTS miembros_riesgo")
+        conexion.execute("DROP INDEX IF EXISTS miembros_rfc")
+        conexion.execute("ALTER TABLE carteras RENAME TO carteras_sin_dueno")
+        conexion.execute("ALTER TABLE miembros RENAME TO miembros_sin_dueno")
+        return True
+
+    @staticmethod
+    def _migrar_sin_dueno(conexion):
+        """Copia las carteras apartadas como carteras del administrador ('')"""
+        columnas = ', '.join(('cartera', 'creada', 'ultimo_cambio', 'rfcs', 'con_datos') + ACUMULADOS)
+        conexion.execute(f"INSERT INTO carteras ({columnas}) SELECT {columnas} FROM carteras_sin_dueno")
+        conexion.execute(
+            "INSERT INTO miembros (cartera, rfc, riesgo, vencidas, monto_total)"
+            " SELECT cartera, rfc, riesgo, vencidas, monto_total FROM miembros_sin_dueno"
+        )
+        conexion.execute("DROP TABLE carteras_sin_dueno")
+        conexion.execute("DROP TABLE miembros_sin_dueno")
+        logger.info("Carteras existentes migradas a las del administrador")
+
+    def _reiniciar(self):
+        # También se usa tras un fork(): cola, hilo y conexiones propios del proceso
+        self._local = threading.local()
+        self._pendientes = []
+        self._lock = threading.Lock()
+        self._lock_escritura = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def _conexion(self):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    @staticmethod
+    def _estado(conexion, rfc):
+        return conexion.execute(
+            f"SELECT momento, {_COLUMNAS} FROM estados WHERE rfc = ?", (rfc,)
+        ).fetchone()
+
+    # Instantáneas
+
+    def observar(self, rfc, alertas, datos, momento=None):
+        """Encola una instantánea nueva del RFC; no toca el disco en el hilo de la petición"""
+        conteos = tuple(sum(1 for alerta in alertas if alerta.get('tipo') == tipo) for tipo in TIPOS)
+        fila = (rfc, momento if momento is not None else time.time(),
+                tuple(datos.get(c, 0) for c in CAMPOS) + conteos)
+        with self._lock:
+            if len(self._pendientes) >= self.max_pendientes:
+                self.descartadas += 1
+                return
+            self._pendientes.append(fila)
+            lleno = len(self._pendientes) >= self.tamano_lote
+        self._iniciar_escritor()
+        if lleno:
+            self._despertar.set()
+
+    def _iniciar_escritor(self):
+        if self._hilo is not None:
+            return
+        with self._lock:
+            if self._hilo is not None:
+                return
+
+            def ciclo():
+                while True:
+                    self._despertar.wait(self.intervalo_escritura)
+                    self._despertar.clear()
+                    try:
+                        self.vaciar()
+                    except Exception:
+                        # Un lote con un error inesperado se pierde, pero el hilo sigue aplicando
+                        logger.exception("Error inesperado actualizando carteras")
+
+            self._hilo = threading.Thread(target=ciclo, name='carteras-escritura', daemon=True)
+            self._hilo.start()
+
+    def vaciar(self):
+        """Aplica las instantáneas pendientes en una sola transacción"""
+        with self._lock:
+            lote, self._pendientes = self._pendientes, []
+        if not lote:
+            return
+        with self._lock_escritura:
+            try:
+                self._escribir(lote)
+            except sqlite3.Error as e:
+                logger.error(f"Error actualizando carteras ({len(lote)} instantáneas): {str(e)}")
+
+    def _escribir(self, lote):
+        conexion = self._conexion()
+        # IMMEDIATE: otro worker no puede aplicar a la vez una diferencia del mismo RFC
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            cambios = 0
+            for rfc, momento, valores in sorted(lote, key=lambda f: f[1]):
+                anterior = self._estado(conexion, rfc)
+                if anterior is not None and anterior[0] > momento:
+                    # Otro worker ya aplicó una instantánea más reciente
+                    continue
+                riesgo = puntaje(valores[len(CAMPOS):])
+                conexion.execute(
+                    f"INSERT OR REPLACE INTO estados (rfc, momento, {_COLUMNAS}, riesgo)"
+                    f" VALUES (?, ?, {', '.join('?' * len(ACUMULADOS))}, ?)",
+                    (rfc, momento) + valores + (riesgo,)
+                )
+                if anterior is not None and tuple(anterior[1:]) == valores:
+                    continue
+                previos = anterior[1:] if anterior is not None else (0,) * len(ACUMULADOS)
+                conexion.execute(
+                    f"UPDATE carteras SET con_datos = con_datos + ?, {_SUMAS}, ultimo_cambio = ?"
+                    " WHERE (propietario, cartera) IN (SELECT propietario, cartera FROM miembros WHERE rfc = ?)",
+                    (0 if anterior is not None else 1,)
+                    + tuple(nuevo - previo for nuevo, previo in zip(valores, previos))
+                    + (momento, rfc)
+                )
+                conexion.execute(
+                    "UPDATE miembros SET riesgo = ?, vencidas = ?, monto_total = ? WHERE rfc = ?",
+                    (riesgo, valores[CAMPOS.index('vencidas')], valores[CAMPOS.index('monto_total')], rfc)
+                )
+                cambios += 1
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        self.escritas += len(lote)
+        self.cambios += cambios
+
+    # Miembros
+
+    def _sumar(self, conexion, propietario, cartera, rfcs, con_datos, sumas, momento):
+        conexion.execute(
+            f"UPDATE carteras SET rfcs = rfcs + ?, con_datos = con_datos + ?, {_SUMAS}, ultimo_cambio = ?"
+            " WHERE propietario = ? AND cartera = ?",
+            (rfcs, con_datos) + tuple(sumas) + (momento, propietario, cartera)
+        )
+
+    def agregar(self, cartera, rfcs, propietario=None):
+        """Agrega RFCs a la cartera del dueño (la crea si no existe); devuelve cuántos no estaban ya"""
+        propietario = _dueno(propietario)
+        conexion = self._conexion()
+        ahora = time.time()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            conexion.execute(
+                "INSERT OR IGNORE INTO carteras (propietario, cartera, creada) VALUES (?, ?, ?)",
+                (propietario, cartera, ahora)
+            )
+            nuevos = con_datos = 0
+            sumas = [0] * len(ACUMULADOS)
+            for rfc in dict.fromkeys(rfcs):
+                estado = self._estado(conexion, rfc)
+                if estado is None:
+                    fila = (None, None, None)
+                else:
+                    fila = (puntaje(estado[1 + len(CAMPOS):]), estado[1 + CAMPOS.index('vencidas')],
+                            estado[1 + CAMPOS.index('monto_total')])
+                cursor = conexion.execute(
+                    "INSERT OR IGNORE INTO miembros (propietario, cartera, rfc, riesgo, vencidas, monto_total)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", (propietario, cartera, rfc) + fila
+                )
+                if cursor.rowcount == 0:
+                    continue
+                nuevos += 1
+                if estado is not None:
+                    con_datos += 1
+                    sumas = [s + v for s, v in zip(sumas, estado[1:])]
+            self._sumar(conexion, propietario, cartera, nuevos, con_datos, sumas, ahora)
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        return nuevos
+
+    def quitar(self, cartera, rfcs, propietario=None):
+        """Quita RFCs de la cartera del dueño; devuelve cuántos estaban en ella"""
+        propietario = _dueno(propietario)
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            quitados = con_datos = 0
+            sumas = [0] * len(ACUMULADOS)
+            for rfc in dict.fromkeys(rfcs):
+                cursor = conexion.execute(
+                    "DELETE FROM miembros WHERE propietario = ? AND cartera = ? AND rfc = ?",
+                    (propietario, cartera, rfc)
+                )
+                if cursor.rowcount == 0:
+                    continue
+                quitados += 1
+                estado = self._estado(conexion, rfc)
+                if estado is not None:
+                    con_datos -= 1
+                    sumas = [s - v for s, v in zip(sumas, estado[1:])]
+            if quitados:
+                self._sumar(conexion, propietario, cartera, -quitados, con_datos, sumas, time.time())
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        return quitados
+
+    def eliminar(self, cartera, propietario=None):
+        """Borra la cartera completa del dueño (las instantáneas de sus RFCs se conservan)"""
+        propietario = _dueno(propietario)
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            conexion.execute("DELETE FROM miembros WHERE propietario = ? AND cartera = ?", (propietario, cartera))
+            existia = conexion.execute(
+                "DELETE FROM carteras WHERE propietario = ? AND cartera = ?", (propietario, cartera)
+            ).rowcount > 0
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        return existia
+
+    # Lectura
+
+    @staticmethod
+    def _totales(valores):
+        totales = dict(zip(CAMPOS, valores[:len(CAMPOS)]))
+        totales['monto_total'] = round(totales['monto_total'], 2)
+        return totales, dict(zip(TIPOS, valores[len(CAMPOS):]))
+
+    def resumen(self, cartera, top=10, propietario=None):
+        """Totales, alertas por tipo y los `top` RFCs más riesgosos (None si el dueño no tiene esa cartera)"""
+        propietario = _dueno(propietario)
+        conexion = self._conexion()
+        # Una sola transacción de lectura: los totales y el top son de la misma versión
+        conexion.execute("BEGIN")
+        try:
+            fila = conexion.execute(
+                f"SELECT creada, ultimo_cambio, rfcs, con_datos, {_COLUMNAS} FROM carteras"
+                " WHERE propietario = ? AND cartera = ?",
+                (propietario, cartera)
+            ).fetchone()
+            riesgosos = []
+            if fila is not None and top > 0:
+                riesgosos = conexion.execute(
+                    f"SELECT e.rfc, e.momento, e.riesgo, {', '.join('e.' + c for c in ACUMULADOS)}"
+                    " FROM miembros m JOIN estados e ON e.rfc = m.rfc"
+                    " WHERE m.propietario = ? AND m.cartera = ? AND m.riesgo IS NOT NULL"
+                    " ORDER BY m.riesgo DESC, m.vencidas DESC, m.monto_total DESC LIMIT ?",
+                    (propietario, cartera, top)
+                ).fetchall()
+        finally:
+            conexion.execute("COMMIT")
+        if fila is None:
+            return None
+
+        totales, alertas = self._totales(fila[4:])
+        top_riesgo = []
+        for rfc, momento, riesgo, *valores in riesgosos:
+            datos, conteos = self._totales(valores)
+            top_riesgo.append({
+                'rfc': rfc,
+                'riesgo': riesgo,
+                'alertas': {tipo: n for tipo, n in conteos.items() if n},
+                'datos': datos,
+                'actualizado': momento,
+            })
+        return {
+            'cartera': cartera,
+            'creada': fila[0],
+            'ultimo_cambio': fila[1],
+            'rfcs': fila[2],
+            'con_datos': fila[3],
+            'sin_datos': fila[2] - fila[3],
+            'totales': totales,
+            'alertas': alertas,
+            'top_riesgo': top_riesgo,
+        }
+
+    def recalcular(self, cartera, propietario=None):
+        """Rehace los totales de la cartera desde las instantáneas de sus miembros.
+
+        No se usa al consultar: sirve para verificar los agregados incrementales
+        o repararlos. Devuelve False si la cartera no existe. Las instantáneas
+        aún en cola se aplican después como diferencias sobre estos totales.
+        """
+        propietario = _dueno(propietario)
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            sumas = conexion.execute(
+                f"SELECT count(*), count(e.rfc), {', '.join(f'coalesce(sum(e.{c}), 0)' for c in ACUMULADOS)}"
+                " FROM miembros m LEFT JOIN estados e ON e.rfc = m.rfc"
+                " WHERE m.propietario = ? AND m.cartera = ?", (propietario, cartera)
+            ).fetchone()
+            cursor = conexion.execute(
+                f"UPDATE carteras SET rfcs = ?, con_datos = ?, {', '.join(f'{c} = ?' for c in ACUMULADOS)}"
+                " WHERE propietario = ? AND cartera = ?", tuple(sumas) + (propietario, cartera)
+            )
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        return cursor.rowcount > 0
+
+    def estadisticas(self):
+        try:
+            carteras = self._conexion().execute("SELECT count(*) FROM carteras").fetchone()[0]
+        except sqlite3.Error:
+            carteras = None
+        return {
+            "carteras": carteras,
+            "escritas": self.escritas,
+            "cambios": self.cambios,
+            "pendientes": len(self._pendientes),
+            "descartadas": self.descartadas,
+        }
+
+
+def crear_carteras(config):
+    """Construye el almacén de carteras a partir de la configuración (None si está deshabilitado)"""
+    if not config.PORTFOLIO_ENABLED:
+        return None
+    return PortfolioStore(
+        config.PORTFOLIO_DB_PATH,
+        intervalo_escritura=config.PORTFOLIO_FLUSH_INTERVAL,
+        tamano_lote=config.PORTFOLIO_BATCH,
+        max_pendientes=config.PORTFOLIO_QUEUE_MAX
+    )
@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket thread-safe: `tasa` tokens por segundo, hasta `capacidad` acumulados.
+
+    Una tasa <= 0 desactiva el límite.
+    """
+
+    def __init__(self, tasa, capacidad=None):
+        self.tasa = tasa
+        self.capacidad = capacidad if capacidad is not None else max(1.0, tasa)
+        self._tokens = self.capacidad
+        self._actualizado = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _rellenar(self, ahora):
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._actualizado) * self.tasa)
+        self._actualizado = ahora
+
+    def intentar(self, tokens=1):
+        """Consume tokens si hay disponibles; devuelve los segundos a esperar si no (0 = aceptado)"""
+        if self.tasa <= 0:
+            return 0.0
+        with self._lock:
+            self._rellenar(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.tasa
+
+    def adquirir(self, tokens=1):
+        """Bloquea hasta poder consumir los tokens"""
+        while True:
+            espera = self.intentar(tokens)
+            if espera <= 0:
+                return
+            time.sleep(espera)
@@ -0,0 +1,131 @@
+"""
+Codificación de respuestas: JSON rápido y compresión negociada.
+
+El backend de JSON se elige al importar: orjson si está instalado, luego
+msgspec y por último la biblioteca estándar. Todos producen JSON compacto en
+UTF-8, con las llaves en orden de inserción (el proveedor por defecto de
+Flask las ordenaba) y fechas en ISO 8601 con `T`; los tipos que el backend
+no conoce (p. ej. Decimal) salen como texto. Diferencia conocida: msgspec
+escribe la zona UTC como `Z` y orjson/stdlib como `+00:00`.
+
+La compresión se aplica solo a cuerpos de al menos `minimo` bytes (las
+respuestas de un RFC caben en un paquete y no ganan nada): brotli si el
+cliente lo acepta y el módulo está instalado, gzip en otro caso.
+"""
+
+import datetime
+import gzip
+import json
+
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+
+def _respaldo(obj):
+    # Tipos que el backend no conoce: fechas como las escribe orjson, el resto como texto
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    return str(obj)
+
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def dumps(obj):
+        """Serializa a bytes UTF-8"""
+        return orjson.dumps(obj, default=_respaldo, option=orjson.OPT_NON_STR_KEYS)
+
+    loads = orjson.loads
+
+elif msgspec is not None:
+    BACKEND = 'msgspec'
+    _codificador = msgspec.json.Encoder(enc_hook=_respaldo)
+    _decodificador = msgspec.json.Decoder()
+
+    def dumps(obj):
+        """Serializa a bytes UTF-8"""
+        return _codificador.encode(obj)
+
+    def loads(datos):
+        try:
+            return _decodificador.decode(datos)
+        except msgspec.DecodeError as e:
+            # Flask y asgi_app esperan ValueError para responder "JSON malformado"
+            raise ValueError(str(e)) from e
+
+else:
+    BACKEND = 'json'
+    _codificador = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=_respaldo)
+
+    def dumps(obj):
+        """Serializa a bytes UTF-8"""
+        return _codificador.encode(obj).encode()
+
+    loads = json.loads
+
+
+def dumps_texto(obj):
+    """Serializa a str (para NDJSON/SSE y lugares que esperan texto)"""
+    return dumps(obj).decode()
+
+
+class FastJSONProvider(JSONProvider):
+    """Proveedor de JSON de Flask sobre el backend rápido.
+
+    Lo usan `jsonify` y `request.get_json()`, así que toda la aplicación
+    serializa y parsea con el mismo backend.
+    """
+
+    mimetype = 'application/json'
+
+    def dumps(self, obj, **kwargs):
+        return dumps_texto(obj)
+
+    def loads(self, s, **kwargs):
+        return loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj), mimetype=self.mimetype)
+
+
+# Compresión
+
+def elegir_codificacion(accept_encoding):
+    """'br', 'gzip' o None según el encabezado Accept-Encoding del cliente"""
+    if not accept_encoding:
+        return None
+    aceptadas = set()
+    for parte in accept_encoding.lower().split(','):
+        nombre, _, parametros = parte.strip().partition(';')
+        if parametros.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        aceptadas.add(nombre.strip())
+    if brotli is not None and 'br' in aceptadas:
+        return 'br'
+    if 'gzip' in aceptadas or '*' in aceptadas:
+        return 'gzip'
+    return None
+
+
+def comprimir(cuerpo, codificacion, nivel_gzip=1, calidad_brotli=4):
+    """Comprime el cuerpo con la codificación elegida por `elegir_codificacion`"""
+    if codificacion == 'br':
+        return brotli.compress(cuerpo, quality=calidad_brotli)
+    # mtime=0: el mismo cuerpo produce los mismos bytes (ETags y cachés intermedias)
+    return gzip.compress(cuerpo, compresslevel=nivel_gzip, mtime=0)
@@ -0,0 +1,358 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as FuturesTimeout
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    """Backend LRU en memoria, local a cada worker"""
+
+    def __init__(self, max_entradas):
+        self.max_entradas = max_entradas
+        self._datos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada is not None:
+                self._datos.move_to_end(clave)
+            return entrada
+
+    def guardar(self, clave, valor, guardado, expira):
+        with self._lock:
+            self._datos[clave] = (valor, guardado, expira)
+            self._datos.move_to_end(clave)
+            while len(self._datos) > self.max_entradas:
+                self._datos.popitem(last=False)
+
+    def eliminar(self, clave):
+        with self._lock:
+            self._datos.pop(clave, None)
+
+    def __len__(self):
+        return len(self._datos)
+
+
+class SQLiteBackend:
+    """Backend LRU en un archivo SQLite compartido entre workers.
+
+    Para que una lectura no sea también una escritura, `accedido` solo se
+    actualiza si tiene más de `intervalo_acceso` segundos (el LRU es preciso
+    hasta ese intervalo). El desalojo no corre en cada escritura: cada
+    `lote` escrituras del proceso se cuenta la tabla y se borran de una vez
+    las menos usadas necesarias para dejar `lote` lugares libres.
+    """
+
+    def __init__(self, ruta, max_entradas, tabla='cache', intervalo_acceso=60.0):
+        self.ruta = ruta
+        self.max_entradas = max_entradas
+        self.tabla = tabla
+        self.intervalo_acceso = intervalo_acceso
+        self.lote = max(1, max_entradas // 20)
+        self._escrituras = 0
+        self._local = threading.local()
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        # Conexión temporal: las conexiones de trabajo se abren por hilo y
+        # nunca se heredan a través de fork()
+        conexion = sqlite3.connect(ruta, timeout=5, isolation_level=None)
+        try:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                f"CREATE TABLE IF NOT EXISTS {tabla} ("
+                " clave TEXT PRIMARY KEY,"
+                " valor TEXT NOT NULL,"
+                " guardado REAL NOT NULL,"
+                " expira REAL NOT NULL,"
+                " accedido REAL NOT NULL)"
+            )
+            conexion.execute(f"CREATE INDEX IF NOT EXISTS {tabla}_accedido ON {tabla} (accedido)")
+            if tabla == 'cache':
+                # Los respaldos antes vivían en esta tabla con sufijo y contaban para su tope
+                conexion.execute("DELETE FROM cache WHERE clave LIKE '%#respaldo'")
+        finally:
+            conexion.close()
+
+    def _conexion(self):
+        # sqlite3 no permite compartir conexiones entre hilos: una por hilo
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    def obtener(self, clave):
+        conexion = self._conexion()
+        fila = conexion.execute(
+            f"SELECT valor, guardado, expira, accedido FROM {self.tabla} WHERE clave = ?", (clave,)
+        ).fetchone()
+        if fila is None:
+            return None
+        ahora = time.time()
+        if ahora - fila[3] > self.intervalo_acceso:
+            conexion.execute(f"UPDATE {self.tabla} SET accedido = ? WHERE clave = ?", (ahora, clave))
+        return json.loads(fila[0]), fila[1], fila[2]
+
+    def guardar(self, clave, valor, guardado, expira):
+        conexion = self._conexion()
+        conexion.execute(
+            f"INSERT OR REPLACE INTO {self.tabla} (clave, valor, guardado, expira, accedido)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (clave, json.dumps(valor), guardado, expira, guardado)
+        )
+        self._escrituras += 1
+        if self._escrituras >= self.lote:
+            self._escrituras = 0
+            self._desalojar(conexion)
+
+    def _desalojar(self, conexion):
+        # Quedan `lote` lugares libres: las escrituras hasta la próxima revisión caben en el tope
+        exceso = len(self) + self.lote - self.max_entradas
+        if exceso > 0:
+            conexion.execute(
+                f"DELETE FROM {self.tabla} WHERE clave IN ("
+                f" SELECT clave FROM {self.tabla} ORDER BY accedido LIMIT ?)",
+                (exceso,)
+            )
+
+    def eliminar(self, clave):
+        self._conexion().execute(f"DELETE FROM {self.tabla} WHERE clave = ?", (clave,))
+
+    def __len__(self):
+        return self._conexion().execute(f"SELECT COUNT(*) FROM {self.tabla}").fetchone()[0]
+
+
+class _Vuelo:
+    """Consulta en curso a la que se suman las peticiones concurrentes"""
+
+    __slots__ = ('evento', 'valor', 'error')
+
+    def __init__(self):
+        self.evento = threading.Event()
+        self.valor = None
+        self.error = None
+
+
+class ResultCache:
+    """Caché con TTL de respuestas de Finkok por RFC, con coalescencia de consultas.
+
+    Las respuestas con error se guardan con un TTL más corto (ttl_negativo) y
+    las peticiones concurrentes por el mismo RFC comparten una sola consulta.
+
+    Además, la última respuesta válida de cada RFC se conserva como respaldo
+    durante `ttl_respaldo` segundos (aunque venza su TTL o llegue un error
+    después), para servirla marcada como obsoleta cuando Finkok falla o tarda.
+    Los respaldos van en su propio backend (`respaldos`), con su propio tope:
+    no le quitan lugar a las entradas vigentes.
+    """
+
+    def __init__(self, ttl, ttl_negativo, backend, ttl_respaldo=0, respaldos=None, max_segundo_plano=16):
+        self.ttl = ttl
+        self.ttl_negativo = ttl_negativo
+        self.ttl_respaldo = ttl_respaldo if respaldos is not None else 0
+        self.backend = backend
+        self.respaldos = respaldos
+        self.max_segundo_plano = max_segundo_plano
+        self._vuelos = {}
+        # Claves con una consulta en el ejecutor (en cola o en curso)
+        self._segundo_plano = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalescidas = 0
+        self.obsoletas = 0
+        self.omitidas = 0
+
+    @staticmethod
+    def normalizar(rfc):
+        return rfc.strip().upper()
+
+    @staticmethod
+    def es_negativo(valor):
+        return not isinstance(valor, dict) or "error" in valor
+
+    def obtener(self, clave):
+        """Devuelve (valor, edad_segundos) si hay una entrada vigente, o None"""
+        try:
+            entrada = self.backend.obtener(clave)
+        except Exception as e:
+            logger.error(f"Error leyendo caché: {str(e)}")
+            return None
+        if entrada is None:
+            return None
+        valor, guardado, expira = entrada
+        ahora = time.time()
+        if expira <= ahora:
+            return None
+        return valor, ahora - guardado
+
+    def guardar(self, clave, valor):
+        negativo = self.es_negativo(valor)
+        ttl = self.ttl_negativo if negativo else self.ttl
+        ahora = time.time()
+        try:
+            if ttl > 0:
+                self.backend.guardar(clave, valor, ahora, ahora + ttl)
+            if not negativo and self.ttl_respaldo > 0:
+                # Entrada aparte: un error posterior no pisa el último resultado bueno
+                self.respaldos.guardar(clave, valor, ahora, ahora + self.ttl_respaldo)
+        except Exception as e:
+            logger.error(f"Error escribiendo caché: {str(e)}")
+
+    def obtener_respaldo(self, clave, max_edad):
+        """Último resultado válido con a lo sumo `max_edad` segundos: (valor, edad) o None"""
+        if max_edad <= 0 or self.ttl_respaldo <= 0:
+            return None
+        try:
+            entrada = self.respaldos.obtener(clave)
+        except Exception as e:
+            logger.error(f"Error leyendo caché: {str(e)}")
+            return None
+        if entrada is None:
+            return None
+        valor, guardado, _ = entrada
+        edad = time.time() - guardado
+        if edad > max_edad:
+            return None
+        return valor, edad
+
+    def respuesta_obsoleta(self, respaldo, motivo):
+        """(valor, info_cache) para servir un respaldo marcado como obsoleto"""
+        self.obsoletas += 1
+        valor, edad = respaldo
+        return valor, {"hit": True, "obsoleta": True, "edad_segundos": round(edad, 3), "motivo": motivo}
+
+    def obtener_o_calcular(self, rfc, funcion, max_edad=0, espera=0.0, ejecutor=None):
+        """Devuelve (valor, info_cache), llamando a funcion() solo si no hay entrada vigente.
+
+        Con `max_edad` > 0 y un `ejecutor`, si hay un respaldo de a lo sumo
+        `max_edad` segundos la consulta corre en el ejecutor: si en `espera`
+        segundos no termina o termina con error se sirve el respaldo, y la
+        consulta sigue en segundo plano para refrescar la caché. Si ya hay una
+        consulta en curso para el RFC o `max_segundo_plano` en el ejecutor
+        (en curso o en cola), el respaldo se sirve sin encolar otra.
+        """
+        clave = self.normalizar(rfc)
+        encontrado = self.obtener(clave)
+        if encontrado is not None:
+            valor, edad = encontrado
+            if max_edad > 0 and self.es_negativo(valor):
+                # Error reciente en caché: mejor el último resultado bueno que repetir el error
+                respaldo = self.obtener_respaldo(clave, max_edad)
+                if respaldo is not None:
+                    return self.respuesta_obsoleta(respaldo, 'error_upstream')
+            self.hits += 1
+            return valor, {"hit": True, "edad_segundos": round(edad, 3)}
+
+        respaldo = self.obtener_respaldo(clave, max_edad) if ejecutor is not None else None
+        if respaldo is None:
+            return self._calcular(clave, funcion)
+
+        with self._lock:
+            # Con Finkok lento la cola crece: cada tarea encolada de más sería
+            # otra llamada tardía por un RFC que para entonces ya se refrescó
+            omitir = (clave in self._vuelos or clave in self._segundo_plano
+                      or len(self._segundo_plano) >= self.max_segundo_plano)
+            if not omitir:
+                self._segundo_plano.add(clave)
+        if omitir:
+            self.omitidas += 1
+            return self.respuesta_obsoleta(respaldo, 'upstream_lento')
+        try:
+            futuro = ejecutor.submit(self._calcular, clave, funcion, True)
+        except Exception:
+            self._terminar_segundo_plano(clave)
+            raise
+        futuro.add_done_callback(lambda _: self._terminar_segundo_plano(clave))
+        try:
+            valor, info_cache = futuro.result(timeout=espera)
+        except FuturesTimeout:
+            return self.respuesta_obsoleta(respaldo, 'upstream_lento')
+        except Exception as e:
+            logger.error(f"Error consultando {clave}: {str(e)}")
+            return self.respuesta_obsoleta(respaldo, 'error_upstream')
+        if self.es_negativo(valor):
+            return self.respuesta_obsoleta(respaldo, 'error_upstream')
+        return valor, info_cache
+
+    def _terminar_segundo_plano(self, clave):
+        with self._lock:
+            self._segundo_plano.discard(clave)
+
+    def _calcular(self, clave, funcion, revisar=False):
+        """Llama a funcion() una sola vez por clave a la vez; con `revisar` (tarea que
+        pudo esperar en la cola del ejecutor) primero vuelve a buscar en la caché"""
+        with self._lock:
+            vuelo = self._vuelos.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = _Vuelo()
+                self._vuelos[clave] = vuelo
+
+        if not lider:
+            self.coalescidas += 1
+            vuelo.evento.wait()
+            if vuelo.error is not None:
+                raise vuelo.error
+            return vuelo.valor, {"hit": False, "coalescida": True, "edad_segundos": 0.0}
+
+        try:
+            if revisar:
+                encontrado = self.obtener(clave)
+                if encontrado is not None:
+                    # Otra consulta ya refrescó la entrada mientras esta esperaba su turno
+                    vuelo.valor, edad = encontrado
+                    self.hits += 1
+                    return vuelo.valor, {"hit": True, "edad_segundos": round(edad, 3)}
+            self.misses += 1
+            vuelo.valor = funcion()
+            self.guardar(clave, vuelo.valor)
+            return vuelo.valor, {"hit": False, "edad_segundos": 0.0}
+        except Exception as e:
+            vuelo.error = e
+            raise
+        finally:
+            with self._lock:
+                self._vuelos.pop(clave, None)
+            vuelo.evento.set()
+
+    def estadisticas(self):
+        """Contadores de uso de la caché"""
+        try:
+            entradas = len(self.backend)
+            respaldos = len(self.respaldos) if self.respaldos is not None else 0
+        except Exception:
+            entradas = respaldos = None
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalescidas": self.coalescidas,
+            "obsoletas": self.obsoletas,
+            "revalidaciones_omitidas": self.omitidas,
+            "entradas": entradas,
+            "respaldos": respaldos,
+            "backend": type(self.backend).__name__,
+        }
+
+
+def crear_cache(config):
+    """Construye la caché de resultados a partir de la configuración"""
+    if config.CACHE_BACKEND == 'sqlite':
+        backend = SQLiteBackend(config.CACHE_SQLITE_PATH, config.CACHE_MAX_ENTRADAS)
+        respaldos = SQLiteBackend(config.CACHE_SQLITE_PATH, config.CACHE_MAX_RESPALDOS, tabla='respaldos')
+    else:
+        backend = MemoryBackend(config.CACHE_MAX_ENTRADAS)
+        respaldos = MemoryBackend(config.CACHE_MAX_RESPALDOS)
+    # El respaldo se conserva tanto como lo admita el endpoint más tolerante
+    ttl_respaldo = max(config.STALE_MAX_EDAD_SAT, config.STALE_MAX_EDAD_MULTIPLE)
+    return ResultCache(config.CACHE_TTL, config.CACHE_TTL_NEGATIVO, backend, ttl_respaldo, respaldos,
+                       max_segundo_plano=config.STALE_MAX_PENDIENTES)
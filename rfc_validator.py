@@ -0,0 +1,109 @@
+"""
+Validación local de RFCs: formato, fecha y dígito verificador.
+
+Los RFCs que no pasan la validación se rechazan sin gastar una consulta a
+Finkok. Las funciones devuelven el motivo del rechazo (o None si el RFC es
+válido) para poder reportarlo por elemento en las validaciones por lote.
+"""
+
+import re
+from operator import mul
+
+# Personas morales: 3 letras; personas físicas: 4 letras. Después fecha
+# AAMMDD, dos caracteres de homoclave y el dígito verificador. Que este sea
+# 0-9 o A lo revisa `digito_verificador` (solo si se pide la verificación).
+_PATRON_MORAL = re.compile(r'[A-ZÑ&]{3}[0-9]{6}[A-Z0-9]{3}')
+_PATRON_FISICA = re.compile(r'[A-ZÑ&]{4}[0-9]{6}[A-Z0-9]{3}')
+
+# Valores del algoritmo de dígito verificador del SAT, como tabla de
+# traducción de bytes (latin-1) para no hacer búsquedas en diccionario
+_TABLA_VALORES = bytearray(256)
+for _valor, _caracter in enumerate('0123456789ABCDEFGHIJKLMN&OPQRSTUVWXYZ Ñ'):
+    _TABLA_VALORES[ord(_caracter)] = _valor
+_TABLA_VALORES = bytes(_TABLA_VALORES)
+_PESOS = tuple(range(13, 1, -1))
+_DIGITOS = ('0', 'A') + tuple(str(11 - r) for r in range(2, 11))
+
+# Combinaciones MMDD posibles; febrero admite 29 y se revisa el año aparte
+_DIAS_MES = (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_MMDD_VALIDOS = frozenset(
+    f"{mes:02d}{dia:02d}" for mes, dias in enumerate(_DIAS_MES, 1) for dia in range(1, dias + 1)
+)
+
+# RFCs genéricos del SAT (público en general y residentes en el extranjero)
+RFCS_GENERICOS = frozenset({'XAXX010101000', 'XEXX010101000'})
+
+MOTIVOS = {
+    'vacio': 'RFC vacío',
+    'longitud': 'El RFC debe tener 12 (persona moral) o 13 (persona física) caracteres',
+    'formato': 'Formato: ABCD123456789 (13 caracteres) o ABC123456789 (12 caracteres)',
+    'fecha': 'La fecha del RFC no es válida',
+    'digito_verificador': 'El dígito verificador del RFC no coincide',
+}
+
+
+def digito_verificador(rfc):
+    """Calcula el dígito verificador esperado para un RFC de 12 o 13 caracteres"""
+    base = rfc[:-1]
+    if len(base) == 11:
+        # Las personas morales se completan con un espacio al inicio
+        base = ' ' + base
+    suma = sum(map(mul, base.encode('latin-1').translate(_TABLA_VALORES), _PESOS))
+    return _DIGITOS[suma % 11]
+
+
+def validar(rfc, verificar_digito=True):
+    """Devuelve None si el RFC es válido o la clave del motivo de rechazo"""
+    if not rfc or not isinstance(rfc, str):
+        return 'vacio'
+
+    rfc = rfc.strip()
+    longitud = len(rfc)
+    if longitud == 12:
+        patron = _PATRON_MORAL
+        letras = 3
+    elif longitud == 13:
+        patron = _PATRON_FISICA
+        letras = 4
+    else:
+        return 'longitud'
+
+    if patron.fullmatch(rfc) is None:
+        return 'formato'
+
+    if rfc in RFCS_GENERICOS:
+        return None
+
+    # Fecha AAMMDD: el siglo no se conoce, así que el 29 de febrero se
+    # acepta en cualquier año divisible entre 4
+    mmdd = rfc[letras + 2:letras + 6]
+    if mmdd not in _MMDD_VALIDOS:
+        return 'fecha'
+    if mmdd == '0229' and int(rfc[letras:letras + 2]) % 4:
+        return 'fecha'
+
+    if verificar_digito and digito_verificador(rfc) != rfc[-1]:
+        return 'digito_verificador'
+
+    return None
+
+
+def es_valido(rfc, verificar_digito=True):
+    """Indica si el RFC es válido"""
+    return validar(rfc, verificar_digito) is None
+
+
+def validar_lote(rfcs, verificar_digito=True):
+    """Valida un iterable de RFCs en una sola pasada.
+
+    Genera tuplas (rfc, motivo) en el orden de entrada; motivo es None para
+    los RFCs válidos. Al ser un generador sirve igual para listas que para
+    flujos de gran tamaño.
+    """
+    for rfc in rfcs:
+        yield rfc, validar(rfc, verificar_digito)
+
+
+def describir(motivo):
+    """Mensaje legible para una clave de motivo"""
+    return MOTIVOS.get(motivo, 'RFC inválido')
@@ -0,0 +1,409 @@
+"""
+Refresco programado de RFCs en segundo plano.
+
+Los RFCs registrados se consultan a Finkok periódicamente y la última
+instantánea se guarda en SQLite; cada worker mantiene una copia en memoria
+(un `Snapshot` compacto por RFC: pueden ser decenas de miles), así que las
+peticiones de un RFC programado se contestan sin esperar a Finkok. Un solo
+worker (el que obtiene el flock) ejecuta el ciclo de refresco: un heap
+ordenado por próxima ejecución, con un presupuesto global de consultas por
+segundo y jitter en cada intervalo.
+
+El intervalo de cada RFC se adapta: se reduce a la mitad mientras haya
+alertas críticas, crece 1.5x cada vez que los datos no cambian y vuelve al
+intervalo base cuando cambian.
+"""
+
+import fcntl
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import TokenBucket
+from snapshots import Snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshScheduler:
+    """Programador de refrescos por RFC compartido entre workers.
+
+    `consultar(rfc)` devuelve la respuesta cruda de Finkok y
+    `procesar(rfc, data_sat)` la respuesta procesada (con alertas).
+    """
+
+    def __init__(self, ruta, consultar, procesar, intervalo=3600.0, intervalo_min=300.0,
+                 intervalo_max=86400.0, jitter=0.1, tasa=2.0, concurrencia=4,
+                 intervalo_sync=2.0, max_edad=86400.0):
+        self.ruta = ruta
+        self.consultar = consultar
+        self.procesar = procesar
+        self.intervalo = intervalo
+        self.intervalo_min = intervalo_min
+        self.intervalo_max = intervalo_max
+        self.jitter = jitter
+        self.tasa = tasa
+        self.concurrencia = concurrencia
+        self.intervalo_sync = intervalo_sync
+        self.max_edad = max_edad
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        # Conexión temporal: las de trabajo se abren por hilo y no cruzan fork()
+        conexion = sqlite3.connect(ruta, timeout=10, isolation_level=None)
+        try:
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS programadas ("
+                " rfc TEXT PRIMARY KEY,"
+                " activa INTEGER NOT NULL,"
+                " intervalo_base REAL NOT NULL,"
+                " intervalo REAL NOT NULL,"
+                " proxima REAL NOT NULL,"
+                " ultima REAL,"
+                " sin_cambios INTEGER NOT NULL DEFAULT 0,"
+                " criticas INTEGER NOT NULL DEFAULT 0,"
+                " fallos INTEGER NOT NULL DEFAULT 0,"
+                " modificada REAL NOT NULL)"
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS programadas_modificada ON programadas (modificada)")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS instantaneas ("
+                " rfc TEXT PRIMARY KEY,"
+                " datos TEXT NOT NULL,"
+                " actualizada REAL NOT NULL)"
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS instantaneas_actualizada ON instantaneas (actualizada)")
+        finally:
+            conexion.close()
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        # También se usa tras un fork(): hilos, flock y copia en memoria propios del proceso
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instantaneas = {}
+        self._sincronizado_hasta = 0.0
+        self._bajas_hasta = time.time()
+        self._hilo_sync = None
+        self._archivo_lock = None
+        self.lider = False
+        self.refrescos = 0
+        self.errores = 0
+
+    def _conexion(self):
+        conexion = getattr(self._local, 'conexion', None)
+        if conexion is None:
+            conexion = sqlite3.connect(self.ruta, timeout=10, isolation_level=None)
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            self._local.conexion = conexion
+        return conexion
+
+    # Registro (cualquier worker)
+
+    def registrar(self, rfcs, intervalo=None):
+        """Agrega RFCs al refresco programado (o cambia su intervalo base)"""
+        intervalo = max(self.intervalo_min, min(self.intervalo_max, intervalo or self.intervalo))
+        ahora = time.time()
+        filas = [
+            # Primer refresco repartido en una fracción del intervalo: registrar
+            # miles de RFCs a la vez no genera una ráfaga
+            (rfc, intervalo, intervalo, ahora + random.uniform(0, self.jitter * intervalo), ahora)
+            for rfc in rfcs
+        ]
+        self._conexion().executemany(
+            "INSERT INTO programadas (rfc, activa, intervalo_base, intervalo, proxima, modificada)"
+            " VALUES (?, 1, ?, ?, ?, ?)"
+            " ON CONFLICT(rfc) DO UPDATE SET activa = 1, intervalo_base = excluded.intervalo_base,"
+            " intervalo = excluded.intervalo, modificada = excluded.modificada",
+            filas
+        )
+        return len(filas)
+
+    def eliminar(self, rfc):
+        """Quita un RFC del refresco programado; devuelve False si no estaba"""
+        cursor = self._conexion().execute(
+            "UPDATE programadas SET activa = 0, modificada = ? WHERE rfc = ? AND activa = 1",
+            (time.time(), rfc)
+        )
+        with self._lock:
+            self._instantaneas.pop(rfc, None)
+        return cursor.rowcount > 0
+
+    def estado(self, rfc):
+        """Estado de programación de un RFC (None si no está registrado)"""
+        fila = self._conexion().execute(
+            "SELECT intervalo_base, intervalo, proxima, ultima, sin_cambios, criticas, fallos"
+            " FROM programadas WHERE rfc = ? AND activa = 1", (rfc,)
+        ).fetchone()
+        if fila is None:
+            return None
+        return {
+            'rfc': rfc,
+            'intervalo_base': fila[0],
+            'intervalo': round(fila[1], 1),
+            'proxima': fila[2],
+            'ultima': fila[3],
+            'sin_cambios': fila[4],
+            'alertas_criticas': fila[5],
+            'fallos': fila[6],
+        }
+
+    def instantanea(self, rfc):
+        """(Snapshot, edad) de la última instantánea del RFC, o None si no hay una vigente"""
+        entrada = self._instantaneas.get(rfc)
+        if entrada is None:
+            return None
+        edad = time.time() - entrada.momento
+        if edad > self.max_edad:
+            return None
+        return entrada, edad
+
+    # Sincronización (todos los workers)
+
+    def iniciar(self):
+        """Arranca el hilo de sincronización del worker (idempotente)"""
+        if self._hilo_sync is not None:
+            return
+        with self._lock:
+            if self._hilo_sync is not None:
+                return
+            self._hilo_sync = threading.Thread(target=self._ciclo_sync, name='programador-sync', daemon=True)
+            self._hilo_sync.start()
+
+    def _ciclo_sync(self):
+        while True:
+            try:
+                self._sincronizar_instantaneas()
+                if not self.lider and self._tomar_liderazgo():
+                    threading.Thread(target=self._ciclo_lider, name='programador-lider', daemon=True).start()
+            except Exception as e:
+                logger.error(f"Error sincronizando programador: {str(e)}")
+            time.sleep(self.intervalo_sync)
+
+    def _sincronizar_instantaneas(self):
+        # Ventana de traslape: una fila escrita con reloj ligeramente atrasado no se pierde
+        desde = self._sincronizado_hasta - 5.0
+        filas = self._conexion().execute(
+            "SELECT i.rfc, i.datos, i.actualizada FROM instantaneas i JOIN programadas p ON p.rfc = i.rfc"
+            " WHERE i.actualizada > ? AND p.activa = 1", (desde,)
+        ).fetchall()
+        for rfc, datos, actualizada in filas:
+            actual = self._instantaneas.get(rfc)
+            if actual is None or actual.momento < int(actualizada):
+                instantanea = Snapshot.desde_datos(rfc, json.loads(datos), actualizada)
+                self._instantaneas[instantanea.rfc] = instantanea
+            self._sincronizado_hasta = max(self._sincronizado_hasta, actualizada)
+
+        # RFCs dados de baja en otros workers: su instantánea deja de servirse
+        bajas = self._conexion().execute(
+            "SELECT rfc, modificada FROM programadas WHERE activa = 0 AND modificada > ?",
+            (self._bajas_hasta - 5.0,)
+        ).fetchall()
+        for rfc, modificada in bajas:
+            with self._lock:
+                self._instantaneas.pop(rfc, None)
+            self._bajas_hasta = max(self._bajas_hasta, modificada)
+
+    def _tomar_liderazgo(self):
+        """Intenta tomar el flock; solo un proceso a la vez ejecuta los refrescos"""
+        archivo = open(f"{self.ruta}.lock", 'a')
+        try:
+            fcntl.flock(archivo, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            archivo.close()
+            return False
+        # El archivo queda abierto mientras viva el proceso; al morir se libera el lock
+        self._archivo_lock = archivo
+        self.lider = True
+        logger.info(f"Worker {os.getpid()} ejecuta el refresco programado")
+        return True
+
+    # Ciclo de refresco (solo el líder)
+
+    def _ciclo_lider(self):
+        presupuesto = TokenBucket(self.tasa)
+        executor = ThreadPoolExecutor(max_workers=self.concurrencia, thread_name_prefix='programador')
+        cupos = threading.Semaphore(self.concurrencia)
+        despertar = threading.Event()
+        # El heap y las versiones solo los toca este hilo; los refrescos
+        # terminados llegan por `terminados` (deque es thread-safe)
+        self._heap = []
+        self._versiones = {}
+        self._contador = itertools.count()
+        terminados = deque()
+        sincronizado = 0.0
+        proxima_sync = 0.0
+
+        while True:
+            ahora = time.time()
+            if ahora >= proxima_sync:
+                try:
+                    sincronizado = self._sincronizar_programadas(sincronizado)
+                except sqlite3.Error as e:
+                    logger.error(f"Error leyendo RFCs programados: {str(e)}")
+                proxima_sync = ahora + self.intervalo_sync
+
+            while terminados:
+                rfc, proxima = terminados.popleft()
+                if proxima is None:
+                    self._versiones.pop(rfc, None)
+                else:
+                    self._programar(rfc, proxima)
+
+            while self._heap and self._heap[0][0] <= ahora:
+                proxima, rfc, version = self._heap[0]
+                if self._versiones.get(rfc) != version:
+                    heapq.heappop(self._heap)  # entrada obsoleta (reprogramada o eliminada)
+                    continue
+                if not cupos.acquire(blocking=False):
+                    break
+                espera = presupuesto.intentar()
+                if espera > 0:
+                    cupos.release()
+                    break
+                heapq.heappop(self._heap)
+                self._versiones[rfc] = None  # en vuelo: no se reprograma hasta terminar
+
+                def terminar(futuro, rfc=rfc):
+                    try:
+                        proxima = futuro.result()
+                    except Exception as e:
+                        logger.error(f"Error refrescando {rfc}: {str(e)}")
+                        proxima = time.time() + self.intervalo_min
+                    terminados.append((rfc, proxima))
+                    cupos.release()
+                    despertar.set()
+
+                executor.submit(self._refrescar, rfc).add_done_callback(terminar)
+
+            siguiente = self._heap[0][0] - time.time() if self._heap else self.intervalo_sync
+            despertar.wait(max(0.01, min(siguiente, proxima_sync - time.time(), 1.0 / self.tasa if self.tasa > 0 else 1.0)))
+            despertar.clear()
+
+    def _programar(self, rfc, proxima):
+        version = next(self._contador)
+        self._versiones[rfc] = version
+        heapq.heappush(self._heap, (proxima, rfc, version))
+
+    def _sincronizar_programadas(self, desde):
+        """Incorpora al heap los registros/bajas hechos por cualquier worker"""
+        filas = self._conexion().execute(
+            "SELECT rfc, activa, proxima, modificada FROM programadas WHERE modificada > ?",
+            (desde - 5.0 if desde else -1.0,)
+        ).fetchall()
+        for rfc, activa, proxima, modificada in filas:
+            desde = max(desde, modificada)
+            if rfc in self._versiones and self._versiones[rfc] is None:
+                continue  # en vuelo: al terminar se reprograma con el estado de la tabla
+            if activa:
+                self._programar(rfc, proxima)
+            else:
+                self._versiones.pop(rfc, None)
+        return desde
+
+    def _refrescar(self, rfc):
+        """Consulta un RFC y devuelve su próxima ejecución (None si ya no está programado)"""
+        conexion = self._conexion()
+        fila = conexion.execute(
+            "SELECT activa, intervalo_base, intervalo, sin_cambios, fallos FROM programadas WHERE rfc = ?", (rfc,)
+        ).fetchone()
+        if fila is None or not fila[0]:
+            return None
+        _, base, intervalo, sin_cambios, fallos = fila
+        ahora = time.time()
+
+        try:
+            data_sat = self.consultar(rfc)
+        except Exception as e:
+            data_sat = {"error": str(e)}
+
+        if "error" in data_sat:
+            # Se conserva la última instantánea buena; reintento con backoff acotado por el intervalo
+            self.errores += 1
+            fallos += 1
+            proxima = ahora + min(intervalo, 60.0 * 2 ** min(fallos - 1, 10)) * random.uniform(1 - self.jitter, 1 + self.jitter)
+            conexion.execute(
+                "UPDATE programadas SET proxima = ?, fallos = ? WHERE rfc = ?", (proxima, fallos, rfc)
+            )
+            return proxima
+
+        respuesta = self.procesar(rfc, data_sat)
+        criticas = sum(1 for alerta in respuesta.get('alertas', ()) if alerta.get('tipo') == 'critico')
+        anterior = self._instantaneas.get(rfc)
+        sin_cambio = anterior is not None and anterior.mismos_datos(data_sat)
+
+        if criticas:
+            intervalo = max(self.intervalo_min, intervalo / 2)
+        elif sin_cambio:
+            intervalo = min(self.intervalo_max, intervalo * 1.5)
+        else:
+            intervalo = base
+        sin_cambios = sin_cambios + 1 if sin_cambio else 0
+        proxima = ahora + intervalo * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+        conexion.execute("BEGIN")
+        try:
+            conexion.execute(
+                "INSERT OR REPLACE INTO instantaneas (rfc, datos, actualizada) VALUES (?, ?, ?)",
+                (rfc, json.dumps(data_sat), ahora)
+            )
+            conexion.execute(
+                "UPDATE programadas SET intervalo = ?, proxima = ?, ultima = ?, sin_cambios = ?,"
+                " criticas = ?, fallos = 0 WHERE rfc = ?",
+                (intervalo, proxima, ahora, sin_cambios, criticas, rfc)
+            )
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        with self._lock:
+            instantanea = Snapshot.desde_datos(rfc, data_sat, ahora)
+            self._instantaneas[instantanea.rfc] = instantanea
+        self.refrescos += 1
+        return proxima
+
+    def estadisticas(self):
+        try:
+            programadas = self._conexion().execute(
+                "SELECT COUNT(*) FROM programadas WHERE activa = 1"
+            ).fetchone()[0]
+        except sqlite3.Error:
+            programadas = None
+        return {
+            "programadas": programadas,
+            "instantaneas": len(self._instantaneas),
+            "lider": self.lider,
+            "refrescos": self.refrescos,
+            "errores": self.errores,
+            "tasa_max": self.tasa,
+        }
+
+
+def crear_programador(config, consultar, procesar):
+    """Construye el programador a partir de la configuración (None si está deshabilitado)"""
+    if not config.SCHEDULER_ENABLED:
+        return None
+    return RefreshScheduler(
+        config.SCHEDULER_DB_PATH,
+        consultar,
+        procesar,
+        intervalo=config.SCHEDULER_INTERVALO,
+        intervalo_min=config.SCHEDULER_INTERVALO_MIN,
+        intervalo_max=config.SCHEDULER_INTERVALO_MAX,
+        jitter=config.SCHEDULER_JITTER,
+        tasa=config.SCHEDULER_TASA,
+        concurrencia=config.SCHEDULER_CONCURRENCIA,
+        intervalo_sync=config.SCHEDULER_SYNC,
+        max_edad=config.SCHEDULER_MAX_EDAD
+    )
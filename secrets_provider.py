@@ -0,0 +1,193 @@
+"""
+Secretos (credenciales de Finkok) con caché en memoria y refresco en segundo plano.
+
+`SecretsProvider.obtener()` solo lee un diccionario en memoria: ninguna
+petición espera a Secrets Manager. Un hilo por worker vuelve a leer el
+backend antes de que venza el TTL; si la lectura falla se conserva el último
+valor bueno y se reintenta más tarde. Rotar un secreto no requiere reiniciar
+los workers: el siguiente refresco lo toma.
+
+Backends: variables de entorno y archivo JSON (desarrollo y pruebas, sin
+AWS) y AWS Secrets Manager. boto3 se importa solo con este último.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EnvBackend:
+    """Lee cada clave de la variable de entorno con su nombre en mayúsculas"""
+
+    def __init__(self, claves):
+        self.claves = tuple(claves)
+
+    def leer(self):
+        return {clave: os.environ[clave.upper()] for clave in self.claves if clave.upper() in os.environ}
+
+
+class FileBackend:
+    """Lee un archivo JSON con el mismo formato que el secreto de AWS"""
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+
+    def leer(self):
+        with open(self.ruta) as f:
+            valores = json.load(f)
+        if not isinstance(valores, dict):
+            raise ValueError(f"{self.ruta} debe contener un objeto JSON")
+        return valores
+
+
+class AWSSecretsManagerBackend:
+    """Lee un secreto JSON de AWS Secrets Manager con un cliente reutilizado por proceso.
+
+    El cliente (sesión y pool de conexiones de botocore) se crea en la primera
+    lectura y se descarta tras fork(): con `preload_app` el proveedor se
+    construye en el maestro de gunicorn y cada worker abre el suyo.
+    """
+
+    def __init__(self, nombre, region, timeout=5.0):
+        import boto3
+        from botocore.config import Config as BotoConfig
+
+        self.nombre = nombre
+        self._boto3 = boto3
+        self._opciones = {
+            'service_name': 'secretsmanager',
+            'region_name': region,
+            'config': BotoConfig(connect_timeout=timeout, read_timeout=timeout, retries={'max_attempts': 2}),
+        }
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        self._lock = threading.Lock()
+        self._cliente = None
+
+    def _cliente_proceso(self):
+        if self._cliente is None:
+            with self._lock:
+                if self._cliente is None:
+                    self._cliente = self._boto3.session.Session().client(**self._opciones)
+        return self._cliente
+
+    def leer(self):
+        respuesta = self._cliente_proceso().get_secret_value(SecretId=self.nombre)
+        valores = json.loads(respuesta['SecretString'])
+        if not isinstance(valores, dict):
+            raise ValueError(f"El secreto {self.nombre} debe ser un objeto JSON")
+        return valores
+
+
+class SecretsProvider:
+    """Caché con TTL de los secretos, refrescada por un hilo de fondo.
+
+    El refresco ocurre a `(1 - anticipacion) * ttl` segundos de la última
+    lectura buena; tras un fallo se reintenta cada `reintento` segundos
+    mientras se sigue sirviendo el último valor bueno.
+    """
+
+    def __init__(self, backend, ttl=300.0, anticipacion=0.2, reintento=30.0):
+        self.backend = backend
+        self.ttl = ttl
+        self.anticipacion = anticipacion
+        self.reintento = reintento
+        self._valores = {}
+        self._leido = None
+        self.version = 0
+        self.refrescos = 0
+        self.errores = 0
+        self.ultimo_error = None
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+        # Primera lectura al construir (arranque del proceso), nunca en una petición
+        self.refrescar()
+
+    def _reiniciar(self):
+        # Los valores se heredan del padre; el hilo no sobrevive a fork()
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def obtener(self, clave, defecto=None):
+        """Último valor bueno de la clave (no bloquea)"""
+        if self._hilo is None:
+            self.iniciar()
+        return self._valores.get(clave, defecto)
+
+    def iniciar(self):
+        """Arranca el hilo de refresco del worker (idempotente)"""
+        if self._hilo is not None or self.ttl <= 0:
+            return
+        with self._lock:
+            if self._hilo is not None:
+                return
+            self._hilo = threading.Thread(target=self._ciclo, name='secretos-refresco', daemon=True)
+            self._hilo.start()
+
+    def solicitar_refresco(self):
+        """Adelanta el siguiente refresco (p. ej. tras rotar el secreto)"""
+        self._proximo = 0.0
+        self._despertar.set()
+
+    def _ciclo(self):
+        while True:
+            espera = self._proximo - time.time()
+            if espera > 0:
+                self._despertar.wait(espera)
+                self._despertar.clear()
+                if self._proximo > time.time():
+                    continue
+            self.refrescar()
+
+    def refrescar(self):
+        """Lee el backend; ante un error conserva el último valor bueno"""
+        ahora = time.time()
+        try:
+            valores = self.backend.leer()
+        except Exception as e:
+            self.errores += 1
+            self.ultimo_error = f"{type(e).__name__}: {str(e)}"
+            self._proximo = ahora + self.reintento
+            logger.error(f"Error leyendo secretos; se conserva el último valor bueno: {self.ultimo_error}")
+            return False
+        if valores != self._valores:
+            if self._leido is not None:
+                logger.info("Secretos rotados")
+            self.version += 1
+        # Se reemplaza el diccionario completo: los lectores nunca ven uno a medias
+        self._valores = valores
+        self._leido = ahora
+        self.refrescos += 1
+        self._proximo = ahora + max(1.0, self.ttl * (1 - self.anticipacion))
+        return True
+
+    def estadisticas(self):
+        """Estado del proveedor, sin los valores de los secretos"""
+        return {
+            "backend": type(self.backend).__name__,
+            "version": self.version,
+            "edad_segundos": round(time.time() - self._leido, 1) if self._leido is not None else None,
+            "refrescos": self.refrescos,
+            "errores": self.errores,
+            "ultimo_error": self.ultimo_error,
+        }
+
+
+def crear_proveedor_secretos(config):
+    """Construye el proveedor de secretos a partir de la configuración"""
+    if config.SECRETS_BACKEND == 'aws':
+        backend = AWSSecretsManagerBackend(config.SECRET_NAME, config.AWS_REGION)
+    elif config.SECRETS_BACKEND == 'archivo':
+        backend = FileBackend(config.SECRETS_FILE)
+    else:
+        backend = EnvBackend(('finkok_username', 'finkok_password'))
+    return SecretsProvider(backend, ttl=config.SECRETS_TTL, reintento=config.SECRETS_REINTENTO)
@@ -0,0 +1,483 @@
+#!/usr/bin/env python3
+"""
+Arranque del servicio: perfil de gunicorn calculado y supervisor con recarga sin cortes.
+
+`perfil()` deriva workers e hilos de los CPUs disponibles, de la memoria y de
+la fracción del tiempo de cada petición que se pasa esperando a Finkok (la
+fase `finkok` de las trazas volcadas en METRICS_DIR, o SERVER_RAZON_ESPERA):
+con una razón de espera W cada CPU rinde con 1 / (1 - W) peticiones en curso.
+También arma la jerarquía de timeouts: el presupuesto de una consulta a Finkok
+(intentos, timeouts y backoff, recortados por el cliente en upstream.py) < el
+deadline de la aplicación < el timeout de gunicorn < el de nginx, separados
+por SERVER_MARGEN_TIMEOUT. gunicorn.conf.py
+lee este mismo perfil, así que `gunicorn app:app` directo también lo usa.
+
+`Supervisor` abre el socket una sola vez y lanza el maestro de gunicorn
+entregándoselo con el protocolo de activación por socket de systemd
+(LISTEN_FDS). Con SIGHUP lanza un maestro nuevo sobre el mismo socket, espera
+a que todos sus workers terminen `post_worker_init` y solo entonces detiene
+el anterior con SIGTERM: sus workers dejan de aceptar y terminan las
+consultas en curso, mientras las conexiones nuevas ya las atiende el maestro
+nuevo desde la misma cola del kernel. Si el maestro nuevo no llega a estar
+listo se descarta y el anterior sigue sirviendo. A diferencia del SIGHUP de
+gunicorn (que con `preload_app` no vuelve a importar el código), así se
+carga el código nuevo tras un despliegue.
+
+Ejecutar con:
+    python server.py                          # supervisor (unidad systemd)
+    python server.py --perfil                 # perfil calculado, en JSON
+    python server.py --campo timeouts.proxy   # un solo valor del perfil
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import deque
+
+from gunicorn.workers.gthread import ThreadWorker as _ThreadWorker
+
+from metrics import histogramas_volcados
+from settings import Config
+from upstream import consumidores_finkok, presupuesto_finkok, tamano_pool
+
+logger = logging.getLogger(__name__)
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+# Primer descriptor del protocolo LISTEN_FDS de systemd
+FD_SOCKET = 3
+
+# Muestras de la fase finkok necesarias para confiar en la razón medida
+MIN_MUESTRAS = 200
+RAZON_ESPERA_DEFECTO = 0.9
+RAZON_ESPERA_MAX = 0.99
+
+# Fracción de la memoria que pueden ocupar los workers
+FRACCION_MEMORIA = 0.75
+
+CLASES_WORKER = {
+    'sync': ('sync', 'app:app'),
+    'gthread': ('server.ThreadWorker', 'app:app'),
+    'async': ('uvicorn.workers.UvicornWorker', 'asgi_app:app'),
+}
+
+
+def cpus():
+    """CPUs que puede usar este proceso (respeta la afinidad y los cpusets)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def memoria_mb():
+    """Memoria total de la máquina en MB (None si no se puede leer)"""
+    try:
+        with open('/proc/meminfo') as f:
+            for linea in f:
+                if linea.startswith('MemTotal:'):
+                    return int(linea.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def razon_espera(config):
+    """Fracción del tiempo de las peticiones esperando a Finkok y su origen"""
+    if config.SERVER_RAZON_ESPERA > 0:
+        return min(config.SERVER_RAZON_ESPERA, RAZON_ESPERA_MAX), 'configurada'
+    histogramas = histogramas_volcados(config.METRICS_DIR) if config.METRICS_DIR else {}
+    finkok = histogramas.get('fase_finkok')
+    if finkok is not None and finkok[-1] >= MIN_MUESTRAS:
+        total = sum(valores[-2] for nombre, valores in histogramas.items() if nombre.startswith('fase_'))
+        if total > 0:
+            return round(min(finkok[-2] / total, RAZON_ESPERA_MAX), 3), 'medida'
+    return RAZON_ESPERA_DEFECTO, 'por_defecto'
+
+
+def timeout_finkok(config):
+    """Peor caso de una consulta a Finkok: todos los intentos agotan sus timeouts,
+    acotado por el presupuesto que impone el cliente"""
+    intentos = config.FINKOK_RETRIES + 1
+    backoff = sum(min(config.FINKOK_BACKOFF_MAX, config.FINKOK_BACKOFF_BASE * (2 ** i))
+                  for i in range(config.FINKOK_RETRIES))
+    peor = intentos * (config.FINKOK_CONNECT_TIMEOUT + config.FINKOK_READ_TIMEOUT) + backoff
+    presupuesto = presupuesto_finkok(config)
+    return peor if presupuesto is None else min(peor, presupuesto)
+
+
+def perfil(config):
+    """Workers, hilos y timeouts de gunicorn (y el timeout de nginx) para esta máquina"""
+    if config.SERVER_WORKER_CLASS not in CLASES_WORKER:
+        raise ValueError(f"SERVER_WORKER_CLASS debe ser uno de: {', '.join(CLASES_WORKER)}")
+    clase, aplicacion_wsgi = CLASES_WORKER[config.SERVER_WORKER_CLASS]
+    if config.SERVER_WORKER_CLASS == 'gthread':
+        verificar_gthread()
+    advertencias = []
+    n_cpus = cpus()
+    memoria = memoria_mb()
+    razon, origen = razon_espera(config)
+
+    # Peticiones en curso por CPU para mantenerlo ocupado mientras las demás esperan
+    hilos = max(1, min(config.SERVER_MAX_THREADS, math.ceil(round(1 / (1 - razon), 6))))
+    if config.SERVER_WORKER_CLASS == 'gthread':
+        workers, threads = max(2, n_cpus), max(2, hilos)
+    elif config.SERVER_WORKER_CLASS == 'sync':
+        workers, threads = max(2, n_cpus * hilos), 1
+    else:
+        # Un event loop por CPU; la concurrencia la da asyncio
+        workers, threads = max(2, n_cpus), 1
+
+    if memoria and config.SERVER_MEMORIA_WORKER_MB > 0:
+        tope = max(1, int(memoria * FRACCION_MEMORIA // config.SERVER_MEMORIA_WORKER_MB))
+        if workers > tope:
+            advertencias.append(f"workers limitados a {tope} por memoria ({memoria} MB)")
+            workers = tope
+    if config.SERVER_WORKERS > 0:
+        workers = config.SERVER_WORKERS
+    if config.SERVER_THREADS > 0 and config.SERVER_WORKER_CLASS == 'gthread':
+        threads = config.SERVER_THREADS
+
+    margen = config.SERVER_MARGEN_TIMEOUT
+    finkok = timeout_finkok(config)
+    deadlines = [d for d in (config.ADMISSION_DEADLINE, config.MULTIPLE_DEADLINE) if d > 0]
+    aplicacion = max(deadlines) if deadlines else finkok + margen
+    if deadlines and finkok + margen > min(deadlines):
+        advertencias.append(
+            f"el deadline de la aplicación ({min(deadlines):g}s) no cubre el presupuesto de"
+            f" Finkok ({finkok:g}s) más el margen ({margen:g}s, SERVER_MARGEN_TIMEOUT)"
+        )
+    servidor = math.ceil(aplicacion + margen)
+    # nginx también cuenta la espera en la cola del socket antes de que un worker acepte
+    proxy = math.ceil(servidor + margen + config.ADMISSION_MAX_COLA_MS / 1000.0)
+
+    if config.SERVER_WORKER_CLASS == 'sync' and config.MULTIPLE_STREAM_DEADLINE > servidor:
+        advertencias.append(
+            f"con workers sync una respuesta en flujo de más de {servidor}s mata al worker"
+            " (MULTIPLE_STREAM_DEADLINE); usar gthread o async"
+        )
+    consumidores = consumidores_finkok(config, threads)
+    if config.SERVER_WORKER_CLASS != 'async' and config.FINKOK_POOL_BLOCK and tamano_pool(config) < consumidores:
+        advertencias.append(
+            f"{consumidores} hilos comparten {tamano_pool(config)} conexiones a Finkok con"
+            " FINKOK_POOL_BLOCK: un hilo sin conexión libre espera sin límite de tiempo"
+        )
+
+    return {
+        'cpus': n_cpus,
+        'memoria_mb': memoria,
+        'razon_espera': razon,
+        'origen_razon_espera': origen,
+        'worker_class': clase,
+        'wsgi_app': aplicacion_wsgi,
+        'workers': workers,
+        'threads': threads,
+        'timeout': servidor,
+        'graceful_timeout': servidor,
+        'max_requests': config.SERVER_MAX_REQUESTS,
+        'max_requests_jitter': config.SERVER_MAX_REQUESTS // 10,
+        'timeouts': {
+            'finkok': round(finkok, 2),
+            'aplicacion': round(aplicacion, 2),
+            'servidor': servidor,
+            'proxy': proxy,
+        },
+        'advertencias': advertencias,
+    }
+
+
+# Campos del gthread de gunicorn que usa ThreadWorker y el método que los crea
+CAMPOS_GTHREAD = {
+    '__init__': ('_lock', 'poller', '_keep', 'nr_conns'),
+    'init_process': ('_lock', 'poller'),
+    'run': ('alive', 'poller', 'nr_conns', 'sockets'),
+}
+
+
+def verificar_gthread():
+    """Falla al arrancar si el gthread instalado no tiene los campos internos que usa ThreadWorker"""
+    import gunicorn
+
+    faltantes = [f"{metodo}.{campo}" for metodo, campos in CAMPOS_GTHREAD.items()
+                 for campo in campos if campo not in getattr(_ThreadWorker, metodo).__code__.co_names]
+    if faltantes:
+        raise RuntimeError(
+            f"server.ThreadWorker no es compatible con gunicorn {gunicorn.__version__}"
+            f" (no usa {', '.join(faltantes)}): instalar la versión de requirements.txt"
+            " o usar SERVER_WORKER_CLASS=sync"
+        )
+
+
+class ThreadWorker(_ThreadWorker):
+    """Worker gthread que al salir atiende las conexiones que ya aceptó.
+
+    El de gunicorn cierra su poller en cuanto `alive` pasa a False (SIGTERM o
+    max_requests): una conexión aceptada cuya petición aún no se leía se
+    corta. Este deja de aceptar y sigue en su ciclo mientras queden
+    conexiones fuera de keep-alive, hasta graceful_timeout.
+    """
+
+    _vivo = True
+    _limite = None
+    _aceptando = True
+
+    @property
+    def alive(self):
+        if self._vivo or self._limite is None:
+            return self._vivo
+        if self._aceptando:
+            self._aceptando = False
+            with self._lock:
+                for sock in self.sockets:
+                    try:
+                        self.poller.unregister(sock)
+                    except (KeyError, ValueError):
+                        pass
+        return self.nr_conns > len(self._keep) and time.monotonic() < self._limite
+
+    @alive.setter
+    def alive(self, valor):
+        # Se llama desde el manejador de señales: solo registra el momento
+        self._vivo = valor
+        if not valor and self._limite is None:
+            self._limite = time.monotonic() + self.cfg.graceful_timeout
+
+
+def abrir_socket(bind):
+    """Socket de escucha para 'host:puerto' o 'unix:/ruta'"""
+    if bind.startswith('unix:'):
+        ruta = bind[len('unix:'):]
+        if os.path.exists(ruta):
+            os.unlink(ruta)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(ruta)
+    else:
+        host, _, puerto = bind.rpartition(':')
+        host = host.strip('[]') or '0.0.0.0'
+        sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(puerto)))
+    sock.listen(2048)
+    return sock
+
+
+def notificar_systemd(estado):
+    """Avisa a systemd (Type=notify); sin NOTIFY_SOCKET no hace nada"""
+    from gunicorn.systemd import sd_notify
+
+    sd_notify(estado, logger)
+
+
+class Maestro:
+    """Un maestro de gunicorn y el pipe por el que cada worker avisa que está listo"""
+
+    def __init__(self, proceso, avisos_fd, workers, timeout):
+        self.proceso = proceso
+        self.avisos_fd = avisos_fd
+        self.workers = workers
+        self.timeout = timeout
+        self.avisos = 0
+        self.detenido = None
+
+    def leer_avisos(self):
+        try:
+            while True:
+                leido = os.read(self.avisos_fd, 1024)
+                if not leido:
+                    break
+                self.avisos += len(leido)
+        except BlockingIOError:
+            pass
+
+    def vivo(self):
+        return self.proceso.poll() is None
+
+    def detener(self):
+        """SIGTERM: gunicorn deja de aceptar y espera a que terminen las peticiones en curso"""
+        if self.detenido is None and self.vivo():
+            self.proceso.send_signal(signal.SIGTERM)
+        self.detenido = time.monotonic()
+
+    def cerrar(self):
+        os.close(self.avisos_fd)
+
+
+class Supervisor:
+    """Mantiene un maestro de gunicorn sobre un socket que nunca se cierra"""
+
+    def __init__(self, config, argumentos=()):
+        self.config = config
+        self.argumentos = list(argumentos)
+        self.actual = None
+        self.retirados = []
+        self._pendientes = deque()
+        self._socket = None
+
+    def _preparar_socket(self):
+        self._socket = abrir_socket(self.config.SERVER_BIND)
+        if self._socket.fileno() != FD_SOCKET:
+            try:
+                os.fstat(FD_SOCKET)
+            except OSError:
+                os.dup2(self._socket.fileno(), FD_SOCKET)
+            else:
+                raise RuntimeError(f"El descriptor {FD_SOCKET} ya está en uso; no se puede entregar el socket")
+
+    def _lanzar(self):
+        datos = perfil(self.config)
+        for advertencia in datos['advertencias']:
+            logger.warning(advertencia)
+        lectura, escritura = os.pipe()
+        os.set_blocking(lectura, False)
+        entorno = {
+            'LISTEN_FDS': '1',
+            'SERVER_AVISO_FD': str(escritura),
+            # El maestro usa exactamente los workers que se esperan aquí
+            'SERVER_WORKERS': str(datos['workers']),
+            'SERVER_THREADS': str(datos['threads']),
+        }
+
+        def preparar():
+            # En el hijo, antes de exec: LISTEN_PID debe ser el PID del maestro
+            os.environ.update(entorno)
+            os.environ['LISTEN_PID'] = str(os.getpid())
+            os.environ.pop('NOTIFY_SOCKET', None)
+
+        proceso = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '-c', os.path.join(DIRECTORIO, 'gunicorn.conf.py')]
+            + self.argumentos,
+            cwd=DIRECTORIO,
+            pass_fds=(FD_SOCKET, escritura),
+            preexec_fn=preparar,
+            start_new_session=True
+        )
+        os.close(escritura)
+        logger.info(f"Maestro {proceso.pid}: {datos['workers']} workers {datos['worker_class']}"
+                    f" x {datos['threads']} hilos, timeout {datos['timeout']}s")
+        return Maestro(proceso, lectura, datos['workers'], datos['graceful_timeout'])
+
+    def _esperar_listo(self, maestro):
+        """True cuando todos los workers del maestro pasaron post_worker_init"""
+        limite = time.monotonic() + maestro.timeout
+        while time.monotonic() < limite:
+            maestro.leer_avisos()
+            if maestro.avisos >= maestro.workers:
+                return True
+            if not maestro.vivo() or signal.SIGTERM in self._pendientes:
+                return False
+            time.sleep(0.1)
+        return False
+
+    def _descartar(self, maestro):
+        if maestro.vivo():
+            maestro.proceso.kill()
+            maestro.proceso.wait()
+        maestro.cerrar()
+
+    def recargar(self):
+        """Lanza un maestro nuevo y retira el actual solo si el nuevo quedó listo"""
+        notificar_systemd("RELOADING=1")
+        nuevo = self._lanzar()
+        if not self._esperar_listo(nuevo):
+            logger.error(f"El maestro {nuevo.proceso.pid} no quedó listo; se conserva {self.actual.proceso.pid}")
+            self._descartar(nuevo)
+        else:
+            logger.info(f"Maestro {nuevo.proceso.pid} listo; retirando {self.actual.proceso.pid}")
+            self.actual.detener()
+            self.retirados.append(self.actual)
+            self.actual = nuevo
+        notificar_systemd("READY=1")
+
+    def _recoger_retirados(self):
+        ahora = time.monotonic()
+        for maestro in list(self.retirados):
+            maestro.leer_avisos()
+            if maestro.vivo() and ahora - maestro.detenido > maestro.timeout + self.config.SERVER_MARGEN_TIMEOUT:
+                logger.warning(f"El maestro {maestro.proceso.pid} no terminó a tiempo; se mata")
+                maestro.proceso.kill()
+            if not maestro.vivo():
+                maestro.cerrar()
+                self.retirados.remove(maestro)
+
+    def detener(self):
+        """Detiene todos los maestros con SIGTERM y espera a que terminen"""
+        notificar_systemd("STOPPING=1")
+        maestros = [self.actual] + self.retirados
+        for maestro in maestros:
+            maestro.detener()
+        for maestro in maestros:
+            try:
+                maestro.proceso.wait(maestro.timeout + self.config.SERVER_MARGEN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                maestro.proceso.kill()
+                maestro.proceso.wait()
+            maestro.cerrar()
+
+    def ejecutar(self):
+        """Bucle principal: SIGHUP recarga, SIGTERM/SIGINT detienen con gracia"""
+        for senal in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(senal, lambda signum, frame: self._pendientes.append(signum))
+        self._preparar_socket()
+
+        self.actual = self._lanzar()
+        if not self._esperar_listo(self.actual):
+            logger.error("El maestro de gunicorn no quedó listo")
+            self.detener()
+            return 1
+        notificar_systemd("READY=1")
+
+        while True:
+            while self._pendientes:
+                senal = self._pendientes.popleft()
+                if senal == signal.SIGHUP:
+                    self.recargar()
+                else:
+                    logger.info("Deteniendo el servicio")
+                    self.detener()
+                    return 0
+            self.actual.leer_avisos()
+            self._recoger_retirados()
+            if not self.actual.vivo():
+                # systemd (Restart=always) vuelve a arrancar el servicio completo
+                logger.error(f"El maestro {self.actual.proceso.pid} terminó inesperadamente")
+                for maestro in self.retirados:
+                    maestro.detener()
+                self.actual.cerrar()
+                return self.actual.proceso.returncode or 1
+            time.sleep(0.2)
+
+
+def valor_campo(datos, campo):
+    """Valor de un campo con puntos (p. ej. 'timeouts.proxy')"""
+    for parte in campo.split('.'):
+        datos = datos[parte]
+    return datos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--perfil', action='store_true', help='Imprime el perfil calculado en JSON')
+    parser.add_argument('--campo', help="Imprime un campo del perfil (p. ej. 'timeouts.proxy')")
+    args, gunicorn_args = parser.parse_known_args()
+
+    config = Config()
+    if args.perfil:
+        print(json.dumps(perfil(config), indent=2))
+        return 0
+    if args.campo:
+        print(valor_campo(perfil(config), args.campo))
+        return 0
+
+    logging.basicConfig(level=logging.INFO, format='[supervisor] %(levelname)s %(message)s')
+    return Supervisor(config, gunicorn_args).ejecutar()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+"""
+Configuración del servicio a partir de variables de entorno.
+
+Vive fuera de app.py para que el arranque (server.py, gunicorn.conf.py) pueda
+leerla sin importar la aplicación.
+"""
+
+import os
+
+
+# Configuración (en producción usar variables de entorno)
+class Config:
+    FINKOK_API_URL = os.getenv('FINKOK_API_URL', "https://api.finkok.com/v3/cfdi33/status")
+    FINKOK_USERNAME = os.getenv('FINKOK_USERNAME', 'tu_usuario_finkok')
+    FINKOK_PASSWORD = os.getenv('FINKOK_PASSWORD', 'tu_password_finkok')
+    # Origen de las credenciales de Finkok: 'env' (FINKOK_USERNAME/PASSWORD),
+    # 'archivo' (JSON en SECRETS_FILE) o 'aws' (Secrets Manager); se releen cada
+    # SECRETS_TTL segundos en segundo plano y tras un error cada SECRETS_REINTENTO
+    SECRETS_BACKEND = os.getenv('SECRETS_BACKEND', 'env')
+    SECRETS_FILE = os.getenv('SECRETS_FILE', '/etc/monitor-sat/secretos.json')
+    SECRET_NAME = os.getenv('SECRET_NAME', 'monitor-sat/credentials')
+    AWS_REGION = os.getenv('AWS_REGION', 'us-east-2')
+    SECRETS_TTL = float(os.getenv('SECRETS_TTL', '300'))
+    SECRETS_REINTENTO = float(os.getenv('SECRETS_REINTENTO', '30'))
+    CERT_PATH = os.getenv('CERT_PATH', 'certificados/cert.cer')
+    KEY_PATH = os.getenv('KEY_PATH', 'certificados/key.key')
+    # Directorio opcional con certificados por RFC: <RFC>.cer / <RFC>.key
+    CERTS_DIR = os.getenv('CERTS_DIR')
+    # Segundos entre revisiones de mtime/inode de los certificados
+    CERT_STAT_INTERVAL = float(os.getenv('CERT_STAT_INTERVAL', '5'))
+    # Consulta múltiple: máximo de RFCs por petición, hilos concurrentes
+    # y tiempo límite (segundos) para todo el lote
+    MULTIPLE_MAX_RFCS = int(os.getenv('MULTIPLE_MAX_RFCS', '10'))
+    MULTIPLE_MAX_WORKERS = int(os.getenv('MULTIPLE_MAX_WORKERS', '10'))
+    MULTIPLE_DEADLINE = float(os.getenv('MULTIPLE_DEADLINE', '45'))
+    # Consulta múltiple en flujo (NDJSON/SSE): máximo de RFCs y tiempo límite;
+    # la memoria no depende del tamaño del lote
+    MULTIPLE_STREAM_MAX_RFCS = int(os.getenv('MULTIPLE_STREAM_MAX_RFCS', '1000'))
+    MULTIPLE_STREAM_DEADLINE = float(os.getenv('MULTIPLE_STREAM_DEADLINE', '600'))
+    # Cliente de Finkok: pool de conexiones (hosts y conexiones por host; 0 =
+    # una por cada hilo del worker que consulta a Finkok), timeouts de
+    # conexión/lectura, reintentos con backoff y circuit breaker. Con
+    # FINKOK_POOL_BLOCK un hilo sin conexión libre espera sin límite de tiempo
+    # (requests no pasa un timeout de pool); sin él abre una conexión extra
+    FINKOK_POOL_CONNECTIONS = int(os.getenv('FINKOK_POOL_CONNECTIONS', '4'))
+    FINKOK_POOL_MAXSIZE = int(os.getenv('FINKOK_POOL_MAXSIZE', '0'))
+    FINKOK_POOL_BLOCK = os.getenv('FINKOK_POOL_BLOCK', 'False').lower() == 'true'
+    FINKOK_CONNECT_TIMEOUT = float(os.getenv('FINKOK_CONNECT_TIMEOUT', '3.05'))
+    FINKOK_READ_TIMEOUT = float(os.getenv('FINKOK_READ_TIMEOUT', '25'))
+    FINKOK_RETRIES = int(os.getenv('FINKOK_RETRIES', '2'))
+    FINKOK_BACKOFF_BASE = float(os.getenv('FINKOK_BACKOFF_BASE', '0.2'))
+    FINKOK_BACKOFF_MAX = float(os.getenv('FINKOK_BACKOFF_MAX', '2'))
+    BREAKER_UMBRAL = int(os.getenv('BREAKER_UMBRAL', '5'))
+    BREAKER_RESET = float(os.getenv('BREAKER_RESET', '30'))
+    # Lotes: URL de Finkok que acepta varios RFCs por petición (vacía desactiva),
+    # ventana (ms) para juntar consultas simultáneas y máximo de RFCs por lote
+    FINKOK_BATCH_URL = os.getenv('FINKOK_BATCH_URL', '')
+    FINKOK_BATCH_VENTANA_MS = float(os.getenv('FINKOK_BATCH_VENTANA_MS', '5'))
+    FINKOK_BATCH_MAX = int(os.getenv('FINKOK_BATCH_MAX', '50'))
+    # Modo ASGI: conexiones simultáneas máximas hacia Finkok por proceso
+    ASGI_MAX_CONEXIONES = int(os.getenv('ASGI_MAX_CONEXIONES', '200'))
+    # Caché de resultados: TTL (segundos) para respuestas válidas y con error,
+    # tamaño máximo y backend ('memoria' o 'sqlite' compartido entre workers);
+    # los respaldos del modo degradado tienen su propio tope (CACHE_MAX_RESPALDOS)
+    CACHE_TTL = float(os.getenv('CACHE_TTL', '300'))
+    CACHE_TTL_NEGATIVO = float(os.getenv('CACHE_TTL_NEGATIVO', '30'))
+    CACHE_MAX_ENTRADAS = int(os.getenv('CACHE_MAX_ENTRADAS', '10000'))
+    CACHE_MAX_RESPALDOS = int(os.getenv('CACHE_MAX_RESPALDOS', '10000'))
+    CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memoria')
+    CACHE_SQLITE_PATH = os.getenv('CACHE_SQLITE_PATH', '/tmp/monitor_sat/cache.sqlite3')
+    # Modo degradado: antigüedad máxima (segundos) del último resultado bueno
+    # que cada endpoint sirve si Finkok falla o tarda más de STALE_ESPERA
+    # segundos (0 desactiva), hilos que siguen la consulta en segundo plano y
+    # máximo de esas consultas en curso o en cola (pasado el tope, o si el RFC
+    # ya tiene una en curso, el respaldo se sirve sin encolar otra)
+    STALE_MAX_EDAD_SAT = float(os.getenv('STALE_MAX_EDAD_SAT', '86400'))
+    STALE_MAX_EDAD_MULTIPLE = float(os.getenv('STALE_MAX_EDAD_MULTIPLE', '86400'))
+    STALE_MAX_EDAD_JOBS = float(os.getenv('STALE_MAX_EDAD_JOBS', '0'))
+    STALE_ESPERA = float(os.getenv('STALE_ESPERA', '3'))
+    STALE_HILOS = int(os.getenv('STALE_HILOS', '4'))
+    STALE_MAX_PENDIENTES = int(os.getenv('STALE_MAX_PENDIENTES', '16'))
+    # Trabajos masivos (POST /jobs; JOBS_ENABLED): directorio de trabajo, consultas
+    # simultáneas por trabajo, máximo de consultas por segundo entre todos los
+    # trabajos, trabajos en ejecución a la vez entre todos los workers (los
+    # demás esperan en cola; 0 = sin límite) y tamaño máximo de la entrada
+    JOBS_ENABLED = os.getenv('JOBS_ENABLED', 'True').lower() == 'true'
+    JOBS_DIR = os.getenv('JOBS_DIR', '/tmp/monitor_sat/jobs')
+    JOBS_CONCURRENCIA = int(os.getenv('JOBS_CONCURRENCIA', '5'))
+    JOBS_TASA = float(os.getenv('JOBS_TASA', '10'))
+    JOBS_MAX_CONCURRENTES = int(os.getenv('JOBS_MAX_CONCURRENTES', '2'))
+    JOBS_MAX_BYTES = int(os.getenv('JOBS_MAX_BYTES', str(50 * 1024 * 1024)))
+    # Métricas: directorio compartido donde cada worker vuelca su instantánea
+    METRICS_DIR = os.getenv('METRICS_DIR', '/tmp/monitor_sat/metrics')
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+    # Historial de instantáneas por RFC (SQLite WAL), escrito por lotes en
+    # segundo plano cada HISTORY_FLUSH_INTERVAL segundos o HISTORY_BATCH instantáneas
+    HISTORY_ENABLED = os.getenv('HISTORY_ENABLED', 'True').lower() == 'true'
+    HISTORY_DB_PATH = os.getenv('HISTORY_DB_PATH', '/tmp/monitor_sat/historial.sqlite3')
+    HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '1'))
+    HISTORY_BATCH = int(os.getenv('HISTORY_BATCH', '500'))
+    HISTORY_QUEUE_MAX = int(os.getenv('HISTORY_QUEUE_MAX', '10000'))
+    # Refresco programado de RFCs registrados: intervalo base y límites del
+    # intervalo adaptativo (segundos), jitter relativo, presupuesto global de
+    # consultas por segundo a Finkok y antigüedad máxima de las instantáneas servidas
+    SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'True').lower() == 'true'
+    SCHEDULER_DB_PATH = os.getenv('SCHEDULER_DB_PATH', '/tmp/monitor_sat/programador.sqlite3')
+    SCHEDULER_INTERVALO = float(os.getenv('SCHEDULER_INTERVALO', '3600'))
+    SCHEDULER_INTERVALO_MIN = float(os.getenv('SCHEDULER_INTERVALO_MIN', '300'))
+    SCHEDULER_INTERVALO_MAX = float(os.getenv('SCHEDULER_INTERVALO_MAX', '86400'))
+    SCHEDULER_JITTER = float(os.getenv('SCHEDULER_JITTER', '0.1'))
+    SCHEDULER_TASA = float(os.getenv('SCHEDULER_TASA', '2'))
+    SCHEDULER_CONCURRENCIA = int(os.getenv('SCHEDULER_CONCURRENCIA', '4'))
+    SCHEDULER_SYNC = float(os.getenv('SCHEDULER_SYNC', '2'))
+    SCHEDULER_MAX_EDAD = float(os.getenv('SCHEDULER_MAX_EDAD', '86400'))
+    # Alertas por webhook: cambios de alertas por RFC entregados en lotes
+    # (hasta ALERTS_BATCH eventos o ALERTS_BATCH_WINDOW segundos por webhook),
+    # con reintentos y backoff; lo que no se entrega va al archivo de dead-letter
+    ALERTS_ENABLED = os.getenv('ALERTS_ENABLED', 'True').lower() == 'true'
+    ALERTS_DB_PATH = os.getenv('ALERTS_DB_PATH', '/tmp/monitor_sat/alertas.sqlite3')
+    ALERTS_DEAD_LETTER_PATH = os.getenv('ALERTS_DEAD_LETTER_PATH', '/tmp/monitor_sat/alertas_dead_letter.ndjson')
+    ALERTS_BATCH = int(os.getenv('ALERTS_BATCH', '50'))
+    ALERTS_BATCH_WINDOW = float(os.getenv('ALERTS_BATCH_WINDOW', '2'))
+    ALERTS_RETRIES = int(os.getenv('ALERTS_RETRIES', '5'))
+    ALERTS_BACKOFF_BASE = float(os.getenv('ALERTS_BACKOFF_BASE', '1'))
+    ALERTS_BACKOFF_MAX = float(os.getenv('ALERTS_BACKOFF_MAX', '60'))
+    ALERTS_CONCURRENCIA = int(os.getenv('ALERTS_CONCURRENCIA', '10'))
+    ALERTS_TIMEOUT = float(os.getenv('ALERTS_TIMEOUT', '10'))
+    ALERTS_QUEUE_MAX = int(os.getenv('ALERTS_QUEUE_MAX', '10000'))
+    ALERTS_SYNC = float(os.getenv('ALERTS_SYNC', '5'))
+    # Acceso a /webhooks, /carteras y /jobs: API_ADMIN_TOKEN (cabecera X-Admin-Token)
+    # ve y administra todo; cada clave de API_KEYS (X-API-Key, separadas por
+    # comas) solo lo suyo, y sus webhooks siempre con filtro de RFCs. Sin
+    # ninguna de las dos configurada, esas rutas quedan cerradas (también se
+    # leen los nombres anteriores ALERTS_ADMIN_TOKEN y ALERTS_API_KEYS).
+    # ALERTS_PERMITIR_PRIVADOS acepta destinos en la red interna (solo para desarrollo)
+    API_ADMIN_TOKEN = os.getenv('API_ADMIN_TOKEN', os.getenv('ALERTS_ADMIN_TOKEN', ''))
+    API_KEYS = tuple(clave.strip() for clave in os.getenv('API_KEYS', os.getenv('ALERTS_API_KEYS', '')).split(',')
+                     if clave.strip())
+    ALERTS_PERMITIR_PRIVADOS = os.getenv('ALERTS_PERMITIR_PRIVADOS', 'False').lower() == 'true'
+    # Carteras de RFCs: totales, alertas por tipo y top de riesgo mantenidos
+    # con cada instantánea nueva (escritura por lotes como el historial);
+    # máximo de RFCs por petición y del top que se puede pedir
+    PORTFOLIO_ENABLED = os.getenv('PORTFOLIO_ENABLED', 'True').lower() == 'true'
+    PORTFOLIO_DB_PATH = os.getenv('PORTFOLIO_DB_PATH', '/tmp/monitor_sat/carteras.sqlite3')
+    PORTFOLIO_FLUSH_INTERVAL = float(os.getenv('PORTFOLIO_FLUSH_INTERVAL', '1'))
+    PORTFOLIO_BATCH = int(os.getenv('PORTFOLIO_BATCH', '500'))
+    PORTFOLIO_QUEUE_MAX = int(os.getenv('PORTFOLIO_QUEUE_MAX', '10000'))
+    PORTFOLIO_MAX_RFCS = int(os.getenv('PORTFOLIO_MAX_RFCS', '5000'))
+    PORTFOLIO_TOP_MAX = int(os.getenv('PORTFOLIO_TOP_MAX', '100'))
+    # Límite por cliente (API key en X-API-Key o IP): consultas de RFC por
+    # minuto y ráfaga máxima, compartido entre workers en SQLite (0 = sin límite).
+    # Detrás de nginx la IP viene de X-Real-IP
+    RATE_LIMIT = float(os.getenv('RATE_LIMIT', '600'))
+    RATE_LIMIT_RAFAGA = float(os.getenv('RATE_LIMIT_RAFAGA', '60'))
+    RATE_LIMIT_DB_PATH = os.getenv('RATE_LIMIT_DB_PATH', '/tmp/monitor_sat/limites.sqlite3')
+    RATE_LIMIT_TRUST_PROXY = os.getenv('RATE_LIMIT_TRUST_PROXY', 'True').lower() == 'true'
+    # Control de admisión: 503 inmediato si la petición esperó más de
+    # ADMISSION_MAX_COLA_MS en la cola (X-Request-Start de nginx), si hay
+    # demasiadas en curso en el proceso o si el tiempo estimado supera
+    # ADMISSION_DEADLINE (por debajo del --timeout de gunicorn)
+    ADMISSION_MAX_COLA_MS = float(os.getenv('ADMISSION_MAX_COLA_MS', '10000'))
+    ADMISSION_MAX_EN_VUELO = int(os.getenv('ADMISSION_MAX_EN_VUELO', '200'))
+    ADMISSION_DEADLINE = float(os.getenv('ADMISSION_DEADLINE', '55'))
+    # Servidor (server.py y gunicorn.conf.py): clase de worker ('gthread',
+    # 'sync' o 'async' con el modo ASGI); workers e hilos (0 = calcularlos con
+    # los CPUs, la memoria por worker y la fracción del tiempo que se espera a
+    # Finkok, medida en METRICS_DIR o fijada con SERVER_RAZON_ESPERA); reciclado
+    # de cada worker tras SERVER_MAX_REQUESTS peticiones (0 = nunca) y margen en
+    # segundos entre los timeouts de Finkok < aplicación < gunicorn < nginx (el
+    # presupuesto de cada consulta a Finkok es el menor deadline menos el margen)
+    SERVER_BIND = os.getenv('SERVER_BIND', '127.0.0.1:5000')
+    SERVER_WORKER_CLASS = os.getenv('SERVER_WORKER_CLASS', 'gthread')
+    SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '0'))
+    SERVER_THREADS = int(os.getenv('SERVER_THREADS', '0'))
+    SERVER_MAX_THREADS = int(os.getenv('SERVER_MAX_THREADS', '32'))
+    SERVER_MEMORIA_WORKER_MB = int(os.getenv('SERVER_MEMORIA_WORKER_MB', '150'))
+    SERVER_RAZON_ESPERA = float(os.getenv('SERVER_RAZON_ESPERA', '0'))
+    SERVER_MAX_REQUESTS = int(os.getenv('SERVER_MAX_REQUESTS', '5000'))
+    SERVER_MARGEN_TIMEOUT = float(os.getenv('SERVER_MARGEN_TIMEOUT', '5'))
+    # Compresión de respuestas (gzip, o brotli si está instalado) a partir de
+    # COMPRESSION_MIN_BYTES; nivel de gzip (1: la mitad de CPU que 5 con ~20% más
+    # de bytes, ver benchmarks/bench_json.py) y calidad de brotli
+    COMPRESSION_MIN_BYTES = int(os.getenv('COMPRESSION_MIN_BYTES', '1024'))
+    COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '1'))
+    COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))
+    # Trazas por petición: cabecera Server-Timing, registro JSON de las
+    # peticiones más lentas que el umbral (ms) y perfilador por muestreo
+    # opcional que guarda las pilas de las N peticiones más lentas
+    TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'True').lower() == 'true'
+    TRACING_SLOW_MS = float(os.getenv('TRACING_SLOW_MS', '2000'))
+    TRACING_PROFILER = os.getenv('TRACING_PROFILER', 'False').lower() == 'true'
+    TRACING_PROFILER_TOP_N = int(os.getenv('TRACING_PROFILER_TOP_N', '10'))
+    TRACING_PROFILER_INTERVAL_MS = float(os.getenv('TRACING_PROFILER_INTERVAL_MS', '5'))
+    TRACING_PROFILER_DIR = os.getenv('TRACING_PROFILER_DIR', '/tmp/monitor_sat/perfiles')
+    # Rechazar localmente RFCs cuyo dígito verificador no coincide
+    RFC_VALIDAR_DIGITO = os.getenv('RFC_VALIDAR_DIGITO', 'True').lower() == 'true'
+    DEBUG = os.getenv('DEBUG', 'True').lower() == 'true'
@@ -0,0 +1,107 @@
+"""
+Instantánea compacta del estatus SAT de un RFC para conjuntos grandes en memoria.
+
+Una respuesta procesada es un diccionario anidado con la fecha en texto ISO y
+una lista de alertas con su mensaje completo; el diccionario crudo de Finkok
+decodificado de JSON repite además las cadenas de sus claves en cada copia.
+Para los miles de RFCs que un worker mantiene en memoria (el refresco
+programado) `Snapshot` guarda solo los valores en `__slots__`, el RFC
+internado (la misma cadena que la clave del diccionario que lo contiene), el
+momento como epoch entero y las alertas como un código de bits. La respuesta
+de la API (datos, alertas con mensaje y fecha ISO) se arma solo al responder,
+directamente desde esos campos (`Snapshot.respuesta`).
+
+Las reglas de alertas viven aquí para que `SATMonitor.generar_alertas` y las
+instantáneas compactas produzcan exactamente lo mismo.
+"""
+
+import sys
+from datetime import datetime
+
+from history_store import CAMPOS
+
+# Códigos de alerta (bits), en el orden en que se presentan
+CRITICO = 1
+ADVERTENCIA = 2
+ATENCION = 4
+
+# Facturas pendientes a partir de las cuales se emite una advertencia
+UMBRAL_PENDIENTES = 10
+
+
+def codigos_alerta(pendientes, vencidas, discrepancias):
+    """Alertas de un RFC como combinación de bits CRITICO | ADVERTENCIA | ATENCION"""
+    codigos = 0
+    if vencidas > 0:
+        codigos |= CRITICO
+    if pendientes > UMBRAL_PENDIENTES:
+        codigos |= ADVERTENCIA
+    if discrepancias > 0:
+        codigos |= ATENCION
+    return codigos
+
+
+def renderizar_alertas(codigos, pendientes, vencidas, discrepancias):
+    """Lista de alertas de la API ({"tipo", "mensaje"}) a partir de sus códigos"""
+    alertas = []
+    if codigos & CRITICO:
+        alertas.append({
+            "tipo": "critico",
+            "mensaje": f"Tienes {vencidas} facturas vencidas que requieren atención inmediata"
+        })
+    if codigos & ADVERTENCIA:
+        alertas.append({
+            "tipo": "advertencia",
+            "mensaje": f"Tienes {pendientes} facturas pendientes de procesamiento"
+        })
+    if codigos & ATENCION:
+        alertas.append({
+            "tipo": "atencion",
+            "mensaje": f"Se encontraron {discrepancias} discrepancias en tus facturas"
+        })
+    return alertas
+
+
+class Snapshot:
+    """Datos SAT de un RFC en un momento, sin diccionarios ni cadenas por instancia"""
+
+    __slots__ = ('rfc', 'momento', 'pendientes', 'vencidas', 'discrepancias', 'total_facturas',
+                 'monto_total', 'alertas')
+
+    def __init__(self, rfc, momento, pendientes=0, vencidas=0, discrepancias=0, total_facturas=0,
+                 monto_total=0.0):
+        self.rfc = sys.intern(rfc)
+        self.momento = int(momento)
+        self.pendientes = pendientes
+        self.vencidas = vencidas
+        self.discrepancias = discrepancias
+        self.total_facturas = total_facturas
+        self.monto_total = monto_total
+        self.alertas = codigos_alerta(pendientes, vencidas, discrepancias)
+
+    @classmethod
+    def desde_datos(cls, rfc, datos, momento):
+        """Instantánea a partir de la respuesta cruda de Finkok (los demás campos se descartan)"""
+        return cls(rfc, momento, **{campo: datos[campo] for campo in CAMPOS if campo in datos})
+
+    def mismos_datos(self, datos):
+        """True si la respuesta cruda trae los mismos valores que la instantánea"""
+        return all(getattr(self, campo) == datos.get(campo, 0) for campo in CAMPOS)
+
+    def datos(self):
+        """Diccionario con los campos de la respuesta de Finkok (formato de la API)"""
+        return {campo: getattr(self, campo) for campo in CAMPOS}
+
+    def alertas_api(self):
+        """Alertas con tipo y mensaje, como las devuelve /consultar_sat"""
+        return renderizar_alertas(self.alertas, self.pendientes, self.vencidas, self.discrepancias)
+
+    def respuesta(self):
+        """Respuesta de /consultar_sat (sin "cache"); la fecha es la de la instantánea"""
+        return {
+            "rfc": self.rfc,
+            "timestamp": datetime.fromtimestamp(self.momento).isoformat(),
+            "status": "success",
+            "datos": self.datos(),
+            "alertas": self.alertas_api(),
+        }
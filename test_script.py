@@ -11,7 +11,7 @@ from datetime import datetime
 
 # Configuración
 BASE_URL = "http://localhost:5000"  # Cambiar por tu URL de producción
-TEST_RFC = "XEXX010101XXX"  # RFC de prueba
+TEST_RFC = "GODE561231GR8"  # RFC de prueba (formato, fecha y dígito verificador válidos)
 
 def test_health_check():
     """Prueba el endpoint de verificación de salud"""
@@ -190,12 +190,12 @@ def test_rfc_validos():
     """Prueba RFCs con formato válido"""
     print("\n🔍 Probando RFCs válidos...")
     
-    # RFCs con formato válido (aunque no necesariamente existan)
+    # RFCs con formato, fecha y dígito verificador válidos (aunque no necesariamente existan)
     rfcs_validos = [
-        "XEXX010101000",     # 13 caracteres - persona física
-        "ABC010101ABC",      # 12 caracteres - persona moral
-        "ABCD123456H12",     # 13 caracteres con formato correcto
-        "XYZ987654321"       # 12 caracteres formato correcto
+        "XEXX010101000",     # 13 caracteres - RFC genérico extranjero
+        "ABC010101AB1",      # 12 caracteres - persona moral
+        "GODE561231GR8",     # 13 caracteres - persona física
+        "SAT970701NN3"       # 12 caracteres - fecha y dígito verificador correctos
     ]
     
     resultados = []
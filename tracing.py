@@ -0,0 +1,247 @@
+"""
+Trazas por petición: tiempo por fase, cabecera Server-Timing, registro de
+peticiones lentas y un perfilador por muestreo opcional.
+
+La traza activa vive en una ContextVar, así que sirve igual para hilos
+(Flask) que para tareas de asyncio (ASGI). Sin traza activa, `fase()` solo
+hace una lectura de la ContextVar y devuelve un contexto nulo compartido.
+"""
+
+import contextlib
+import contextvars
+import heapq
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_traza_actual = contextvars.ContextVar('traza', default=None)
+_NULA = contextlib.nullcontext()
+
+
+class Traza:
+    """Tiempos de una petición"""
+
+    __slots__ = ('metodo', 'ruta', 'inicio', 'eventos', 'etiquetas', 'muestras', 'hilo')
+
+    def __init__(self, metodo, ruta):
+        self.metodo = metodo
+        self.ruta = ruta
+        self.inicio = time.perf_counter()
+        # (fase, segundos); append es atómico, así que las fases registradas
+        # desde el pool de consulta múltiple no necesitan lock
+        self.eventos = []
+        self.etiquetas = {}
+        self.muestras = None
+        self.hilo = threading.get_ident()
+
+    def fases(self):
+        """Segundos acumulados por fase, en orden de primera aparición"""
+        totales = {}
+        for nombre, duracion in self.eventos:
+            totales[nombre] = totales.get(nombre, 0.0) + duracion
+        return totales
+
+
+class _Fase:
+    __slots__ = ('traza', 'nombre', 'inicio')
+
+    def __init__(self, traza, nombre):
+        self.traza = traza
+        self.nombre = nombre
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.traza.eventos.append((self.nombre, time.perf_counter() - self.inicio))
+        return False
+
+
+def fase(nombre):
+    """Context manager que mide una fase de la petición actual"""
+    traza = _traza_actual.get()
+    if traza is None:
+        return _NULA
+    return _Fase(traza, nombre)
+
+
+def anotar(clave, valor):
+    """Agrega un dato (p. ej. el RFC) al registro de la petición actual si es lenta"""
+    traza = _traza_actual.get()
+    if traza is not None:
+        traza.etiquetas[clave] = valor
+
+
+class RequestTracer:
+    """Crea y cierra las trazas de las peticiones.
+
+    `umbral_lento` (segundos) define qué peticiones se registran como JSON;
+    con `perfilador` activo, un hilo muestrea las pilas de las peticiones en
+    curso cada `intervalo_muestreo` segundos y guarda en `directorio_perfiles`
+    las pilas más frecuentes de las `top_n` peticiones más lentas (formato
+    de pilas colapsadas, compatible con flamegraph.pl y speedscope).
+    """
+
+    def __init__(self, habilitado=True, umbral_lento=2.0, perfilador=False, top_n=10,
+                 intervalo_muestreo=0.005, directorio_perfiles=None, metricas=None):
+        self.habilitado = habilitado
+        self.umbral_lento = umbral_lento
+        self.perfilador = perfilador
+        self.top_n = top_n
+        self.intervalo_muestreo = intervalo_muestreo
+        self.directorio_perfiles = directorio_perfiles
+        self.metricas = metricas
+        self.lentas = 0
+        self._reiniciar()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        # También se usa tras un fork(): el hilo de muestreo no se hereda
+        self._activas = {}
+        self._peores = []
+        self._lock = threading.Lock()
+        self._hilo_muestreo = None
+
+    def iniciar(self, metodo, ruta, muestrear=True):
+        """Abre la traza de una petición; devuelve un token para `finalizar`.
+
+        Con `muestrear=False` la petición no se perfila; el perfilador asocia
+        muestras a hilos, así que no aplica a peticiones que comparten un
+        event loop.
+        """
+        if not self.habilitado:
+            return None
+        traza = Traza(metodo, ruta)
+        if self.perfilador and muestrear:
+            traza.muestras = Counter()
+            self._activas[traza.hilo] = traza
+            self._iniciar_muestreo()
+        return traza, _traza_actual.set(traza)
+
+    def finalizar(self, token, status=None):
+        """Cierra la traza; devuelve el valor de la cabecera Server-Timing (o None)"""
+        if token is None:
+            return None
+        traza, contexto = token
+        total = time.perf_counter() - traza.inicio
+        try:
+            _traza_actual.reset(contexto)
+        except ValueError:
+            # Cerrada desde otro contexto (p. ej. respuestas en streaming)
+            pass
+        if traza.muestras is not None:
+            self._activas.pop(traza.hilo, None)
+
+        fases = traza.fases()
+        if self.metricas is not None:
+            for nombre, duracion in fases.items():
+                self.metricas.observar(f'fase_{nombre}', duracion)
+
+        if total >= self.umbral_lento:
+            self.lentas += 1
+            self._registrar_lenta(traza, fases, total, status)
+        if traza.muestras:
+            self._guardar_perfil(traza, total)
+
+        partes = [f'{nombre};dur={duracion * 1000:.2f}' for nombre, duracion in fases.items()]
+        partes.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(partes)
+
+    def _registrar_lenta(self, traza, fases, total, status):
+        registro = {
+            'evento': 'peticion_lenta',
+            'metodo': traza.metodo,
+            'ruta': traza.ruta,
+            'status': status,
+            'duracion_ms': round(total * 1000, 1),
+            'fases_ms': {nombre: round(d * 1000, 1) for nombre, d in fases.items()},
+            'sin_fase_ms': round(max(0.0, total - sum(fases.values())) * 1000, 1),
+            **traza.etiquetas,
+        }
+        logger.warning(json.dumps(registro, ensure_ascii=False))
+
+    # Perfilador por muestreo
+
+    def _iniciar_muestreo(self):
+        if self._hilo_muestreo is not None:
+            return
+        with self._lock:
+            if self._hilo_muestreo is not None:
+                return
+            self._hilo_muestreo = threading.Thread(target=self._muestrear, name='trazas-muestreo', daemon=True)
+            self._hilo_muestreo.start()
+
+    def _muestrear(self):
+        while True:
+            time.sleep(self.intervalo_muestreo)
+            if not self._activas:
+                continue
+            marcos = sys._current_frames()
+            for hilo, traza in list(self._activas.items()):
+                marco = marcos.get(hilo)
+                if marco is not None and traza.muestras is not None:
+                    traza.muestras[_pila(marco)] += 1
+
+    def _guardar_perfil(self, traza, total):
+        """Conserva las pilas de la petición si está entre las top_n más lentas"""
+        if not self.directorio_perfiles:
+            return
+        with self._lock:
+            if len(self._peores) >= self.top_n and total <= self._peores[0][0]:
+                return
+            nombre = f"{int(time.time() * 1000)}_{os.getpid()}_{int(total * 1000)}ms.txt"
+            ruta = os.path.join(self.directorio_perfiles, nombre)
+            heapq.heappush(self._peores, (total, ruta))
+            descartada = heapq.heappop(self._peores)[1] if len(self._peores) > self.top_n else None
+        try:
+            os.makedirs(self.directorio_perfiles, exist_ok=True)
+            with open(ruta, 'w') as f:
+                f.write(f"# {traza.metodo} {traza.ruta} {total * 1000:.1f} ms, "
+                        f"{sum(traza.muestras.values())} muestras cada {self.intervalo_muestreo * 1000:g} ms\n")
+                for pila, n in traza.muestras.most_common():
+                    f.write(f"{pila} {n}\n")
+            if descartada:
+                os.remove(descartada)
+        except OSError as e:
+            logger.error(f"Error guardando perfil: {str(e)}")
+
+    def estadisticas(self):
+        return {
+            "habilitado": self.habilitado,
+            "umbral_lento_ms": round(self.umbral_lento * 1000),
+            "lentas": self.lentas,
+            "perfilador": self.perfilador,
+            "perfiles_guardados": len(self._peores),
+        }
+
+
+def _pila(marco):
+    """Pila colapsada 'archivo:funcion;...' de la raíz a la hoja"""
+    partes = []
+    while marco is not None:
+        codigo = marco.f_code
+        partes.append(f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}")
+        marco = marco.f_back
+    partes.reverse()
+    return ';'.join(partes)
+
+
+def crear_tracer(config, metricas=None):
+    """Construye el tracer a partir de la configuración"""
+    return RequestTracer(
+        habilitado=config.TRACING_ENABLED,
+        umbral_lento=config.TRACING_SLOW_MS / 1000.0,
+        perfilador=config.TRACING_PROFILER,
+        top_n=config.TRACING_PROFILER_TOP_N,
+        intervalo_muestreo=config.TRACING_PROFILER_INTERVAL_MS / 1000.0,
+        directorio_perfiles=config.TRACING_PROFILER_DIR,
+        metricas=metricas
+    )
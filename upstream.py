@@ -0,0 +1,394 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+class CircuitoAbierto(requests.exceptions.RequestException):
+    """Se lanza cuando el circuit breaker rechaza la petición sin llamar a Finkok"""
+
+
+class CircuitBreaker:
+    """Circuit breaker con estados cerrado → abierto → semiabierto.
+
+    Tras `umbral_fallos` fallos consecutivos se abre y rechaza peticiones
+    durante `tiempo_reset` segundos; luego deja pasar una sola prueba.
+    """
+
+    CERRADO = 'cerrado'
+    ABIERTO = 'abierto'
+    SEMIABIERTO = 'semiabierto'
+
+    def __init__(self, umbral_fallos=5, tiempo_reset=30.0):
+        self.umbral_fallos = umbral_fallos
+        self.tiempo_reset = tiempo_reset
+        self._estado = self.CERRADO
+        self._fallos = 0
+        self._abierto_desde = 0.0
+        self._prueba_en_curso = False
+        self._lock = threading.Lock()
+        self.aperturas = 0
+        self.rechazos = 0
+
+    @property
+    def estado(self):
+        with self._lock:
+            self._actualizar()
+            return self._estado
+
+    def _actualizar(self):
+        if (self._estado == self.ABIERTO
+                and time.monotonic() - self._abierto_desde >= self.tiempo_reset):
+            self._estado = self.SEMIABIERTO
+            self._prueba_en_curso = False
+
+    def permitir(self):
+        """Indica si se puede llamar a Finkok en este momento"""
+        with self._lock:
+            self._actualizar()
+            if self._estado == self.CERRADO:
+                return True
+            if self._estado == self.SEMIABIERTO and not self._prueba_en_curso:
+                self._prueba_en_curso = True
+                return True
+            self.rechazos += 1
+            return False
+
+    def registrar_exito(self):
+        with self._lock:
+            self._fallos = 0
+            self._prueba_en_curso = False
+            self._estado = self.CERRADO
+
+    def registrar_fallo(self):
+        with self._lock:
+            self._fallos += 1
+            self._prueba_en_curso = False
+            if self._estado == self.SEMIABIERTO or self._fallos >= self.umbral_fallos:
+                if self._estado != self.ABIERTO:
+                    self.aperturas += 1
+                    logger.warning("Circuit breaker de Finkok abierto")
+                self._estado = self.ABIERTO
+                self._abierto_desde = time.monotonic()
+
+    def liberar_prueba(self):
+        """Libera la prueba en curso sin contarla como éxito ni como fallo"""
+        with self._lock:
+            self._prueba_en_curso = False
+
+    def segundos_para_reintento(self):
+        """Segundos que faltan para que el breaker deje pasar una prueba"""
+        with self._lock:
+            if self._estado != self.ABIERTO:
+                return 0.0
+            return max(0.0, self.tiempo_reset - (time.monotonic() - self._abierto_desde))
+
+
+def alcanza(limite, segundos):
+    """Indica si antes de `limite` (monotónico; None = sin límite) caben `segundos` más"""
+    return limite is None or time.monotonic() + segundos < limite
+
+
+class FinkokClient:
+    """Cliente HTTP para Finkok con pool de conexiones, reintentos y circuit breaker.
+
+    Todos los hilos comparten el mismo HTTPAdapter (y por tanto el pool de
+    urllib3, que es thread-safe); cada hilo usa su propia Session para no
+    compartir estado mutable como cookies.
+
+    Con `presupuesto` (segundos) una consulta, contando reintentos y backoff,
+    no pasa de ese tiempo: cada intento recorta sus timeouts a lo que queda y
+    no se reintenta si no alcanza ni para conectar.
+    """
+
+    def __init__(self, url, pool_conexiones=4, pool_max=10, pool_bloqueante=False,
+                 timeout_conexion=3.05, timeout_lectura=25.0, reintentos=2,
+                 backoff_base=0.2, backoff_max=2.0, breaker=None, presupuesto=None):
+        self.url = url
+        self.timeout = (timeout_conexion, timeout_lectura)
+        self.presupuesto = presupuesto
+        self.reintentos = reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_conexiones,
+            pool_maxsize=pool_max,
+            pool_block=pool_bloqueante,
+            max_retries=0
+        )
+        self._local = threading.local()
+        self.peticiones = 0
+        self.reintentos_realizados = 0
+        self.fallos = 0
+
+    @property
+    def session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({
+                'Content-Type': 'application/json',
+                'User-Agent': 'Monitor-SAT/1.0'
+            })
+            session.mount('https://', self.adapter)
+            session.mount('http://', self.adapter)
+            self._local.session = session
+        return session
+
+    def _espera(self, intento):
+        # Backoff exponencial con "full jitter" para no sincronizar reintentos
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** intento)))
+
+    def _timeouts(self, limite):
+        if limite is None:
+            return self.timeout
+        restante = max(0.001, limite - time.monotonic())
+        return min(self.timeout[0], restante), min(self.timeout[1], restante)
+
+    def post_json(self, payload, url=None):
+        """Envía el payload a Finkok y devuelve el JSON de respuesta"""
+        if not self.breaker.permitir():
+            raise CircuitoAbierto(
+                f"Finkok no disponible; reintentar en {self.breaker.segundos_para_reintento():.0f}s"
+            )
+
+        limite = time.monotonic() + self.presupuesto if self.presupuesto else None
+        intento = 0
+        while True:
+            self.peticiones += 1
+            try:
+                response = self.session.post(url or self.url, json=payload, timeout=self._timeouts(limite))
+                response.raise_for_status()
+                data = response.json()
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout,
+                    requests.exceptions.HTTPError) as e:
+                status = getattr(e.response, 'status_code', None)
+                # La consulta de estatus es idempotente: se reintentan errores de
+                # red, 5xx y 429; los demás 4xx son errores de la petición
+                es_fallo_upstream = status is None or status >= 500 or status == 429
+                espera = self._espera(intento + 1)
+                if es_fallo_upstream and intento < self.reintentos and alcanza(limite, espera + self.timeout[0]):
+                    intento += 1
+                    self.reintentos_realizados += 1
+                    logger.warning(f"Reintentando Finkok ({intento}/{self.reintentos}) en {espera:.2f}s: {str(e)}")
+                    time.sleep(espera)
+                    continue
+                if es_fallo_upstream:
+                    self.fallos += 1
+                    self.breaker.registrar_fallo()
+                else:
+                    self.breaker.registrar_exito()
+                raise
+            except Exception:
+                self.fallos += 1
+                self.breaker.registrar_fallo()
+                raise
+
+            self.breaker.registrar_exito()
+            return data
+
+    def _estadisticas_pool(self):
+        conexiones = 0
+        peticiones = 0
+        pools = self.adapter.poolmanager.pools
+        for clave in list(pools.keys()):
+            pool = pools.get(clave)
+            if pool is None:
+                continue
+            conexiones += pool.num_connections
+            peticiones += pool.num_requests
+        return conexiones, peticiones
+
+    def estadisticas(self):
+        """Métricas de reutilización del pool, reintentos y estado del breaker"""
+        conexiones, peticiones_pool = self._estadisticas_pool()
+        return {
+            "peticiones": self.peticiones,
+            "reintentos": self.reintentos_realizados,
+            "fallos": self.fallos,
+            "pool": {
+                "conexiones_abiertas": conexiones,
+                "peticiones": peticiones_pool,
+                "reutilizadas": max(0, peticiones_pool - conexiones),
+            },
+            "breaker": {
+                "estado": self.breaker.estado,
+                "aperturas": self.breaker.aperturas,
+                "rechazos": self.breaker.rechazos,
+            },
+        }
+
+
+class AsyncFinkokClient:
+    """Versión asíncrona del cliente (httpx), para el modo de servicio ASGI.
+
+    Comparte la lógica de reintentos (y el `presupuesto` por consulta) y puede
+    compartir el circuit breaker con el cliente síncrono. asyncio y httpx se
+    importan aquí para que el modo WSGI no dependa de ellos ni los cargue al
+    arrancar.
+    """
+
+    def __init__(self, url, pool_max=100, pool_keepalive=20, timeout_conexion=3.05,
+                 timeout_lectura=25.0, reintentos=2, backoff_base=0.2, backoff_max=2.0,
+                 breaker=None, presupuesto=None):
+        import asyncio
+        import httpx
+
+        self._asyncio = asyncio
+        self._httpx = httpx
+        self.url = url
+        self.timeout_conexion = timeout_conexion
+        self.timeout_lectura = timeout_lectura
+        self.presupuesto = presupuesto
+        self.reintentos = reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_max, max_keepalive_connections=pool_keepalive),
+            timeout=httpx.Timeout(timeout_lectura, connect=timeout_conexion),
+            headers={'Content-Type': 'application/json', 'User-Agent': 'Monitor-SAT/1.0'}
+        )
+        # Excepciones que representan un problema de conexión con Finkok
+        self.errores_conexion = (CircuitoAbierto, httpx.HTTPError)
+        self.peticiones = 0
+        self.reintentos_realizados = 0
+        self.fallos = 0
+
+    def _espera(self, intento):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** intento)))
+
+    async def post_json(self, payload, url=None):
+        """Envía el payload a Finkok sin bloquear el event loop"""
+        asyncio, httpx = self._asyncio, self._httpx
+        if not self.breaker.permitir():
+            raise CircuitoAbierto(
+                f"Finkok no disponible; reintentar en {self.breaker.segundos_para_reintento():.0f}s"
+            )
+
+        limite = time.monotonic() + self.presupuesto if self.presupuesto else None
+        intento = 0
+        while True:
+            self.peticiones += 1
+            try:
+                if limite is None:
+                    response = await self.client.post(url or self.url, json=payload)
+                else:
+                    restante = max(0.001, limite - time.monotonic())
+                    timeout = httpx.Timeout(min(self.timeout_lectura, restante),
+                                            connect=min(self.timeout_conexion, restante))
+                    response = await self.client.post(url or self.url, json=payload, timeout=timeout)
+                response.raise_for_status()
+                data = response.json()
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+                es_fallo_upstream = status is None or status >= 500 or status == 429
+                espera = self._espera(intento + 1)
+                if es_fallo_upstream and intento < self.reintentos and alcanza(limite, espera + self.timeout_conexion):
+                    intento += 1
+                    self.reintentos_realizados += 1
+                    logger.warning(f"Reintentando Finkok ({intento}/{self.reintentos}) en {espera:.2f}s: {str(e)}")
+                    await asyncio.sleep(espera)
+                    continue
+                if es_fallo_upstream:
+                    self.fallos += 1
+                    self.breaker.registrar_fallo()
+                else:
+                    self.breaker.registrar_exito()
+                raise
+            except asyncio.CancelledError:
+                # Cancelada por el tiempo límite del lote: no cuenta como fallo
+                self.breaker.liberar_prueba()
+                raise
+            except Exception:
+                self.fallos += 1
+                self.breaker.registrar_fallo()
+                raise
+
+            self.breaker.registrar_exito()
+            return data
+
+    async def cerrar(self):
+        await self.client.aclose()
+
+    def estadisticas(self):
+        return {
+            "peticiones": self.peticiones,
+            "reintentos": self.reintentos_realizados,
+            "fallos": self.fallos,
+            "breaker": {
+                "estado": self.breaker.estado,
+                "aperturas": self.breaker.aperturas,
+                "rechazos": self.breaker.rechazos,
+            },
+        }
+
+
+def consumidores_finkok(config, hilos_peticion=None):
+    """Hilos de un worker que pueden consultar a Finkok al mismo tiempo.
+
+    Peticiones (SERVER_THREADS o, si se calcula, su máximo), consulta
+    múltiple, revalidación en segundo plano, trabajos masivos y refresco
+    programado comparten el mismo pool.
+    """
+    if hilos_peticion is None:
+        hilos_peticion = config.SERVER_THREADS or config.SERVER_MAX_THREADS
+    return (hilos_peticion + config.MULTIPLE_MAX_WORKERS + config.STALE_HILOS
+            + config.JOBS_CONCURRENCIA + config.SCHEDULER_CONCURRENCIA)
+
+
+def presupuesto_finkok(config):
+    """Segundos que puede tardar una consulta a Finkok con todos sus reintentos.
+
+    Sale del deadline de la aplicación (el menor entre ADMISSION_DEADLINE y
+    MULTIPLE_DEADLINE) menos SERVER_MARGEN_TIMEOUT, así que una consulta
+    siempre termina antes que la petición que la espera; None si no hay deadline.
+    """
+    deadlines = [d for d in (config.ADMISSION_DEADLINE, config.MULTIPLE_DEADLINE) if d > 0]
+    if not deadlines:
+        return None
+    return max(config.FINKOK_CONNECT_TIMEOUT, min(deadlines) - config.SERVER_MARGEN_TIMEOUT)
+
+
+def tamano_pool(config):
+    """Conexiones que conserva el pool (las de más se abren y cierran al vuelo)"""
+    return config.FINKOK_POOL_MAXSIZE or consumidores_finkok(config)
+
+
+def crear_cliente(config):
+    """Construye el cliente de Finkok a partir de la configuración"""
+    return FinkokClient(
+        config.FINKOK_API_URL,
+        pool_conexiones=config.FINKOK_POOL_CONNECTIONS,
+        pool_max=tamano_pool(config),
+        pool_bloqueante=config.FINKOK_POOL_BLOCK,
+        timeout_conexion=config.FINKOK_CONNECT_TIMEOUT,
+        timeout_lectura=config.FINKOK_READ_TIMEOUT,
+        reintentos=config.FINKOK_RETRIES,
+        backoff_base=config.FINKOK_BACKOFF_BASE,
+        backoff_max=config.FINKOK_BACKOFF_MAX,
+        breaker=CircuitBreaker(config.BREAKER_UMBRAL, config.BREAKER_RESET),
+        presupuesto=presupuesto_finkok(config)
+    )
+
+
+def crear_cliente_async(config, breaker=None):
+    """Construye el cliente asíncrono de Finkok a partir de la configuración"""
+    return AsyncFinkokClient(
+        config.FINKOK_API_URL,
+        pool_max=config.ASGI_MAX_CONEXIONES,
+        pool_keepalive=config.ASGI_MAX_CONEXIONES,
+        timeout_conexion=config.FINKOK_CONNECT_TIMEOUT,
+        timeout_lectura=config.FINKOK_READ_TIMEOUT,
+        reintentos=config.FINKOK_RETRIES,
+        backoff_base=config.FINKOK_BACKOFF_BASE,
+        backoff_max=config.FINKOK_BACKOFF_MAX,
+        breaker=breaker,
+        presupuesto=presupuesto_finkok(config)
+    )